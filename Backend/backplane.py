@@ -0,0 +1,159 @@
+# backplane.py
+# 跨行程的 pub/sub 通道：讓 uvicorn --workers N 的每個 worker 都收得到其他 worker 的廣播、上線狀態與踢人事件
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+
+class Backplane:
+    """
+    pub/sub 介面：publish 出去的事件會送到「其他」行程註冊的 handler
+    自己發出的事件不會再回到自己身上 (本機的處理由呼叫端直接完成)
+    """
+    def __init__(self):
+        # 每個行程一個唯一 id，用來過濾自己發出的事件
+        self.node_id = uuid.uuid4().hex
+        self._handlers: Dict[str, List[Callable[[Any], None]]] = {}
+
+    def on(self, kind: str, handler: Callable[[Any], None]):
+        """註冊某一種事件的處理函式 (同步函式，在 event loop 上執行)"""
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def _dispatch(self, kind: str, data: Any):
+        for handler in self._handlers.get(kind, []):
+            try:
+                handler(data)
+            except Exception as e:
+                print(f"Backplane 事件處理失敗 ({kind}): {e}")
+
+    def publish(self, kind: str, data: Any):
+        """送出事件 (不會等待，也不會阻塞 event loop)"""
+        raise NotImplementedError
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class LocalBackplane(Backplane):
+    """單一行程用：沒有其他 worker，事件不必送到任何地方"""
+    def publish(self, kind: str, data: Any):
+        pass
+
+
+class SQLiteBackplane(Backplane):
+    """
+    用一個獨立的 SQLite 檔當作共用事件表，不需要任何外部服務
+    送出的事件先累積在 outbox，由背景任務一次寫入，同時輪詢其他行程寫入的新事件
+    """
+    def __init__(self, path: str, poll_interval: float = 0.05, retention: float = 60.0):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        # 事件表只保留最近 retention 秒，避免無限長大
+        self.retention = retention
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._outbox: list = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._cursor = 0
+        self._last_cleanup = 0.0
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.execute("PRAGMA busy_timeout = 5000;")
+        conn.execute('''CREATE TABLE IF NOT EXISTS events
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                         origin TEXT,
+                         kind TEXT,
+                         payload TEXT,
+                         created REAL)''')
+        conn.commit()
+        # 只看啟動之後的新事件
+        self._cursor = conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        return conn
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backplane")
+        self._conn = await loop.run_in_executor(self._executor, self._open)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._pump())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        # 把還沒送出的事件寫完再關閉
+        if self._outbox and self._conn:
+            outbox, self._outbox = self._outbox, []
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._exchange, outbox)
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        if self._conn:
+            self._conn.close()
+        self._conn = None
+
+    def publish(self, kind: str, data: Any):
+        self._outbox.append((self.node_id, kind, json.dumps(data), time.time()))
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _exchange(self, outbox: list):
+        """(在背景執行緒) 寫入 outbox，並讀回其他行程的新事件"""
+        conn = self._conn
+        if outbox:
+            try:
+                conn.executemany("INSERT INTO events (origin, kind, payload, created) VALUES (?, ?, ?, ?)", outbox)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        rows = conn.execute("SELECT id, origin, kind, payload FROM events WHERE id > ? ORDER BY id",
+                            (self._cursor,)).fetchall()
+        if rows:
+            self._cursor = rows[-1][0]
+        now = time.time()
+        if now - self._last_cleanup > self.retention:
+            conn.execute("DELETE FROM events WHERE created < ?", (now - self.retention,))
+            conn.commit()
+            self._last_cleanup = now
+        return [(origin, kind, payload) for _, origin, kind, payload in rows if origin != self.node_id]
+
+    async def _pump(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            outbox, self._outbox = self._outbox, []
+            try:
+                events = await loop.run_in_executor(self._executor, self._exchange, outbox)
+            except Exception as e:
+                print(f"Backplane 同步失敗: {e}")
+                # 寫入失敗的事件放回去，下一輪再試
+                self._outbox[:0] = outbox
+                continue
+            for _, kind, payload in events:
+                self._dispatch(kind, json.loads(payload))
+
+
+def create_backplane(kind: str, path: str) -> Backplane:
+    """依設定建立 backplane ("local" 或 "sqlite")"""
+    if kind == "sqlite":
+        return SQLiteBackplane(path)
+    return LocalBackplane()
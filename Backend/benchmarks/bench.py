@@ -0,0 +1,414 @@
+# bench.py
+# 聊天室後端的壓力測試：在暫存目錄啟動一個全新的伺服器 (uvicorn)，模擬 N 個客戶端
+# 量測項目：
+#   - 連線時收到 history 的延遲 (所有客戶端同時連線)
+#   - 訊息吞吐量與廣播延遲 (p50 / p99)
+#   - /history/more 在不同深度的單頁延遲 (游標分頁 vs OFFSET 分頁)
+#   - /upload 吞吐量
+# 結果存成 JSON，可以用 --compare 跟之前的結果比較
+#
+# 用法 (在 Backend 目錄下)：
+#   python benchmarks/bench.py --clients 50 --messages 20
+#   python benchmarks/bench.py --compare bench-results/舊的結果.json
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+import httpx
+import websockets
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "benchpass1"
+MSGPACK_SUBPROTOCOL = "chat.msgpack.v1"
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize_ms(seconds):
+    """秒數列表 -> 毫秒的 p50 / p99 / 最大值"""
+    ms = [s * 1000 for s in seconds]
+    return {
+        "count": len(ms),
+        "p50_ms": round(percentile(ms, 50), 3) if ms else None,
+        "p99_ms": round(percentile(ms, 99), 3) if ms else None,
+        "max_ms": round(max(ms), 3) if ms else None,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# --- 準備資料與伺服器 ---
+def seed_database(workdir, count):
+    """先建立資料表並塞入 count 則舊訊息 (用 main 的 init_db / insert_messages，跟正式的寫入路徑一樣)"""
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    try:
+        import sqlite3
+        import main
+        from search import register_sql_functions
+        main.init_db()
+        conn = sqlite3.connect(main.DB_NAME)
+        register_sql_functions(conn)
+        rows = [(f"seed{i % 100}", f"歷史訊息 {i} lorem ipsum dolor sit amet", "text",
+                 "2024-01-01 12:00:00", None, main.DEFAULT_ROOM) for i in range(count)]
+        for start in range(0, count, 10000):
+            main.insert_messages(conn, rows[start:start + 10000])
+        conn.commit()
+        conn.close()
+    finally:
+        os.chdir(cwd)
+
+def start_server(workdir, port):
+    env = {
+        **os.environ,
+        "JWT_SECRET_KEY": "bench-secret",
+        # 量的是伺服器的處理能力，不是洗版防護，所以把限制放寬
+        "CHAT_FLOOD_USER_RATE": "1000000",
+        "CHAT_FLOOD_USER_BURST": "1000000",
+        "CHAT_FLOOD_GLOBAL_RATE": "1000000",
+        "CHAT_FLOOD_GLOBAL_BURST": "1000000",
+        # 種子訊息的時間是很久以前，保留工作一跑就會把它們封存掉，量到一半資料就變了
+        "CHAT_RETENTION": "0",
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=env)
+
+async def wait_until_ready(http, proc, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("伺服器啟動失敗")
+        try:
+            if (await http.get("/users")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("等不到伺服器啟動")
+
+
+# --- 帳號 ---
+async def post_with_retry(http, url, payload):
+    """bcrypt 行程池滿了會回 503，照 Retry-After 重試"""
+    while True:
+        r = await http.post(url, json=payload)
+        if r.status_code != 503:
+            return r
+        await asyncio.sleep(float(r.headers.get("retry-after", "1")))
+
+async def create_accounts(http, count, concurrency=8):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        username = f"bench{i}"
+        async with semaphore:
+            await post_with_retry(http, "/register", {"username": username, "password": PASSWORD,
+                                                      "confirm_password": PASSWORD})
+            r = await post_with_retry(http, "/token", {"username": username, "password": PASSWORD})
+            r.raise_for_status()
+            return username, r.json()["access_token"]
+
+    return await asyncio.gather(*(one(i) for i in range(count)))
+
+
+# --- WebSocket 客戶端 ---
+class Client:
+    def __init__(self, index, username, token, protocol):
+        self.index = index
+        self.username = username
+        self.token = token
+        self.protocol = protocol
+        self.ws = None
+        self.history_seconds = None
+        self.history_size = 0
+        self.history_event = asyncio.Event()
+        self.received = 0
+        self.reader = None
+
+    def decode(self, raw):
+        if isinstance(raw, bytes):
+            return msgpack.unpackb(raw)
+        return json.loads(raw)
+
+    async def connect(self, base_ws_url):
+        started = time.perf_counter()
+        subprotocols = [MSGPACK_SUBPROTOCOL] if self.protocol == "msgpack" else None
+        self.ws = await websockets.connect(f"{base_ws_url}/ws?token={self.token}",
+                                           subprotocols=subprotocols, max_size=None)
+        raw = await self.ws.recv()
+        self.history_seconds = time.perf_counter() - started
+        self.history_size = len(raw)
+
+    async def read(self, bench):
+        try:
+            async for raw in self.ws:
+                data = self.decode(raw)
+                if data.get("type") != "chat":
+                    continue
+                text = data.get("message", "")
+                if not text.startswith("bench:"):
+                    continue
+                bench.delivered(text, time.perf_counter())
+        except websockets.ConnectionClosed:
+            pass
+
+
+class ChatBench:
+    def __init__(self, clients):
+        self.clients = clients
+        self.sent_at = {}
+        self.latencies = []
+        self.deliveries = 0
+        self.expected = 0
+        self.last_delivery = None
+        self.done = asyncio.Event()
+
+    def delivered(self, text, now):
+        sent = self.sent_at.get(text)
+        if sent is None:
+            return
+        self.latencies.append(now - sent)
+        self.deliveries += 1
+        self.last_delivery = now
+        if self.deliveries >= self.expected:
+            self.done.set()
+
+    async def run(self, messages_per_client, rate, timeout):
+        self.expected = len(self.clients) * messages_per_client * len(self.clients)
+        interval = 1 / rate if rate > 0 else 0
+
+        async def sender(client):
+            for seq in range(messages_per_client):
+                text = f"bench:{client.index}:{seq}"
+                self.sent_at[text] = time.perf_counter()
+                await client.ws.send(text)
+                if interval:
+                    await asyncio.sleep(interval)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender(c) for c in self.clients))
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = (self.last_delivery or time.perf_counter()) - started
+        sent = len(self.clients) * messages_per_client
+        return {
+            "messages_sent": sent,
+            "deliveries_expected": self.expected,
+            "deliveries_received": self.deliveries,
+            "elapsed_s": round(elapsed, 3),
+            "messages_per_s": round(sent / elapsed, 1) if elapsed else None,
+            "deliveries_per_s": round(self.deliveries / elapsed, 1) if elapsed else None,
+            "broadcast_latency": summarize_ms(self.latencies),
+        }
+
+
+# --- HTTP 量測 ---
+async def bench_history_pages(http, depths, repeat, page_size):
+    """同一個深度各打 repeat 次：before_id 游標分頁 與 skip (OFFSET) 分頁"""
+    newest = (await http.get("/history/more", params={"skip": 0, "limit": 1})).json()
+    max_id = newest[-1]["id"] if newest else 0
+    results = {}
+    for depth in depths:
+        for mode in ("cursor", "offset"):
+            params = ({"before_id": max_id - depth + 1, "limit": page_size} if mode == "cursor"
+                      else {"skip": depth, "limit": page_size})
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                r = await http.get("/history/more", params=params)
+                timings.append(time.perf_counter() - started)
+                r.raise_for_status()
+            results[f"{mode}_depth_{depth}"] = summarize_ms(timings)
+    return results
+
+async def bench_uploads(http, count, size, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def one(i):
+        # 每個檔案內容都不同，避免被去除重複
+        body = os.urandom(size)
+        async with semaphore:
+            started = time.perf_counter()
+            r = await http.post("/upload", files={"file": (f"bench{i}.zip", body, "application/zip")})
+            timings.append(time.perf_counter() - started)
+            r.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    elapsed = time.perf_counter() - started
+    return {
+        "files": count,
+        "file_size_bytes": size,
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "files_per_s": round(count / elapsed, 2),
+        "mb_per_s": round(count * size / elapsed / (1024 * 1024), 2),
+        "latency": summarize_ms(timings),
+    }
+
+
+async def run_bench(args, port):
+    base_url = f"http://127.0.0.1:{port}"
+    results = {}
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as http:
+        print(f"建立 {args.clients} 個帳號...")
+        accounts = await create_accounts(http, args.clients)
+        clients = [Client(i, username, token, args.protocol) for i, (username, token) in enumerate(accounts)]
+
+        print("所有客戶端同時連線...")
+        started = time.perf_counter()
+        await asyncio.gather(*(c.connect(f"ws://127.0.0.1:{port}") for c in clients))
+        results["connect"] = {
+            "clients": len(clients),
+            "protocol": args.protocol,
+            "all_connected_s": round(time.perf_counter() - started, 3),
+            "history_frame_bytes": clients[0].history_size,
+            "history_latency": summarize_ms([c.history_seconds for c in clients]),
+        }
+
+        bench = ChatBench(clients)
+        for c in clients:
+            c.reader = asyncio.create_task(c.read(bench))
+        # 等加入訊息與上線名單的廣播結束
+        await asyncio.sleep(1)
+
+        print(f"每個客戶端送出 {args.messages} 則訊息...")
+        results["chat"] = await bench.run(args.messages, args.rate, args.timeout)
+
+        for c in clients:
+            await c.ws.close()
+        await asyncio.gather(*(c.reader for c in clients), return_exceptions=True)
+
+        print("量測 /history/more...")
+        depths = [d for d in args.depths if d < args.seed]
+        results["history_more"] = await bench_history_pages(http, depths, args.repeat, 50)
+
+        print("量測 /upload...")
+        results["upload"] = await bench_uploads(http, args.uploads, args.upload_size, args.upload_concurrency)
+
+        results["server_metrics"] = (await http.get("/metrics")).text
+    return results
+
+
+# --- 比較兩次結果 ---
+def flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            flatten(f"{prefix}.{k}" if prefix else k, v, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+    return out
+
+def compare(old_path, new):
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    old_values = flatten("", old["results"], {})
+    new_values = flatten("", new["results"], {})
+    print(f"\n與 {old['meta']['commit']} 比較：")
+    for key, value in new_values.items():
+        if key not in old_values or not old_values[key]:
+            continue
+        change = (value - old_values[key]) / old_values[key] * 100
+        print(f"  {key:55s} {old_values[key]:>12} -> {value:>12}  ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天室後端壓力測試")
+    parser.add_argument("--clients", type=int, default=50, help="同時連線的客戶端數")
+    parser.add_argument("--messages", type=int, default=20, help="每個客戶端送出幾則訊息")
+    parser.add_argument("--rate", type=float, default=0, help="每個客戶端每秒送幾則 (0 = 全速)")
+    parser.add_argument("--protocol", choices=["json", "msgpack"], default="json")
+    parser.add_argument("--seed", type=int, default=20000, help="預先塞入的歷史訊息數")
+    parser.add_argument("--depths", type=int, nargs="+", default=[0, 1000, 5000, 19000],
+                        help="/history/more 要量測的深度 (距離最新訊息幾則)")
+    parser.add_argument("--repeat", type=int, default=30, help="/history/more 每個深度打幾次")
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--upload-size", type=int, default=1024 * 1024)
+    parser.add_argument("--upload-concurrency", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=60, help="等廣播送達的最長秒數")
+    parser.add_argument("--output", help="結果檔路徑 (預設 bench-results/<時間>-<commit>.json)")
+    parser.add_argument("--compare", help="跟之前的結果檔比較")
+    parser.add_argument("--keep", action="store_true", help="保留暫存目錄 (資料庫、上傳檔)")
+    args = parser.parse_args()
+    if args.protocol == "msgpack" and msgpack is None:
+        parser.error("--protocol msgpack 需要安裝 msgpack")
+
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    port = free_port()
+    print(f"暫存目錄 {workdir}，塞入 {args.seed} 則歷史訊息...")
+    seed_database(workdir, args.seed)
+    proc = start_server(workdir, port)
+    try:
+        async def run():
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as http:
+                await wait_until_ready(http, proc)
+            return await run_bench(args, port)
+        results = asyncio.run(run())
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = git_commit()
+    report = {
+        "meta": {
+            "commit": commit,
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        "bench-results", f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{commit}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    printable = {k: v for k, v in results.items() if k != "server_metrics"}
+    print(json.dumps(printable, ensure_ascii=False, indent=2))
+    print(f"結果已存到 {output}")
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == "__main__":
+    main()
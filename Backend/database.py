@@ -0,0 +1,115 @@
+# database.py
+# 共用的 SQLite 存取層：長駐連線 + 專屬執行緒池，讓 async 路由不會卡在資料庫上
+import sqlite3
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+# 每條連線快取的 prepared statement 數量 (sqlite3 內建的 statement cache)
+STATEMENT_CACHE_SIZE = 256
+# checkpoint 之後 WAL 檔超過這個大小就截斷 (大量刪除後 WAL 不會一直佔著空間)
+WAL_SIZE_LIMIT = 64 * 1024 * 1024
+
+
+class Database:
+    """
+    一條寫入連線 + 多條讀取連線 (WAL 模式下讀寫互不阻塞)
+    所有 SQL 都在專屬的執行緒池上跑，對外只提供 await 的介面
+    """
+    def __init__(self, path: str, readers: int = 4,
+                 on_connect: Optional[Callable[[sqlite3.Connection], None]] = None):
+        self.path = path
+        self.readers = readers
+        # 每條新連線建立後呼叫 (例如註冊觸發器會用到的 SQL 函式)
+        self.on_connect = on_connect
+        self._writer_executor: Optional[ThreadPoolExecutor] = None
+        self._reader_executor: Optional[ThreadPoolExecutor] = None
+        self._writer_conn: Optional[sqlite3.Connection] = None
+        # 每個讀取執行緒各自持有一條連線
+        self._local = threading.local()
+        self._reader_conns: list = []
+        self._lock = threading.Lock()
+
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA busy_timeout = 5000;")
+        # WAL 模式下 NORMAL 已經足夠安全，且每次 commit 不必 fsync 主檔
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.execute(f"PRAGMA journal_size_limit = {WAL_SIZE_LIMIT};")
+        if readonly:
+            conn.execute("PRAGMA query_only = 1;")
+        if self.on_connect:
+            self.on_connect(conn)
+        return conn
+
+    def open(self):
+        """建立寫入連線與兩個執行緒池 (在 lifespan 啟動時呼叫)"""
+        if self._writer_conn is not None:
+            return
+        # 寫入只有一個執行緒，SQLite 同一時間本來就只允許一個寫入者
+        self._writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._reader_executor = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="db-reader")
+        self._writer_conn = self._connect()
+
+    def close(self):
+        """關閉所有連線與執行緒池 (在 lifespan 結束時呼叫)"""
+        if self._writer_executor:
+            self._writer_executor.shutdown(wait=True)
+        if self._reader_executor:
+            self._reader_executor.shutdown(wait=True)
+        with self._lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+        if self._writer_conn:
+            self._writer_conn.close()
+        self._writer_conn = None
+        self._writer_executor = None
+        self._reader_executor = None
+        self._local = threading.local()
+
+    def _reader_conn(self) -> sqlite3.Connection:
+        # 第一次在這個執行緒上讀取時才建立連線，之後重複使用
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect(readonly=True)
+            self._local.conn = conn
+            with self._lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def _run_read(self, fn: Callable, args: tuple):
+        return fn(self._reader_conn(), *args)
+
+    def _run_write(self, fn: Callable, args: tuple):
+        conn = self._writer_conn
+        try:
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+    async def read(self, fn: Callable[..., Any], *args):
+        """在讀取執行緒上執行 fn(conn, *args)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader_executor, self._run_read, fn, args)
+
+    async def write(self, fn: Callable[..., Any], *args):
+        """在寫入執行緒上執行 fn(conn, *args)，成功就 commit，失敗就 rollback"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer_executor, self._run_write, fn, args)
+
+    # --- 常用的簡易介面 ---
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """執行一筆寫入，回傳 lastrowid"""
+        return await self.write(lambda conn: conn.execute(sql, params).lastrowid)
@@ -0,0 +1,184 @@
+# history_cache.py
+# 最近訊息的記憶體環形緩衝區：連線時的歷史訊息不必再查資料庫
+import asyncio
+from bisect import bisect_left, bisect_right, insort
+from collections import deque, OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+from wire import Frame
+
+
+class HistoryCache:
+    """
+    依 id 排序保存最近 capacity 則「未刪除」的訊息
+    floor_id 以上 (含) 的未刪除訊息保證都在緩衝區裡，更舊的就要回資料庫查
+    """
+    def __init__(self, capacity: int = 1000, snapshot_size: int = 300, delete_log_size: int = 1000):
+        self.capacity = capacity
+        self.snapshot_size = snapshot_size
+        self._ids: List[int] = []
+        self._messages: Dict[int, dict] = {}
+        self.floor_id = 0
+        # 目前看過最新的訊息 id
+        self.last_id = 0
+        # 刪除紀錄 (刪除當下最新的訊息 id, 被刪除的 id)，給斷線重連的差異同步用
+        self._deleted = deque(maxlen=delete_log_size)
+        # 比這個 id 更早的刪除紀錄已經不完整 (被擠掉或是伺服器重啟前發生的)
+        self.deleted_floor = 0
+        # 預先序列化好的 history 訊框 (每種格式各編碼一次)，直到下一次變動才重算
+        self._frame: Optional[Frame] = None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def load(self, messages: List[dict]):
+        """用資料庫撈出的最新訊息 (由舊到新) 填滿緩衝區 (lifespan 啟動時呼叫)"""
+        self._ids.clear()
+        self._messages.clear()
+        for msg in messages[-self.capacity:]:
+            self._ids.append(msg["id"])
+            self._messages[msg["id"]] = msg
+        # [修改] 撈不滿也不代表全部的訊息都在這裡 (更舊的可能已經搬進封存區段)，
+        # 所以緩衝區只保證涵蓋到最舊的這一則
+        self.floor_id = self._ids[0] if self._ids else 0
+        self.last_id = self._ids[-1] if self._ids else 0
+        # 重啟前發生的刪除我們不知道，比現在更早的客戶端都要拿完整快照
+        self._deleted.clear()
+        self.deleted_floor = self.last_id
+        self._frame = None
+
+    def add(self, msg: dict):
+        """新增一則剛寫入資料庫的訊息"""
+        message_id = msg["id"]
+        if message_id < self.floor_id or message_id in self._messages:
+            return
+        insort(self._ids, message_id)
+        self._messages[message_id] = msg
+        self.last_id = max(self.last_id, message_id)
+        # 超過容量就把最舊的丟掉，floor 跟著往上移
+        while len(self._ids) > self.capacity:
+            oldest = self._ids.pop(0)
+            del self._messages[oldest]
+            self.floor_id = oldest + 1
+        self._frame = None
+
+    def remove(self, message_id: int):
+        """訊息被刪除 (is_deleted = 1) 時從緩衝區移除"""
+        # 不論是否在緩衝區內都要記錄，重連的客戶端手上可能還有這則訊息
+        if len(self._deleted) == self._deleted.maxlen:
+            self.deleted_floor = max(self.deleted_floor, self._deleted[0][0])
+        self._deleted.append((self.last_id, message_id))
+        if self._messages.pop(message_id, None) is None:
+            return
+        index = bisect_left(self._ids, message_id)
+        del self._ids[index]
+        self._frame = None
+
+    def recent(self, limit: int, skip: int = 0) -> Optional[List[dict]]:
+        """相當於 ORDER BY id DESC LIMIT limit OFFSET skip (由舊到新回傳)，緩衝區不夠時回傳 None"""
+        end = len(self._ids) - skip
+        if end - limit < 0:
+            return None
+        start = max(end - limit, 0)
+        return [self._messages[i] for i in self._ids[start:max(end, 0)]]
+
+    def page_before(self, before_id: int, limit: int) -> Optional[List[dict]]:
+        """取得 before_id 之前的 limit 則訊息 (由舊到新)，緩衝區不夠時回傳 None"""
+        end = bisect_left(self._ids, before_id)
+        if end - limit < 0:
+            return None
+        start = max(end - limit, 0)
+        return [self._messages[i] for i in self._ids[start:end]]
+
+    def delta_since(self, last_id: int) -> Optional[dict]:
+        """
+        斷線重連的差異同步：last_id 之後的新訊息 + 期間被刪除的 id
+        缺口太大或資料不完整時回傳 None，呼叫端改送完整快照
+        """
+        if last_id <= self.deleted_floor or last_id > self.last_id:
+            return None
+        # 緩衝區沒有涵蓋到 last_id 之後的全部訊息
+        if last_id + 1 < self.floor_id:
+            return None
+        start = bisect_right(self._ids, last_id)
+        if len(self._ids) - start > self.snapshot_size:
+            return None
+        # 刪除當下最新 id 比 last_id 小的，客戶端當時還在線上，已經收過 delete 廣播
+        deleted = [message_id for mark, message_id in self._deleted if mark >= last_id]
+        return {
+            "type": "history_delta",
+            "messages": [self._messages[i] for i in self._ids[start:]],
+            "deleted": deleted
+        }
+
+    def history_frame(self) -> Frame:
+        """連線時要送出的 history 訊框 (編碼結果會快取在 Frame 裡)"""
+        if self._frame is None:
+            # 緩衝區容量大於 snapshot_size，直接取最後一段即可
+            snapshot = [self._messages[i] for i in self._ids[-self.snapshot_size:]]
+            self._frame = Frame({"type": "history", "messages": snapshot})
+        return self._frame
+
+
+class RoomHistories:
+    """
+    每個聊天室各一個 HistoryCache，第一次用到時才從資料庫載入
+    最多保留 max_rooms 個 (LRU)，被擠掉的聊天室下次用到時重新載入
+    """
+    def __init__(self, max_rooms: int = 100, **cache_options):
+        self.max_rooms = max_rooms
+        self.cache_options = cache_options
+        self._caches: "OrderedDict[str, HistoryCache]" = OrderedDict()
+        # 載入中的聊天室：同時多個人進同一個聊天室只查一次資料庫
+        self._loading: Dict[str, asyncio.Future] = {}
+        # 載入期間發生的新增/刪除，載入完再補上，避免漏掉
+        self._pending: Dict[str, list] = {}
+
+    def __len__(self):
+        return sum(len(cache) for cache in self._caches.values())
+
+    def get(self, room: str) -> Optional[HistoryCache]:
+        """已經載入的話回傳該聊天室的緩衝區，沒有就回傳 None (不會查資料庫)"""
+        cache = self._caches.get(room)
+        if cache is not None:
+            self._caches.move_to_end(room)
+        return cache
+
+    async def load(self, room: str, loader: Callable[[str, int], Awaitable[List[dict]]]) -> HistoryCache:
+        """取得該聊天室的緩衝區，還沒載入就用 loader(room, 筆數) 從資料庫撈"""
+        cache = self.get(room)
+        if cache is not None:
+            return cache
+        future = self._loading.get(room)
+        if future is None:
+            future = self._loading[room] = asyncio.ensure_future(self._load(room, loader))
+        return await asyncio.shield(future)
+
+    async def _load(self, room: str, loader) -> HistoryCache:
+        self._pending[room] = []
+        try:
+            cache = HistoryCache(**self.cache_options)
+            cache.load(await loader(room, cache.capacity))
+            for method, arg in self._pending[room]:
+                getattr(cache, method)(arg)
+            self._caches[room] = cache
+            while len(self._caches) > self.max_rooms:
+                self._caches.popitem(last=False)
+            return cache
+        finally:
+            self._pending.pop(room, None)
+            self._loading.pop(room, None)
+
+    def add(self, room: str, msg: dict):
+        """新增一則剛寫入資料庫的訊息 (聊天室還沒載入就不用管，載入時會從資料庫撈到)"""
+        if room in self._pending:
+            self._pending[room].append(("add", msg))
+        cache = self._caches.get(room)
+        if cache is not None:
+            cache.add(msg)
+
+    def remove(self, room: str, message_id: int):
+        if room in self._pending:
+            self._pending[room].append(("remove", message_id))
+        cache = self._caches.get(room)
+        if cache is not None:
+            cache.remove(message_id)
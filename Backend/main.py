@@ -4,42 +4,213 @@ import json
 import sqlite3
 import os
 import re
-import uuid # 用來產生唯一檔名
 import asyncio
+import time
+import secrets
+from collections import deque, OrderedDict
 from datetime import datetime, timedelta
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, HTTPException, status, Header, File, UploadFile,Depends
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, HTTPException, status, Header, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles # 用來提供靜態檔案存取
+from fastapi.responses import PlainTextResponse, Response
+from static_media import MediaStaticFiles # 用來提供靜態檔案存取 (含長期快取、Range、預先壓縮)
 from fastapi.concurrency import run_in_threadpool
 from contextlib import asynccontextmanager
 from typing import Dict, List, Optional
 from pydantic import BaseModel, Field
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 from dotenv import load_dotenv
+from database import Database
+from history_cache import RoomHistories
+from backplane import create_backplane
+from password_pool import PasswordPool, PasswordPoolBusy
+from uploads import (UploadError, receive_upload, size_limit_message, precompress,
+                     create_session_file, write_chunk, file_sha256)
+from media import MediaPreviews
+from wire import Frame, negotiate
+from rate_limit import FloodControl
+from metrics import Registry
+from search import register_sql_functions, create_search_index, backfill_search_index, build_match_query
+from retention import (create_retention_schema, enable_incremental_vacuum, purge_deleted, purge_system_messages,
+                       archive_segment, read_archive, remove_archived, incremental_vacuum)
+from user_directory import UserDirectory
+from presence import PresenceDiff, merge_presence_updates
+from upload_sessions import (create_upload_schema, create_session, get_session, begin_chunk, end_chunk,
+                             claim_session, release_session, active_writers, missing_chunks, delete_session,
+                             expired_sessions)
 
 DB_NAME = "Database.db"
+# [新增] 讀取連線數量 (WAL 模式下可以多條連線同時讀)
+DB_READERS = 4
+# [新增] 背景寫入工兵一次最多合併寫入幾筆訊息 (group commit)
+WRITE_BATCH_SIZE = 200
+# [新增] 等待寫入的訊息佇列上限
+# 滿了的時候：聊天訊息會等到有空位 (只卡住傳送者自己的接收迴圈)，加入/離開的系統訊息直接丟掉並計數
+MESSAGE_QUEUE_SIZE = 5000
+# 排隊數量超過這個值就在 log 提醒 (寫入跟不上)
+MESSAGE_QUEUE_WARN_DEPTH = 1000
+# 關機時最多等幾秒把佇列寫完，寫不完 (例如資料庫被鎖住) 的就存到 PENDING_MESSAGES_FILE，下次啟動再補寫
+SHUTDOWN_DRAIN_TIMEOUT = 10
+PENDING_MESSAGES_FILE = "pending_messages.jsonl"
+# [新增] 記憶體裡保留最近幾則訊息 (要大於連線時送出的 300 則)
+HISTORY_CACHE_SIZE = 1000
+HISTORY_SNAPSHOT_SIZE = 300
+# [新增] 聊天室：沒指定就進大廳；聊天室代號只允許英數字、底線、減號
+DEFAULT_ROOM = "lobby"
+ROOM_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+ROOM_CLOSE_CODE = 4005
+# 記憶體裡最多保留幾個聊天室的最近訊息 (LRU，每個聊天室最多 HISTORY_CACHE_SIZE 則)
+HISTORY_CACHE_ROOMS = 100
+# [新增] 搜尋結果每頁最多幾筆
+SEARCH_MAX_LIMIT = 100
+# [新增] /users/page 每頁最多幾位
+USERS_PAGE_MAX_LIMIT = 200
+
+# [新增] 每條連線的送出佇列上限，以及塞滿時的處理方式
+# "drop_oldest": 丟掉最舊的訊息 / "coalesce": 先合併同類型的更新 (上線/離線差異)，不行再丟最舊的 / "disconnect": 直接斷線
+# [修改] 兩種會丟訊息的策略都只丟一般訊息；最舊的是狀態訊框的話一樣斷線 (客戶端重連時會重新同步)
+SEND_QUEUE_SIZE = 256
+SLOW_CONSUMER_POLICY = "coalesce"
+SLOW_CONSUMER_CLOSE_CODE = 4002
+# [修改] 還沒送出的可以跟新的合併成一筆的訊息類型 (成員名單只在連線時送一次，不需要合併)
+COALESCE_TYPES = {"presence_update"}
+# [新增] 丟掉之後客戶端的狀態就再也對不上的訊息類型 (歷史訊息、成員名單與它的差異、刪除)
+STATE_FRAME_TYPES = {"history", "history_delta", "member_list_update", "presence_update", "delete"}
+# [新增] 帶有訊息 id 的廣播類型 (連線時的歷史訊息已經包含的就不再送)
+MESSAGE_FRAME_TYPES = {"chat", "system", "image", "file", "video"}
 
 # --- JWT 設定 ---
 load_dotenv()
 SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# [新增] 已驗證過的 Token 最多快取幾個 (LRU)
+TOKEN_CACHE_SIZE = 4096
+
+# --- [新增] 多 worker 設定 ---
+# "local": 單一行程 (預設) / "sqlite": 用共用的 SQLite 事件表讓 uvicorn --workers N 互相廣播
+BACKPLANE = os.getenv("CHAT_BACKPLANE", "local")
+BACKPLANE_DB = "Backplane.db"
+# 每個 worker 多久廣播一次自己的線上名單，超過 PRESENCE_TTL 沒更新就視為該 worker 已離線
+PRESENCE_INTERVAL = 10
+PRESENCE_TTL = 30
+# [新增] 上線/離線的差異在這段時間內合併成一個 presence_update 再廣播 (秒)
+PRESENCE_COALESCE_WINDOW = 0.5
+
+# [新增] 洗版防護 (token bucket)：每位使用者每秒 FLOOD_USER_RATE 則，最多連發 FLOOD_USER_BURST 則
+# 整個聊天室 (每個 worker) 每秒 FLOOD_GLOBAL_RATE 則；超過自己的額度連續被擋 FLOOD_MAX_STRIKES 次以上就斷線 (整個聊天室滿了不算)
+# 可以用環境變數調整 (例如壓力測試時放寬)
+FLOOD_USER_RATE = float(os.getenv("CHAT_FLOOD_USER_RATE", "3"))
+FLOOD_USER_BURST = float(os.getenv("CHAT_FLOOD_USER_BURST", "10"))
+FLOOD_GLOBAL_RATE = float(os.getenv("CHAT_FLOOD_GLOBAL_RATE", "200"))
+FLOOD_GLOBAL_BURST = float(os.getenv("CHAT_FLOOD_GLOBAL_BURST", "400"))
+FLOOD_MAX_STRIKES = 20
+FLOOD_CLOSE_CODE = 4004
+
+# [新增] 心跳
+# - 所有連線：WebSocket 協定層的 ping/pong (由 uvicorn 處理，--ws-ping-interval / --ws-ping-timeout)，
+#   舊版或只看不說話的客戶端也會自動回應，不必改前端
+# - 連線時帶 heartbeat=1 的客戶端 (會回 pong 的新版前端)：另外在閒置超過 HEARTBEAT_INTERVAL 秒時送 {"type":"ping"}，
+#   超過 HEARTBEAT_TIMEOUT 秒都沒收到任何訊框 (含 pong) 就回收 (有些代理會自己回協定層的 pong)
+# 全部連線共用一個計時任務；送出失敗的連線 (不論有沒有開 heartbeat) 會立刻叫醒它回收，不必等到下一輪
+HEARTBEAT_INTERVAL = float(os.getenv("CHAT_HEARTBEAT_INTERVAL", "15"))
+HEARTBEAT_TIMEOUT = float(os.getenv("CHAT_HEARTBEAT_TIMEOUT", "45"))
+HEARTBEAT_CLOSE_CODE = 4006
+# 客戶端回覆的 pong (前端 JSON.stringify({ type: 'pong' }) 的結果)，不算洗版也不存檔
+PONG_MESSAGE = '{"type":"pong"}'
+
+# [新增] 訊息保留政策 (背景工作每 RETENTION_INTERVAL 秒跑一次，CHAT_RETENTION=0 可關閉)
+# - 已軟刪除的訊息：直接真正刪除
+# - 加入/離開的系統訊息：超過 SYSTEM_MESSAGE_RETENTION_DAYS 天就刪除 (0 = 永久保留)
+# - 超過 ARCHIVE_AFTER_DAYS 天的訊息：壓縮成封存區段 (每段最多 ARCHIVE_SEGMENT_SIZE 則)，/history/more 仍可翻到 (0 = 不封存)
+# 每批最多 RETENTION_BATCH_SIZE 筆，批次之間暫停 RETENTION_BATCH_PAUSE 秒讓聊天訊息先寫
+RETENTION_ENABLED = os.getenv("CHAT_RETENTION", "1") != "0"
+RETENTION_START_DELAY = 60
+RETENTION_INTERVAL = float(os.getenv("CHAT_RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH_SIZE = 500
+RETENTION_BATCH_PAUSE = 0.05
+SYSTEM_MESSAGE_RETENTION_DAYS = float(os.getenv("CHAT_SYSTEM_RETENTION_DAYS", "7"))
+ARCHIVE_AFTER_DAYS = float(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_SEGMENT_SIZE = 500
+# 每次最多歸還幾個空頁面給檔案系統 (預設頁面 4KB)
+VACUUM_PAGES_PER_STEP = 256
+# 舊的資料庫要整個 VACUUM 一次才能逐步歸還空間，期間資料庫被鎖住，所以預設不做
+# 停機維護時設 CHAT_VACUUM_MIGRATE=1 啟動一次即可 (之後就不需要了)
+VACUUM_MIGRATE = os.getenv("CHAT_VACUUM_MIGRATE", "0") == "1"
 
 # --- 定義檔案上傳目錄、最大檔案大小、最大訊息長度 ---
 UPLOAD_DIR = "static/uploads"
+# [新增] 上傳中的暫存檔放這裡 (不在 /static 底下，收完才搬進 UPLOAD_DIR)
+UPLOAD_TMP_DIR = "upload_tmp"
 MAX_FILE_SIZE = 5 * 1024 * 1024 # 5MB
+# [新增] 可續傳的分段上傳 (POST /uploads)：影片與壓縮檔最大 MAX_LARGE_FILE_SIZE，其他類型一樣是 MAX_FILE_SIZE
+LARGE_FILE_EXTENSIONS = {"mp4", "webm", "zip", "rar"}
+MAX_LARGE_FILE_SIZE = 200 * 1024 * 1024 # 200MB
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # 每段 1MB
+# 同時進行中的分段上傳上限 (全部 / 每位使用者)；超過 UPLOAD_SESSION_TTL 秒沒有動靜的上傳會被清掉 (每 UPLOAD_GC_INTERVAL 秒檢查一次)
+MAX_UPLOAD_SESSIONS = 100
+MAX_UPLOAD_SESSIONS_PER_USER = 3
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+UPLOAD_GC_INTERVAL = 60 * 60
+# 完成上傳時最多等還在寫的分段幾秒；登記超過 UPLOAD_WRITER_STALE 秒還沒結束的分段當作 worker 已經當掉
+UPLOAD_COMPLETE_WAIT = 30
+UPLOAD_WRITER_STALE = 10 * 60
+# /upload 收到一半當掉留下的 .part 暫存檔，超過這個秒數就清掉
+UPLOAD_PART_TTL = 60 * 60
 MAX_MSG_LENGTH = 500
-if not os.path.exists(UPLOAD_DIR):
-    os.makedirs(UPLOAD_DIR)
-
-# [新增] 密碼雜湊器 (用來把密碼加密，不要存明碼！)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# [新增] 圖片縮圖 / 影片封面的存放位置與最長邊 (像素)
+THUMBNAIL_DIR = "static/uploads/thumbs"
+THUMBNAIL_MAX_SIDE = 480
+PREVIEW_WORKERS = 1
+# 廣播圖片/影片前，最多等縮圖幾秒 (等不到就先送原檔)
+PREVIEW_WAIT_SECONDS = 1.5
+# [新增] 這些類型壓縮效果不錯，上傳後順便產生 .gz 版本 (圖片、影片、zip 本身已經壓縮過了)
+PRECOMPRESS_EXTENSIONS = {"pdf", "doc"}
+# 允許的副檔名類型
+ALLOWED_EXTENSIONS = ["jpg", "jpeg", "png", "gif", "pdf", "doc", "docx", "zip", "rar","mp4", "webm", "heic"]
+for directory in (UPLOAD_DIR, UPLOAD_TMP_DIR):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+# [修改] 密碼雜湊改在獨立的行程池裡做 (bcrypt 會卡住 event loop)
+# 同時最多 PASSWORD_WORKERS 個在算，最多再排 PASSWORD_QUEUE_LIMIT 個，超過就直接回 503
+PASSWORD_WORKERS = 2
+PASSWORD_QUEUE_LIMIT = 32
+password_pool = PasswordPool(workers=PASSWORD_WORKERS, queue_limit=PASSWORD_QUEUE_LIMIT)
+
+# --- [新增] 監控指標 (GET /metrics，Prometheus 文字格式) ---
+# 熱路徑上只做加法；連線數、佇列深度這類數字在抓取時才計算
+metrics = Registry()
+FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+broadcast_seconds = metrics.histogram("chat_broadcast_seconds", "把一則廣播放進本機所有連線送出佇列的耗時", buckets=FAST_BUCKETS)
+broadcast_deliveries = metrics.counter("chat_broadcast_deliveries_total", "廣播送達的連線數 (fan-out) 累計")
+slow_consumer_disconnects = metrics.counter("chat_slow_consumer_disconnects_total", "因為送出佇列塞滿而斷線的次數")
+reaped_connections = metrics.counter("chat_reaped_connections_total", "心跳逾時或送出失敗而被回收的連線數", ["reason"])
+save_message_seconds = metrics.histogram("chat_save_message_seconds", "save_message 從排隊到拿到 id 的耗時")
+db_write_batch_seconds = metrics.histogram("chat_db_write_batch_seconds", "背景寫入一批訊息的耗時")
+db_write_batch_size = metrics.histogram("chat_db_write_batch_size", "背景寫入每批的訊息數", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+history_query_seconds = metrics.histogram("chat_history_query_seconds", "歷史訊息/搜尋查詢資料庫的耗時", ["query"])
+retention_run_seconds = metrics.histogram("chat_retention_run_seconds", "一次訊息保留工作的總耗時",
+                                          buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
+password_seconds = metrics.histogram("chat_password_seconds", "bcrypt 雜湊/驗證的耗時 (含排隊)", ["op"],
+                                     buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+upload_seconds = metrics.histogram("chat_upload_seconds", "/upload 的耗時")
+uploads_total = metrics.counter("chat_uploads_total", "上傳次數 (依結果分類)", ["result"])
+upload_bytes = metrics.counter("chat_upload_bytes_total", "實際收到的上傳檔案大小累計 (bytes)")
+upload_sessions_total = metrics.counter("chat_upload_sessions_total", "分段上傳的事件數", ["event"])
 
 def init_db():
     """初始化資料庫"""
 
     conn = sqlite3.connect(DB_NAME)
+    register_sql_functions(conn)
+    # [新增] 開啟 incremental vacuum (必須在建立資料表之前；舊資料庫要設 CHAT_VACUUM_MIGRATE=1 才會 VACUUM)
+    started = time.perf_counter()
+    vacuum_state = enable_incremental_vacuum(conn, VACUUM_MIGRATE)
+    if vacuum_state == "vacuumed":
+        print(f"資料庫已轉換為 incremental vacuum 模式 (VACUUM 花了 {time.perf_counter() - started:.1f} 秒)")
+    elif vacuum_state == "needs_vacuum":
+        print("資料庫還不是 incremental vacuum 模式，清掉的空間不會還給檔案系統；"
+              "停機維護時設 CHAT_VACUUM_MIGRATE=1 啟動一次即可轉換 (會整個 VACUUM，期間資料庫被鎖住)")
     c = conn.cursor()
 
     # 1. 先開啟 WAL 模式
@@ -53,7 +224,13 @@ def init_db():
                   msg_type TEXT,
                   timestamp TEXT,
                   filename TEXT,
-                  is_deleted INTEGER DEFAULT 0)''') # <--- 直接加在這裡
+                  is_deleted INTEGER DEFAULT 0,
+                  room_id TEXT NOT NULL DEFAULT 'lobby')''') # <--- 直接加在這裡
+
+    # [新增] 舊資料庫沒有 room_id 欄位：補上，原本的訊息都歸到大廳
+    columns = [row[1] for row in c.execute("PRAGMA table_info(messages)")]
+    if "room_id" not in columns:
+        c.execute(f"ALTER TABLE messages ADD COLUMN room_id TEXT NOT NULL DEFAULT '{DEFAULT_ROOM}'")
     
     # [新增] 建立使用者表 (username 是主鍵，不可重複)
     # 注意：password_hash 存的是加密後的字串，不是明碼
@@ -61,17 +238,83 @@ def init_db():
                  (username TEXT PRIMARY KEY,
                   password_hash TEXT)''')
 
+    # [新增] 上傳檔案的索引：以內容的 SHA-256 當主鍵，同樣的檔案只存一份
+    c.execute('''CREATE TABLE IF NOT EXISTS uploads
+                 (hash TEXT PRIMARY KEY,
+                  size INTEGER,
+                  extension TEXT,
+                  created TEXT)''')
+
+    # [新增] 進行中的分段上傳、每個上傳已經收到哪幾段、正在寫的分段 (多個 worker 共用同一份狀態)
+    create_upload_schema(c)
+
+    # [新增] 縮圖索引 (以原檔的內容雜湊值為 key)
+    c.execute('''CREATE TABLE IF NOT EXISTS media_previews
+                 (hash TEXT PRIMARY KEY,
+                  thumbnail TEXT,
+                  width INTEGER,
+                  height INTEGER,
+                  thumb_width INTEGER,
+                  thumb_height INTEGER)''')
+
+    # [修改] 只收錄未刪除訊息的部分索引，依聊天室分開，讓 /history/more 用 id 游標翻頁時不必掃過已跳過的資料
+    # (取代原本不分聊天室的 idx_messages_visible_id)
+    c.execute("DROP INDEX IF EXISTS idx_messages_visible_id")
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_messages_room_visible_id
+                 ON messages (room_id, id) WHERE is_deleted = 0''')
+
+    # [新增] 全文搜尋索引 (FTS5)，由觸發器跟著新增/刪除同步；第一次建立時把既有訊息補進去
+    if create_search_index(c):
+        backfill_search_index(c)
+
+    # [新增] 封存表與清理用的索引
+    create_retention_schema(c)
+
     conn.commit()
     conn.close()
 
+# [新增] 共用的資料庫存取層 (長駐連線 + 專屬執行緒池)
+db = Database(DB_NAME, readers=DB_READERS, on_connect=register_sql_functions)
+
+# [新增] 圖片縮圖 / 影片封面 (背景行程池產生，查詢走記憶體)
+media_previews = MediaPreviews(UPLOAD_DIR, THUMBNAIL_DIR, "/static/uploads",
+                               workers=PREVIEW_WORKERS, max_side=THUMBNAIL_MAX_SIDE)
+
+async def save_preview(content_hash, preview):
+    """縮圖產生完成後寫進資料庫，重啟後不必重算"""
+    await db.execute(
+        "INSERT OR REPLACE INTO media_previews (hash, thumbnail, width, height, thumb_width, thumb_height) VALUES (?, ?, ?, ?, ?, ?)",
+        (content_hash, preview["thumbnail"], preview["width"], preview["height"],
+         preview["thumb_width"], preview["thumb_height"]))
+
+media_previews.on_ready = save_preview
+
+# [新增] 最近訊息的記憶體緩衝區 (連線時的歷史訊息直接從這裡拿)
+room_histories = RoomHistories(max_rooms=HISTORY_CACHE_ROOMS,
+                               capacity=HISTORY_CACHE_SIZE, snapshot_size=HISTORY_SNAPSHOT_SIZE)
+# [新增] 所有已註冊帳號的記憶體名冊 (啟動時載入，註冊時更新)
+user_directory = UserDirectory()
+
 # --- 認證相關函式 ---
+# [新增] 行程池塞滿時，直接請前端稍後再試
+def password_pool_busy():
+    return HTTPException(status_code=503, detail="伺服器忙碌中，請稍後再試", headers={"Retry-After": "1"})
+
 # [新增] 驗證密碼是否正確
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    try:
+        with password_seconds.labels("verify").time():
+            return await password_pool.verify(plain_password, hashed_password)
+    except PasswordPoolBusy:
+        raise password_pool_busy()
 
 # [新增] 將密碼加密
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    try:
+        with password_seconds.labels("hash").time():
+            return await password_pool.hash(password)
+    except PasswordPoolBusy:
+        raise password_pool_busy()
 
 # [新增] 產生 JWT Token
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -86,16 +329,72 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+class TokenCache:
+    """[新增] 已驗證過的 Token 快取：到 Token 的 exp 就失效，數量超過上限時淘汰最久沒用的"""
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        # token: (username, exp 的 unix 時間)
+        self._entries: OrderedDict = OrderedDict()
+        # 統計數據 (驗證耗時只計算沒命中快取、真的去解 JWT 的情況)
+        self.hits = 0
+        self.misses = 0
+        self.decode_seconds = 0.0
+
+    def get(self, token: str) -> Optional[str]:
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        username, exp = entry
+        if time.time() >= exp:
+            del self._entries[token]
+            return None
+        self._entries.move_to_end(token)
+        return username
+
+    def put(self, token: str, username: str, exp: float):
+        self._entries[token] = (username, exp)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+token_cache = TokenCache()
+
 # [新增] 從 Token 解析出使用者 (用於 WebSocket 驗證)
 def get_current_user_from_token(token: str):
+    # [新增] 先查快取，同一個 Token 不必每次重算 HMAC 與解析 JSON
+    username = token_cache.get(token)
+    if username is not None:
+        token_cache.hits += 1
+        return username
+
+    token_cache.misses += 1
+    started_at = time.perf_counter()
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             return None
+        # 沒有 exp 的 Token 不快取
+        if payload.get("exp") is not None:
+            token_cache.put(token, username, payload["exp"])
         return username
     except JWTError:
         return None
+    finally:
+        token_cache.decode_seconds += time.perf_counter() - started_at
+
+# [新增] 共用的驗證元件：從 Authorization header 取出使用者，給需要登入的 API 用 Depends 注入
+async def get_current_user(authorization: str = Header(None)) -> str:
+    # 1. 驗證 Token 是否存在
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="未登入或 Token 無效")
+
+    token = authorization.split(" ")[1]
+    username = get_current_user_from_token(token)
+
+    if not username:
+        raise HTTPException(status_code=401, detail="Token 無效或過期")
+    return username
 
 # [新增] 定義註冊/登入的資料格式
 class UserAuth(BaseModel):
@@ -114,160 +413,871 @@ class ChangePasswordRequest(BaseModel):
     new_password: str
     confirm_new_password: str
 
+# [新增] 建立分段上傳用的資料模型
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: int
+    sha256: Optional[str] = None  # 前端有先算好的話，完成時會比對
+
 class Token(BaseModel):
     access_token: str
     token_type: str
     username: str
 
-def save_message(nickname, message, timestamp, msg_type="text", filename=None):
+def insert_messages(conn, rows):
+    """一次寫入多筆訊息 (同一個 transaction)，依序回傳每筆的 id"""
+    conn.executemany(
+        "INSERT INTO messages (nickname, message, msg_type, timestamp, filename, room_id) VALUES (?, ?, ?, ?, ?, ?)",
+        rows)
+    # 只有一條寫入連線且整批在同一個 transaction 內，AUTOINCREMENT 的 id 一定是連號
+    last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    first_id = last_id - len(rows) + 1
+    return list(range(first_id, last_id + 1))
+
+def delete_message_row(conn, message_id, username):
+    """
+    [新增] 刪除 username 自己的訊息 (還在資料表裡就標記 is_deleted，已經封存的就從封存區段移除)
+    回傳 (發送者, 聊天室)，找不到回傳 None；發送者不是 username 的不會刪
+    在寫入執行緒上一次做完，中間不會被封存任務搬走
+    """
+    row = conn.execute("SELECT nickname, room_id FROM messages WHERE id = ?", (message_id,)).fetchone()
+    if row is None:
+        return remove_archived(conn, message_id, username)
+    if row[0] == username:
+        conn.execute("UPDATE messages SET is_deleted = 1 WHERE id = ?", (message_id,))
+    return row[0], row[1]
+
+def queue_row(task):
+    """佇列裡的順序是 (nickname, message, timestamp, msg_type, filename, room, future)，換成 INSERT 的欄位順序"""
+    return (task[0], task[1], task[3], task[2], task[4], task[5])
+
+async def save_message(nickname, message, timestamp, msg_type="text", filename=None, room=DEFAULT_ROOM):
     """儲存訊息 (支援文字與圖片)"""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    # [修改] 插入時多存一個 msg_type
-    c.execute("INSERT INTO messages (nickname, message, msg_type, timestamp, filename) VALUES (?, ?, ?, ?, ?)",
-              (nickname, message, msg_type, timestamp, filename))
-    message_id = c.lastrowid 
-    conn.commit()
-    conn.close()
+    # [修改] 交給背景寫入工兵批次寫入，透過 future 拿回這筆訊息的 id
+    future = asyncio.get_running_loop().create_future()
+    # [修改] 佇列滿了就在這裡等空位 (背壓只會影響這位傳送者)
+    with save_message_seconds.time():
+        await message_queue.put((nickname, message, timestamp, msg_type, filename, room, future))
+        message_id = await future
     return message_id  # <== 回傳給上層
 
-def get_recent_messages(limit=300, skip=0):
-    """取得最近的歷史訊息"""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+def format_message_row(row):
+    """將資料轉為字典格式 (欄位順序：nickname, message, msg_type, timestamp, id, is_deleted, filename)"""
+    msg_data = {
+        "nickname": row[0],
+        "type": row[2],
+        "time": row[3],
+        "id": row[4],
+        "is_deleted": bool(row[5]), # [修正] index 5 才是 is_deleted
+        "filename": row[6] if row[6] else None # [修正] index 6 才是 filename
+    }
+
+    # [修正重點] 這裡要同時允許 'text' 和 'system' 顯示 message 內容
+    if row[2] in ["text", "system"]:
+        msg_data["message"] = row[1]
+
+    # 處理多媒體類型
+    elif row[2] in ["image", "file", "video"]:
+        msg_data["imageData"] = row[1] # 資料庫設計時把 URL 存在 message 欄位
 
+        # 確保檔案和影片有預設檔名
+        if row[2] == "file" and not msg_data["filename"]:
+            msg_data["filename"] = "附件"
+        elif row[2] == "video" and not msg_data["filename"]:
+            msg_data["filename"] = "影片"
+
+        # [新增] 有縮圖的話一併附上 (前端先顯示縮圖，放大時才載入原檔)
+        preview = media_previews.lookup(row[1])
+        if preview:
+            msg_data.update(preview)
+
+    return msg_data
+
+async def get_recent_messages(limit=300, skip=0, room=DEFAULT_ROOM):
+    """取得某個聊天室最近的歷史訊息"""
     # [修改] SQL 語法加入 OFFSET
     # 意思：抓最新的資料，但是跳過前 skip 筆，再抓 limit 筆
-    c.execute("""
-    SELECT nickname, message, msg_type, timestamp, id, is_deleted, filename
-    FROM messages
-    WHERE is_deleted = 0
-    ORDER BY id DESC
-    LIMIT ? OFFSET ?
-    """, (limit, skip))
-
-    rows = c.fetchall()
-    conn.close()
+    with history_query_seconds.labels("recent").time():
+        rows = await db.fetchall("""
+        SELECT nickname, message, msg_type, timestamp, id, is_deleted, filename
+        FROM messages
+        WHERE room_id = ? AND is_deleted = 0
+        ORDER BY id DESC
+        LIMIT ? OFFSET ?
+        """, (room, limit, skip))
     
-    # 將資料轉為字典格式
-    history = []
-    for row in rows:
-        msg_data = {
-            "nickname": row[0],
-            "type": row[2],
-            "time": row[3],
-            "id": row[4],
-            "is_deleted": bool(row[5]), # [修正] index 5 才是 is_deleted
-            "filename": row[6] if row[6] else None # [修正] index 6 才是 filename
-        }
-        
-        # [修正重點] 這裡要同時允許 'text' 和 'system' 顯示 message 內容
-        if row[2] in ["text", "system"]:
-            msg_data["message"] = row[1]
-
-        # 處理多媒體類型
-        elif row[2] in ["image", "file", "video"]:
-            msg_data["imageData"] = row[1] # 資料庫設計時把 URL 存在 message 欄位
-            
-            # 確保檔案和影片有預設檔名
-            if row[2] == "file" and not msg_data["filename"]:
-                msg_data["filename"] = "附件"
-            elif row[2] == "video" and not msg_data["filename"]:
-                msg_data["filename"] = "影片"
-            
-        history.append(msg_data)
-
-    return history[::-1]
+    return [format_message_row(row) for row in rows][::-1]
+
+# [新增] 游標 (keyset) 分頁：只抓 id 比 before_id 小的訊息，不論翻到多深成本都一樣
+async def get_messages_before(before_id, limit=50, room=DEFAULT_ROOM):
+    """取得某個聊天室 before_id 之前的歷史訊息"""
+    with history_query_seconds.labels("before").time():
+        rows = await db.fetchall("""
+        SELECT nickname, message, msg_type, timestamp, id, is_deleted, filename
+        FROM messages
+        WHERE room_id = ? AND is_deleted = 0 AND id < ?
+        ORDER BY id DESC
+        LIMIT ?
+        """, (room, before_id, limit))
+    rows = rows[::-1]
+    # [新增] 資料表裡的翻完了，再往封存區段裡找
+    if len(rows) < limit:
+        with history_query_seconds.labels("archive").time():
+            archived = await db.read(read_archive, room, rows[0][4] if rows else before_id, limit - len(rows))
+        rows = archived + rows
+    return [format_message_row(row) for row in rows]
+
+async def load_room_history(room, limit):
+    """[新增] 給 RoomHistories 用的載入函式"""
+    return await get_recent_messages(limit, 0, room)
+
+# [新增] 全文搜尋：查 FTS5 索引再用 rowid 取回訊息，只會碰到符合的資料列
+# order="rank" 依相關度 (bm25) 排序，游標是 "分數:id"；order="recent" 依時間新到舊，游標是 id
+async def search_messages(match, limit=20, order="rank", cursor=None, room=None):
+    """回傳 (訊息列表, 下一頁游標)，room 為 None 時搜尋所有聊天室"""
+    columns = "m.nickname, m.message, m.msg_type, m.timestamp, m.id, m.is_deleted, m.filename, m.room_id"
+    room_filter = "AND m.room_id = ?" if room else ""
+    room_params = (room,) if room else ()
+    if order == "recent":
+        sql = f"""
+        SELECT {columns}, NULL FROM messages_fts f JOIN messages m ON m.id = f.rowid
+        WHERE messages_fts MATCH ? AND f.rowid < ? {room_filter}
+        ORDER BY f.rowid DESC
+        LIMIT ?
+        """
+        params = (match, cursor[1] if cursor else 2 ** 63 - 1, *room_params, limit)
+    else:
+        keyset = "AND (f.rank > ? OR (f.rank = ? AND f.rowid < ?))" if cursor else ""
+        sql = f"""
+        SELECT {columns}, f.rank FROM messages_fts f JOIN messages m ON m.id = f.rowid
+        WHERE messages_fts MATCH ? {keyset} {room_filter}
+        ORDER BY f.rank, f.rowid DESC
+        LIMIT ?
+        """
+        keyset_params = (cursor[0], cursor[0], cursor[1]) if cursor else ()
+        params = (match, *keyset_params, *room_params, limit)
+    with history_query_seconds.labels("search").time():
+        rows = await db.fetchall(sql, params)
+
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = str(last[4]) if order == "recent" else f"{last[8]!r}:{last[4]}"
+    # 搜尋結果可能來自不同聊天室，附上聊天室代號
+    return [{**format_message_row(row[:7]), "room": row[7]} for row in rows], next_cursor
+
+def check_room(room):
+    """[新增] 聊天室代號格式不對就回 400"""
+    if not ROOM_ID_PATTERN.match(room):
+        raise HTTPException(status_code=400, detail="無效的聊天室代號")
+    return room
+
+def parse_search_cursor(cursor, order):
+    """把游標字串拆回 (分數, id)，格式不對就回 400"""
+    if cursor is None:
+        return None
+    try:
+        if order == "recent":
+            return (None, int(cursor))
+        rank, last_id = cursor.rsplit(":", 1)
+        return (float(rank), int(last_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="無效的搜尋游標")
 
 # 伺服器啟動時，初始化資料庫
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     init_db()
+    # [新增] 開啟共用資料庫連線
+    db.open()
+    # [新增] 啟動密碼雜湊的行程池
+    password_pool.start()
+    # [新增] 啟動縮圖行程池，並載入已經產生過的縮圖 (歷史訊息要用)
+    media_previews.start()
+    for row in await db.fetchall("SELECT hash, thumbnail, width, height, thumb_width, thumb_height FROM media_previews"):
+        media_previews.load(row[0], {"thumbnail": row[1], "width": row[2], "height": row[3],
+                                     "thumb_width": row[4], "thumb_height": row[5]})
+    # [新增] 載入帳號名冊
+    user_directory.load(row[0] for row in await db.fetchall("SELECT username FROM users"))
+    # [新增] 先補寫上次關機時沒寫完的訊息
+    await replay_pending_messages()
+    # [新增] 啟動時先把大廳最近的訊息載入記憶體 (其他聊天室第一次有人進入時才載入)
+    await room_histories.load(DEFAULT_ROOM, load_room_history)
+    # [新增] 連上其他 worker
+    await backplane.start()
     # [新增] 啟動背景寫入任務
     writer_task = asyncio.create_task(db_writer_worker())
+    presence_task = asyncio.create_task(presence_worker())
+    heartbeat_task = asyncio.create_task(heartbeat_worker())
+    # [新增] 清理放棄的分段上傳
+    upload_gc_task = asyncio.create_task(upload_gc_worker())
+    # [新增] 訊息保留工作
+    retention_task = asyncio.create_task(retention_worker()) if RETENTION_ENABLED else None
     yield
+    presence_task.cancel()
+    heartbeat_task.cancel()
+    upload_gc_task.cancel()
+    if retention_task:
+        retention_task.cancel()
+        await asyncio.gather(retention_task, return_exceptions=True)
+    # [修改] 不直接取消寫入任務：送出停止訊號，等它把佇列裡剩下的訊息寫完
+    await drain_message_queue(writer_task)
+    await backplane.stop()
+    password_pool.shutdown()
+    media_previews.shutdown()
+    db.close()
+
+def coalesce_frames(pending: Frame, frame: Frame) -> Frame:
+    """[新增] 把還沒送出的 pending 跟新的 frame 合併成一個訊框 (Frame 是多條連線共用的，不能直接改)"""
+    if frame.payload.get("type") == "presence_update":
+        return Frame(merge_presence_updates(pending.payload, frame.payload))
+    return frame
+
+class ClientSender:
+    """單一連線的送出佇列 + 專屬寫入任務，慢的客戶端不會拖到其他人"""
+    def __init__(self, websocket: WebSocket, maxsize: int, policy: str, protocol: Optional[str] = None,
+                 on_failed=None, heartbeat: bool = False):
+        self.websocket = websocket
+        self.maxsize = maxsize
+        self.policy = policy
+        # [新增] 協商出來的傳輸格式 (None = JSON 文字訊框)
+        self.protocol = protocol
+        # 佇列內容是 [合併用的 key, Frame]
+        self._frames = deque()
+        self._wakeup = asyncio.Event()
+        self._close_code = None
+        self._close_reason = ""
+        self.closed = False
+        # [新增] 心跳用：客戶端是否會回 pong、最後一次收到這條連線的訊框、最後一次送 ping 的時間
+        self.heartbeat = heartbeat
+        self.last_seen = self.last_ping = time.monotonic()
+        # [新增] 連線時送出的歷史訊息涵蓋到的最新 id：訊息先進記憶體緩衝區才廣播，
+        # 中間連線的客戶端會在歷史訊息裡拿到它，之後的廣播就要跳過，不然會收到兩次
+        self.history_last_id = 0
+        # [新增] 送出失敗時呼叫 on_failed(websocket)，讓連線管理器馬上回收
+        self.on_failed = on_failed
+        self.task = asyncio.create_task(self._run())
+
+    def pending(self) -> int:
+        """還沒送出的訊框數"""
+        return len(self._frames)
+
+    def push(self, frame: Frame, key: Optional[str] = None) -> bool:
+        """放入一筆要送出的訊息，回傳 False 代表佇列已滿且策略是斷線"""
+        if self.closed:
+            return True
+        if key is not None and self.policy == "coalesce":
+            # [修改] 跟還沒送出的同類型更新合併 (從最新的往回找，跨過其他狀態訊框就不能再合併，否則順序會亂)
+            for pending in reversed(self._frames):
+                if pending[0] == key:
+                    pending[1] = coalesce_frames(pending[1], frame)
+                    return True
+                if pending[1].payload.get("type") in STATE_FRAME_TYPES:
+                    break
+        if len(self._frames) >= self.maxsize:
+            # [修改] 狀態訊框不能默默丟掉，改成斷線
+            if self.policy == "disconnect" or self._frames[0][1].payload.get("type") in STATE_FRAME_TYPES:
+                return False
+            self._frames.popleft()
+        self._frames.append([key, frame])
+        self._wakeup.set()
+        return True
+
+    def close(self, code: int, reason: str = ""):
+        """丟掉還沒送出的訊息，並在寫入任務裡關閉連線"""
+        self.closed = True
+        self._frames.clear()
+        self._close_code = code
+        self._close_reason = reason
+        self._wakeup.set()
+
+    def stop(self):
+        """連線已經結束，停止寫入任務"""
+        self.closed = True
+        self.task.cancel()
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._frames:
+                    _, frame = self._frames.popleft()
+                    # [修改] 在送出當下才依這條連線的格式取出編碼結果 (同一個 Frame 每種格式只編碼一次)
+                    data = frame.encode(self.protocol)
+                    if isinstance(data, bytes):
+                        await self.websocket.send_bytes(data)
+                    else:
+                        await self.websocket.send_text(data)
+                if self._close_code is not None:
+                    await self.websocket.close(code=self._close_code, reason=self._close_reason)
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 對方已經斷線
+            self.closed = True
+            # [修改] 不再等接收迴圈發現，馬上通知連線管理器把它移除
+            if self.on_failed:
+                self.on_failed(self.websocket)
 
 class ConnectionManager:
     """管理 WebSocket 連線的類別"""
-    def __init__(self):
+    def __init__(self, backplane, send_queue_size: int = SEND_QUEUE_SIZE, policy: str = SLOW_CONSUMER_POLICY):
         # 儲存活躍連線 (WebSocket: 暱稱)
         self.active_connections: Dict[WebSocket, str] = {}
+        # [新增] 每條連線各自的送出佇列
+        self.senders: Dict[WebSocket, ClientSender] = {}
+        self.send_queue_size = send_queue_size
+        self.policy = policy
+        # [新增] 跨行程通道，以及其他 worker 回報的線上名單 (node_id: (名單, 收到的時間))
+        self.backplane = backplane
+        self.remote_members: Dict[str, tuple] = {}
+        # [新增] 暱稱 -> 連線 的索引，找重複登入不必掃過全部連線
+        self.user_sockets: Dict[str, WebSocket] = {}
+        # [新增] 聊天室 -> 訂閱的連線，廣播成本只跟聊天室人數有關
+        self.rooms: Dict[str, set] = {}
+        self.socket_rooms: Dict[WebSocket, str] = {}
+        # [修改] 上線/離線差異：以最後一次廣播出去的狀態為基準合併，時間窗內互相抵銷的變動才不會讓客戶端名單不一致
+        self.presence = PresenceDiff()
+        self._presence_flush = None
+        # [新增] 送出失敗、等待回收的連線，以及叫醒心跳任務的事件
+        self.failed_sockets: set = set()
+        self.reaper_wakeup = asyncio.Event()
+
+    def _remote_member_set(self) -> set:
+        """其他 worker 回報的線上成員"""
+        members = set()
+        now = time.monotonic()
+        for node_id, (names, seen) in list(self.remote_members.items()):
+            if now - seen > PRESENCE_TTL:
+                # 太久沒回報，當作那個 worker 已經不在了
+                del self.remote_members[node_id]
+                continue
+            members.update(names)
+        return members
 
     def get_member_list(self) -> List[str]:
         """取得所有成員的暱稱列表"""
-        return list(set(self.active_connections.values()))
-
-    # [修改] 回傳值型態註解改為 bool (True=是取代舊連線, False=是新連線)
-    async def connect(self, websocket: WebSocket, nickname: str) -> bool:
-        """接受一個新的 WebSocket 連線"""
-        await websocket.accept()
+        # [修改] 本機的連線 + 其他 worker 回報的連線
+        return list(self._remote_member_set().union(self.user_sockets))
 
-        # [優化] 一行程式碼找出舊連線 (如果沒找到就回傳 None)
-        existing_socket = next((ws for ws, user in self.active_connections.items() if user == nickname), None)
+    def member_snapshot(self, nickname: str) -> List[str]:
+        """
+        [新增] 給剛連線的人的完整名單：已經廣播出去的狀態 (加上他自己)
+        還在時間窗裡的變動會在下一個 presence_update 送到，跟其他客戶端看到的一致
+        """
+        return self.presence.snapshot(self._remote_member_set() | {nickname})
+
+    def is_online_elsewhere(self, nickname: str) -> bool:
+        """[新增] 是否已經在其他 worker 上登入"""
+        now = time.monotonic()
+        return any(nickname in names and now - seen <= PRESENCE_TTL
+                   for names, seen in self.remote_members.values())
+
+    def publish_presence(self):
+        """[新增] 把本機的線上名單告訴其他 worker ([修改] 已經廣播出去的狀態，其他 worker 拿來當新連線的名單)"""
+        self.backplane.publish("presence", {
+            "node": self.backplane.node_id,
+            "members": list(self.presence.announced)
+        })
+
+    def _schedule_presence_flush(self):
+        # 同一個時間窗內只排一次
+        if self._presence_flush is None:
+            self._presence_flush = asyncio.get_running_loop().call_later(
+                PRESENCE_COALESCE_WINDOW, self._flush_presence)
+
+    def _flush_presence(self):
+        """[新增] 把這段時間累積的上線/離線差異一次廣播出去"""
+        self._presence_flush = None
+        payload = self.presence.take()
+        self.publish_presence()
+        if payload is None:
+            return
+        self.broadcast_local(payload)
+        self.backplane.publish("broadcast", {"room": None, "payload": payload})
+
+    def presence_joined(self, nickname: str):
+        """[新增] 記錄一位成員上線 (時間窗結束時跟已廣播的狀態比較)"""
+        self.presence.joined(nickname)
+        self._schedule_presence_flush()
+
+    def presence_left(self, nickname: str):
+        """[新增] 記錄一位成員離線 (時間窗結束時跟已廣播的狀態比較)"""
+        self.presence.left(nickname)
+        self._schedule_presence_flush()
+
+    def on_remote_presence(self, data: dict):
+        """[新增] 收到其他 worker 的線上名單"""
+        self.remote_members[data["node"]] = (set(data["members"]), time.monotonic())
+
+    def on_remote_kick(self, data: dict):
+        """[新增] 同一個帳號在其他 worker 登入了：把本機的舊連線踢掉 (不廣播離開)"""
+        nickname = data["username"]
+        ws = self.user_sockets.pop(nickname, None)
+        if ws is None:
+            return
+        del self.active_connections[ws]
+        self._leave_room(ws)
+        sender = self.senders.pop(ws, None)
+        if sender:
+            sender.close(4001, "Duplicate login")
+        # 之後由新連線所在的 worker 負責廣播他離線
+        self.presence.forget(nickname)
+        self._schedule_presence_flush()
+
+    def _join_room(self, websocket: WebSocket, room: str):
+        self.rooms.setdefault(room, set()).add(websocket)
+        self.socket_rooms[websocket] = room
+
+    def _leave_room(self, websocket: WebSocket) -> Optional[str]:
+        """[新增] 把連線從它的聊天室移除，回傳原本的聊天室"""
+        room = self.socket_rooms.pop(websocket, None)
+        if room is not None:
+            subscribers = self.rooms.get(room)
+            if subscribers is not None:
+                subscribers.discard(websocket)
+                if not subscribers:
+                    del self.rooms[room]
+        return room
+
+    # [修改] 回傳 (是否取代舊連線, 舊連線所在的聊天室)；舊連線在其他 worker 上時聊天室未知 (None)
+    async def connect(self, websocket: WebSocket, nickname: str, room: str = DEFAULT_ROOM, heartbeat: bool = False):
+        """接受一個新的 WebSocket 連線，並加入 room 聊天室 (heartbeat: 客戶端會回應 {"type":"ping"})"""
+        # [新增] 客戶端有提出 MessagePack 子協定就改用二進位訊框，沒有就維持 JSON
+        protocol = negotiate(websocket)
+        await websocket.accept(subprotocol=protocol)
+
+        # [優化] 直接從索引找出舊連線 (如果沒找到就回傳 None)
+        existing_socket = self.user_sockets.get(nickname)
+
+        # [新增] 舊連線在其他 worker 上：請那個 worker 把它踢掉
+        remote = self.is_online_elsewhere(nickname)
+        if remote:
+            self.backplane.publish("kick", {"username": nickname})
+            if existing_socket is None:
+                # 客戶端都知道他在線上 (由原本的 worker 廣播過)，改由本機接手
+                self.presence.adopt(nickname)
         
+        previous_room = None
         if existing_socket:
             # 1. 先從清單刪除 (確保 disconnect 不會廣播離開)
             del self.active_connections[existing_socket]
+            previous_room = self._leave_room(existing_socket)
             
-            # 2. 關閉舊連線
-            try:
-                await existing_socket.close(code=4001, reason="Duplicate login")
-            except Exception:
-                pass # 忽略錯誤
-            
-            # 3. 加入新連線
-            self.active_connections[websocket] = nickname
-            return True # 回傳 True: 代表是「取代」舊連線
-            
-        # 如果沒有舊連線
+            # 2. 關閉舊連線 ([修改] 交給舊連線自己的寫入任務去關，這裡不必等待)
+            old_sender = self.senders.pop(existing_socket, None)
+            if old_sender:
+                old_sender.close(4001, "Duplicate login")
+
+        # 3. 加入新連線
+        # 注意：accept 之後到這裡都沒有 await，呼叫端緊接著 send_personal 的歷史訊息一定排在所有廣播之前
         self.active_connections[websocket] = nickname
-        return False # 回傳 False: 代表是「全新」連線
+        self.user_sockets[nickname] = websocket
+        self.senders[websocket] = ClientSender(websocket, self.send_queue_size, self.policy, protocol,
+                                               on_failed=self._on_send_failed, heartbeat=heartbeat)
+        self._join_room(websocket, room)
+        self._schedule_presence_flush()
+
+        # 回傳 True: 代表是「取代」舊連線 / False: 代表是「全新」連線
+        return existing_socket is not None or remote, previous_room
 
     def disconnect(self, websocket: WebSocket) -> str:
         """斷開一個 WebSocket 連線"""
+        sender = self.senders.pop(websocket, None)
+        if sender:
+            sender.stop()
+        self._leave_room(websocket)
         # [修改] 使用 pop 嘗試移除，如果 key 不存在 (代表已經在 connect 被踢掉了)，回傳 None
-        return self.active_connections.pop(websocket, None)
-
-    async def broadcast(self, payload: dict):
+        nickname = self.active_connections.pop(websocket, None)
+        if nickname and self.user_sockets.get(nickname) is websocket:
+            del self.user_sockets[nickname]
+            self._schedule_presence_flush()
+        return nickname
+
+    def _on_send_failed(self, websocket: WebSocket):
+        self.failed_sockets.add(websocket)
+        self.reaper_wakeup.set()
+
+    def take_failed(self) -> List[WebSocket]:
+        """[新增] 取出所有送出失敗的連線"""
+        failed = list(self.failed_sockets)
+        self.failed_sockets.clear()
+        return failed
+
+    def touch(self, websocket: WebSocket):
+        """[新增] 收到這條連線的訊框 (證明對方還活著)"""
+        sender = self.senders.get(websocket)
+        if sender:
+            sender.last_seen = time.monotonic()
+
+    def reap(self, websocket: WebSocket, code: int, reason: str):
         """
-        廣播 JSON 訊息給所有已連線的 WebSocket
-        payload 是一個字典，我們會將它轉換為 JSON 字串
+        [新增] 立刻把失效的連線從所有清單移除，並在背景關閉它
+        回傳 (暱稱, 聊天室)；暱稱是 None 代表它已經被新連線取代 (不用廣播離開)
+        連線早就不在清單裡時回傳 None
         """
-        message_str = json.dumps(payload)  # 將字典轉為 JSON 字串
-        for connection in list(self.active_connections):
-            try:
-                await connection.send_text(message_str)
-            except Exception:
-                pass
+        sender = self.senders.pop(websocket, None)
+        if sender is None:
+            return None
+        # 交給它的寫入任務送出關閉訊框；對方完全沒反應的話，過一段時間直接停掉
+        sender.close(code, reason)
+        asyncio.get_running_loop().call_later(HEARTBEAT_INTERVAL, sender.stop)
+        room = self._leave_room(websocket)
+        nickname = self.active_connections.pop(websocket, None)
+        if nickname and self.user_sockets.get(nickname) is websocket:
+            del self.user_sockets[nickname]
+            self._schedule_presence_flush()
+        else:
+            nickname = None
+        return nickname, room
+
+    def close(self, websocket: WebSocket, code: int, reason: str = ""):
+        """[新增] 由伺服器主動關閉連線 (交給它的寫入任務，先送完的訊息不受影響)"""
+        sender = self.senders.get(websocket)
+        if sender and not sender.closed:
+            sender.close(code, reason)
+
+    def send_personal(self, websocket: WebSocket, message):
+        """[新增] 只送給單一連線 (一樣走它的送出佇列，確保順序)，message 可以是 dict 或 Frame"""
+        frame = message if isinstance(message, Frame) else Frame(message)
+        sender = self.senders.get(websocket)
+        if sender and not sender.push(frame):
+            sender.close(SLOW_CONSUMER_CLOSE_CODE, "Slow consumer")
+            slow_consumer_disconnects.inc()
+
+    def send_history(self, websocket: WebSocket, message, last_id: int):
+        """[新增] 送出連線時的歷史訊息 (history 或 history_delta)，last_id 是它涵蓋到的最新訊息 id"""
+        sender = self.senders.get(websocket)
+        if sender:
+            sender.history_last_id = last_id
+        self.send_personal(websocket, message)
+
+    async def broadcast(self, payload: dict, room: Optional[str] = None):
+        """
+        廣播 JSON 訊息給所有已連線的 WebSocket ([新增] 有指定 room 就只送給該聊天室)
+        payload 是一個字典，我們會將它轉換為 JSON 字串 (或 MessagePack)
+        [修改] 每種格式只編碼一次，然後放進每條連線的送出佇列，不等待任何一條連線送完
+        """
+        self.broadcast_local(payload, room)
+        # [新增] 其他 worker 上的連線交給它們自己送
+        self.backplane.publish("broadcast", {"room": room, "payload": payload})
+
+    def on_remote_broadcast(self, data: dict):
+        """[新增] 其他 worker 轉送過來的廣播"""
+        self.broadcast_local(data["payload"], data["room"])
+
+    def broadcast_local(self, payload: dict, room: Optional[str] = None):
+        """[新增] 只送給本 worker 上的連線"""
+        started = time.perf_counter()
+        frame = Frame(payload)  # [修改] 第一條需要某種格式的連線送出時才編碼，之後共用
+        key = payload.get("type") if payload.get("type") in COALESCE_TYPES else None
+        message_id = payload.get("id") if payload.get("type") in MESSAGE_FRAME_TYPES else None
+        if room is None:
+            senders = list(self.senders.values())
+        else:
+            # [新增] 只走訪該聊天室的訂閱者
+            senders = [self.senders[ws] for ws in self.rooms.get(room, ()) if ws in self.senders]
+        for sender in senders:
+            # [新增] 這則訊息已經在它連線時的歷史訊息裡了
+            if message_id is not None and message_id <= sender.history_last_id:
+                continue
+            if not sender.push(frame, key):
+                # 佇列塞滿了：斷開這個太慢的客戶端
+                sender.close(SLOW_CONSUMER_CLOSE_CODE, "Slow consumer")
+                slow_consumer_disconnects.inc()
+        broadcast_deliveries.inc(len(senders))
+        broadcast_seconds.observe(time.perf_counter() - started)
+
+# [新增] 跨行程通道 (多 worker 時用來互相轉送廣播、線上名單與踢人事件)
+backplane = create_backplane(BACKPLANE, BACKPLANE_DB)
 
 # 實例化連線管理器
-manager = ConnectionManager()
-
-# [新增] 全域訊息佇列
-message_queue = asyncio.Queue()
+manager = ConnectionManager(backplane)
+
+backplane.on("broadcast", manager.on_remote_broadcast)
+backplane.on("presence", manager.on_remote_presence)
+backplane.on("kick", manager.on_remote_kick)
+# 其他 worker 寫入或刪除的訊息也要同步到本機的記憶體緩衝區
+backplane.on("history_add", lambda items: [room_histories.add(room, msg) for room, msg in items])
+backplane.on("history_remove", lambda data: room_histories.remove(data["room"], data["id"]))
+# 其他 worker 上註冊的帳號
+backplane.on("user_added", user_directory.add)
+
+# [新增] 洗版防護
+flood_control = FloodControl(FLOOD_USER_RATE, FLOOD_USER_BURST,
+                             FLOOD_GLOBAL_RATE, FLOOD_GLOBAL_BURST, FLOOD_MAX_STRIKES)
+
+# [新增] 抓取時才計算的指標
+metrics.gauge("chat_active_connections", "本 worker 的 WebSocket 連線數", lambda: len(manager.active_connections))
+metrics.gauge("chat_online_members", "線上成員數 (含其他 worker)", lambda: len(manager.get_member_list()))
+metrics.gauge("chat_send_queue_frames", "所有連線送出佇列裡還沒送出的訊框數", lambda: sum(s.pending() for s in manager.senders.values()))
+metrics.gauge("chat_message_queue_depth", "等待寫入資料庫的訊息數", lambda: message_queue.qsize())
+metrics.gauge("chat_message_queue_capacity", "訊息佇列上限", lambda: message_queue.maxsize)
+metrics.gauge("chat_message_queue_events_total", "訊息佇列的累計事件數", labelnames=["event"], kind="counter",
+              fn=lambda: {(k,): v for k, v in message_queue_stats.items() if k != "max_depth"})
+metrics.gauge("chat_message_queue_max_depth", "訊息佇列出現過的最大排隊數", lambda: message_queue_stats["max_depth"])
+metrics.gauge("chat_history_cache_messages", "記憶體緩衝區裡的訊息數 (所有聊天室)", lambda: len(room_histories))
+metrics.gauge("chat_active_rooms", "本 worker 上有人在的聊天室數", lambda: len(manager.rooms))
+metrics.gauge("chat_password_pool_pending", "bcrypt 行程池在算 + 排隊中的數量", lambda: password_pool.pending)
+metrics.gauge("chat_password_pool_rejected_total", "bcrypt 行程池滿載而回 503 的次數", lambda: password_pool.rejected, kind="counter")
+metrics.gauge("chat_password_pool_completed_total", "bcrypt 行程池完成的工作數", lambda: password_pool.completed, kind="counter")
+metrics.gauge("chat_password_pool_wait_seconds_total", "bcrypt 工作在行程池排隊的累計秒數", lambda: password_pool.total_wait, kind="counter")
+metrics.gauge("chat_password_pool_run_seconds_total", "bcrypt 工作在子行程裡執行的累計秒數", lambda: password_pool.total_run, kind="counter")
+metrics.gauge("chat_password_pool_max_run_seconds", "單一 bcrypt 工作最長的執行秒數", lambda: password_pool.max_run)
+metrics.gauge("chat_token_cache_lookups_total", "Token 快取查詢次數", labelnames=["result"], kind="counter",
+              fn=lambda: {("hit",): token_cache.hits, ("miss",): token_cache.misses})
+metrics.gauge("chat_token_decode_seconds_total", "沒命中快取、實際解析 JWT 的累計秒數", lambda: token_cache.decode_seconds, kind="counter")
+metrics.gauge("chat_flood_rejected_total", "因為洗版而被擋下的訊框數", lambda: flood_control.rejected, kind="counter")
+metrics.gauge("chat_flood_kicked_total", "因為洗版而被斷線的次數", lambda: flood_control.kicked, kind="counter")
+metrics.gauge("chat_flood_global_rejected_total", "整個聊天室額度用完而丟掉的訊框數 (不算使用者違規)",
+              lambda: flood_control.global_rejected, kind="counter")
+metrics.gauge("chat_retention_rows_total", "訊息保留工作清除/封存的資料列數", labelnames=["action"], kind="counter",
+              fn=lambda: {(k,): v for k, v in retention_stats.items() if k != "vacuumed_pages"})
+metrics.gauge("chat_retention_vacuumed_pages_total", "incremental vacuum 歸還的頁面數",
+              lambda: retention_stats["vacuumed_pages"], kind="counter")
+
+# [新增] 全域訊息佇列 ([修改] 有上限)
+message_queue = asyncio.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+# 佇列裡的關機訊號
+STOP_WRITER = None
+# [新增] 佇列的統計數據
+message_queue_stats = {"written": 0, "failed": 0, "dropped": 0, "spilled": 0, "max_depth": 0}
+
+def enqueue_system_message(text, room=DEFAULT_ROOM):
+    """[新增] 系統訊息 (加入/離開) 不等待寫入結果；佇列滿了就丟掉，不讓它擠掉使用者的訊息"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        message_queue.put_nowait(("系統", text, timestamp, "system", None, room, None))
+    except asyncio.QueueFull:
+        message_queue_stats["dropped"] += 1
+        print(f"訊息佇列已滿，丟棄系統訊息: {text}")
+
+def take_batch(first):
+    """把佇列裡已經在排隊的任務一起拿出來 (遇到關機訊號就停)，回傳 (batch, 是否收到關機訊號)"""
+    if first is STOP_WRITER:
+        return [], True
+    batch = [first]
+    while len(batch) < WRITE_BATCH_SIZE:
+        try:
+            task = message_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+        if task is STOP_WRITER:
+            return batch, True
+        batch.append(task)
+    return batch, False
 
 # [新增] 背景工兵：專門負責把佇列裡的訊息寫入資料庫
 async def db_writer_worker():
     while True:
         # 從佇列拿出一個任務 (如果沒任務，這裡會自動等待，不佔資源)
         task = await message_queue.get()
-        
-        nickname, message, timestamp, msg_type, filename = task
-        
-        # 這裡執行原本的寫入邏輯 (使用 run_in_threadpool 避免卡住工兵)
+
+        # [修改] 把佇列裡已經在排隊的任務一起拿出來，整批只 commit 一次
+        depth = message_queue.qsize() + 1
+        if depth > message_queue_stats["max_depth"]:
+            message_queue_stats["max_depth"] = depth
+        if depth >= MESSAGE_QUEUE_WARN_DEPTH:
+            print(f"訊息佇列積壓 {depth} 筆，資料庫寫入跟不上")
+        batch, stopping = take_batch(task)
+        if batch:
+            await write_batch(batch)
+        if stopping:
+            return
+
+async def write_batch(batch) -> bool:
+    """整批寫入資料庫，並把結果交還給等待中的傳送者，回傳是否成功"""
+    rows = [queue_row(t) for t in batch]
+    try:
+        with db_write_batch_seconds.time():
+            message_ids = await db.write(insert_messages, rows)
+        db_write_batch_size.observe(len(rows))
+        # 把 id 交還給等待中的傳送者 (系統訊息沒有 future)
+        added = []
+        for t, row, message_id in zip(batch, rows, message_ids):
+            # [新增] 同步更新記憶體緩衝區 (欄位順序與 format_message_row 相同)
+            nickname, message, msg_type, timestamp, filename, room = row
+            msg_data = format_message_row((nickname, message, msg_type, timestamp, message_id, 0, filename))
+            room_histories.add(room, msg_data)
+            added.append((room, msg_data))
+            future = t[6]
+            if future is not None and not future.done():
+                future.set_result(message_id)
+        backplane.publish("history_add", added)
+        message_queue_stats["written"] += len(batch)
+        ok = True
+    except Exception as e:
+        print(f"背景寫入失敗: {e}")
+        message_queue_stats["failed"] += len(batch)
+        for t in batch:
+            future = t[6]
+            if future is not None and not future.done():
+                future.set_exception(e)
+        ok = False
+
+    # 標記任務完成
+    for _ in batch:
+        message_queue.task_done()
+    return ok
+
+async def drain_message_queue(writer_task):
+    """
+    [新增] 關機時呼叫：排在最後的停止訊號讓寫入任務把前面的訊息都寫完再結束
+    超過 SHUTDOWN_DRAIN_TIMEOUT 還沒寫完，或停止訊號之後才進來的訊息，寫不進去就存檔，下次啟動補寫
+    (已經交給資料庫執行緒的那一批不會重複存檔，db.close() 會等它寫完)
+    """
+    timed_out = False
+    try:
+        await asyncio.wait_for(message_queue.put(STOP_WRITER), SHUTDOWN_DRAIN_TIMEOUT)
+        await asyncio.wait_for(writer_task, SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        timed_out = True
+        writer_task.cancel()
+        await asyncio.gather(writer_task, return_exceptions=True)
+        print("關機時訊息佇列沒有在時限內寫完")
+
+    leftovers = []
+    while not message_queue.empty():
+        task = message_queue.get_nowait()
+        if task is not STOP_WRITER:
+            leftovers.append(task)
+    if not leftovers:
+        return
+    # 寫入任務是正常結束的 (資料庫沒問題) 就直接補寫
+    if not timed_out and await write_batch(leftovers):
+        return
+    spill_pending_messages(leftovers)
+
+def spill_pending_messages(tasks):
+    """[新增] 把寫不進資料庫的訊息存成 JSON Lines (不含 future)"""
+    with open(PENDING_MESSAGES_FILE, "a", encoding="utf-8") as f:
+        for t in tasks:
+            f.write(json.dumps(list(t[:6]), ensure_ascii=False) + "\n")
+    message_queue_stats["spilled"] += len(tasks)
+    print(f"{len(tasks)} 筆訊息已暫存到 {PENDING_MESSAGES_FILE}，下次啟動時補寫")
+
+async def replay_pending_messages():
+    """[新增] 啟動時補寫上次存檔的訊息 (在寫入任務啟動之前呼叫)"""
+    # [修改] 多個 worker 同時啟動時只能有一個補寫：先把檔案改名成自己的，改名成功的才補寫
+    claimed = f"{PENDING_MESSAGES_FILE}.{os.getpid()}"
+    try:
+        os.rename(PENDING_MESSAGES_FILE, claimed)
+    except FileNotFoundError:
+        return
+    with open(claimed, encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()]
+    if lines:
+        tasks = [json.loads(line) for line in lines]
+        try:
+            # [修改] 舊版暫存檔沒有聊天室欄位，算在預設聊天室
+            await db.write(insert_messages, [queue_row(t + [DEFAULT_ROOM] * (6 - len(t))) for t in tasks])
+        except Exception:
+            # 寫不進去就放回原本的檔案，下次啟動再試
+            with open(PENDING_MESSAGES_FILE, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+            os.remove(claimed)
+            raise
+        print(f"已補寫 {len(tasks)} 筆上次關機時沒寫完的訊息")
+    os.remove(claimed)
+
+# [新增] 訊息保留工作的累計數據
+retention_stats = {"purged_deleted": 0, "purged_system": 0, "archived": 0, "vacuumed_pages": 0}
+
+async def run_in_batches(fn, *args) -> int:
+    """重複執行 fn 直到某一批沒有處理任何資料，每批都是獨立的短交易，回傳總筆數"""
+    total = 0
+    while True:
+        count = await db.write(fn, *args)
+        if not count:
+            return total
+        total += count
+        await asyncio.sleep(RETENTION_BATCH_PAUSE)
+
+async def run_retention():
+    """[新增] 清理、封存、歸還空間各做一輪"""
+    with retention_run_seconds.time():
+        retention_stats["purged_deleted"] += await run_in_batches(purge_deleted, RETENTION_BATCH_SIZE)
+
+        now = datetime.now()
+        if SYSTEM_MESSAGE_RETENTION_DAYS > 0:
+            before = (now - timedelta(days=SYSTEM_MESSAGE_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+            retention_stats["purged_system"] += await run_in_batches(purge_system_messages, before, RETENTION_BATCH_SIZE)
+
+        if ARCHIVE_AFTER_DAYS > 0:
+            before = (now - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+            retention_stats["archived"] += await run_in_batches(archive_segment, before, ARCHIVE_SEGMENT_SIZE)
+
+        # 一次只歸還一小段，直到沒有空頁面
+        retention_stats["vacuumed_pages"] += await run_in_batches(incremental_vacuum, VACUUM_PAGES_PER_STEP)
+
+async def retention_worker():
+    await asyncio.sleep(RETENTION_START_DELAY)
+    while True:
         try:
-            message_id = await run_in_threadpool(save_message, nickname, message, timestamp, msg_type, filename)
+            await run_retention()
         except Exception as e:
-            print(f"背景寫入失敗: {e}")
-        
-        # 標記任務完成
-        message_queue.task_done()
+            print(f"訊息保留工作失敗: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+async def announce_leave(nickname, room):
+    """[新增] 廣播某位成員離開 (存入資料庫 + 通知聊天室 + 線上名單差異)"""
+    enqueue_system_message(f"{nickname} 離開了聊天室", room)
+    await manager.broadcast({"type": "system", "message": f"{nickname} 離開了聊天室"}, room)
+    manager.presence_left(nickname)
+
+async def reap_connection(websocket, reason):
+    """[新增] 回收一條失效的連線，reason: "timeout" (心跳逾時) / "send_failed" (送出失敗)"""
+    reaped = manager.reap(websocket, HEARTBEAT_CLOSE_CODE, "Heartbeat timeout" if reason == "timeout" else "Send failed")
+    if reaped is None:
+        return
+    reaped_connections.labels(reason).inc()
+    nickname, room = reaped
+    if nickname:
+        flood_control.release(nickname)
+        await announce_leave(nickname, room)
+
+# [新增] 心跳：所有連線共用這一個任務，不必每條連線各開一個計時器
+PING_FRAME = Frame({"type": "ping"})
+
+async def check_heartbeats(now):
+    """回收送出失敗的連線；有開 heartbeat 的連線太久沒動靜就回收，閒置的送 ping"""
+    for websocket in manager.take_failed():
+        await reap_connection(websocket, "send_failed")
+
+    for websocket, sender in list(manager.senders.items()):
+        # 沒開 heartbeat 的客戶端看不懂 ping，存活交給協定層的 ping/pong
+        if not sender.heartbeat:
+            continue
+        if now - sender.last_seen > HEARTBEAT_TIMEOUT:
+            await reap_connection(websocket, "timeout")
+        elif now - max(sender.last_seen, sender.last_ping) >= HEARTBEAT_INTERVAL:
+            sender.last_ping = now
+            manager.send_personal(websocket, PING_FRAME)
+
+async def heartbeat_worker():
+    while True:
+        try:
+            # 平常每 HEARTBEAT_INTERVAL 秒檢查一次；有連線送出失敗時會被提早叫醒
+            await asyncio.wait_for(manager.reaper_wakeup.wait(), HEARTBEAT_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        manager.reaper_wakeup.clear()
+        await check_heartbeats(time.monotonic())
+
+# [新增] 定期把本機線上名單告訴其他 worker (worker 當掉時，名單會在 PRESENCE_TTL 後自動過期)
+async def presence_worker():
+    while True:
+        await asyncio.sleep(PRESENCE_INTERVAL)
+        manager.publish_presence()
 
 # ... (FastAPI 實例化) ...
 app = FastAPI(lifespan=lifespan)
 
 # 掛載靜態檔案路徑 (這行一定要加，讓前端讀得到圖片)
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# [修改] 上傳檔 (含縮圖) 的內容永遠不會變，回傳 immutable 快取標頭；影片支援 Range 分段下載
+app.mount("/static", MediaStaticFiles(directory="static", immutable_dirs=["uploads"]), name="static")
 
 # --- CORS 設定 ---
 app.add_middleware(
@@ -280,26 +1290,82 @@ app.add_middleware(
 
 # [新增] 取得所有已註冊的使用者清單 (供前端計算離線成員用)
 @app.get("/users")
-async def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # 只選取 username 欄位
-    c.execute("SELECT username FROM users")
-    rows = c.fetchall()
-    conn.close()
-    
-    # rows 的格式會是 [('alice',), ('bob',), ...]
-    # 我們要把它轉成單純的 list: ['alice', 'bob', ...]
-    all_users = [row[0] for row in rows]
-    
-    return all_users
+async def get_all_users(if_none_match: Optional[str] = Header(None)):
+    # [修改] 直接用記憶體名冊，JSON 也只在名冊變動後才重新產生
+    # 客戶端帶的 ETag 跟目前一樣就回 304，不必再下載一次整份名冊
+    etag = user_directory.etag
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match and (if_none_match.strip() == "*" or etag in
+                          (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))):
+        return Response(status_code=304, headers=headers)
+    return Response(content=user_directory.body(), media_type="application/json", headers=headers)
+
+# [新增] 分頁的成員列表，每位成員都標好線上/離線 (依帳號名稱排序，游標是上一頁最後一個帳號)
+@app.get("/users/page")
+async def get_users_page(presence: str = Query("all", alias="status"), cursor: Optional[str] = None, limit: int = 50):
+    if presence not in ("all", "online", "offline"):
+        raise HTTPException(status_code=400, detail="status 只能是 all、online 或 offline")
+    limit = max(1, min(limit, USERS_PAGE_MAX_LIMIT))
+    online = set(manager.get_member_list())
+    if presence == "online":
+        # 線上名單通常比全部帳號少很多，直接排序線上名單來翻頁
+        names, next_cursor = user_directory.page(cursor, limit, names=sorted(online))
+    elif presence == "offline":
+        names, next_cursor = user_directory.page(cursor, limit, lambda name: name not in online)
+    else:
+        names, next_cursor = user_directory.page(cursor, limit)
+    online_count = len(online)
+    return {
+        "users": [{"username": name, "online": name in online} for name in names],
+        "next_cursor": next_cursor,
+        "total": len(user_directory),
+        "online_count": online_count,
+        "offline_count": max(len(user_directory) - online_count, 0)
+    }
 
 # [新增] 載入更多歷史訊息 API
 @app.get("/history/more")
-async def get_more_history(skip: int = 0, limit: int = 50):
-    # 直接呼叫上面改好的函式
-    return get_recent_messages(limit, skip)
+async def get_more_history(skip: int = 0, limit: int = 50, before_id: Optional[int] = None,
+                           room: str = DEFAULT_ROOM):
+    check_room(room)
+    # [新增] 每個聊天室各自的緩衝區 (沒載入的聊天室直接查資料庫，不為了翻頁載入整個聊天室)
+    cache = room_histories.get(room)
+
+    # [相容] 沒帶 before_id 的舊版前端，仍然用 skip 分頁並直接回傳陣列
+    if before_id is None:
+        history = cache.recent(limit, skip) if cache else None
+        if history is None:
+            history = await get_recent_messages(limit, skip, room)
+        return history
+
+    # [新增] 游標分頁：回傳這一頁 + 下一頁要帶的游標 (沒有更多資料時為 None)
+    # 先找記憶體緩衝區，比緩衝區更舊的頁面才查資料庫
+    history = cache.page_before(before_id, limit) if cache else None
+    if history is None:
+        history = await get_messages_before(before_id, limit, room)
+    next_cursor = history[0]["id"] if len(history) == limit else None
+    return {"messages": history, "next_cursor": next_cursor}
+
+# [新增] 監控指標 (給 Prometheus 抓取)
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# [新增] 搜尋訊息 API
+@app.get("/search")
+async def search(q: str, limit: int = 20, order: str = "rank", cursor: Optional[str] = None,
+                 room: Optional[str] = None):
+    # [新增] 帶 room 只搜尋該聊天室，不帶就搜尋全部
+    if room is not None:
+        check_room(room)
+    if order not in ("rank", "recent"):
+        raise HTTPException(status_code=400, detail="order 只能是 rank 或 recent")
+    match = build_match_query(q[:MAX_MSG_LENGTH])
+    if match is None:
+        raise HTTPException(status_code=400, detail="請輸入搜尋關鍵字")
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    results, next_cursor = await search_messages(match, limit, order, parse_search_cursor(cursor, order), room)
+    return {"results": results, "next_cursor": next_cursor}
 
 # [修改] 註冊 API：改用 UserRegister 模型並加入驗證邏輯
 @app.post("/register")
@@ -324,37 +1390,32 @@ async def register(user: UserRegister):
         raise HTTPException(status_code=400, detail="密碼必須包含至少一個英文字母與一個數字")
 
     # 5. 資料庫檢查
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
     # 3. 檢查帳號是否已存在
-    c.execute("SELECT username FROM users WHERE username = ?", (user.username,))
-    if c.fetchone():
-        conn.close()
+    if await db.fetchone("SELECT username FROM users WHERE username = ?", (user.username,)):
         raise HTTPException(status_code=400, detail="此帳號已被註冊")
     
     # 4. 將密碼加密後存入資料庫
-    hashed_password = get_password_hash(user.password)
-    c.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", 
-              (user.username, hashed_password))
-    
-    conn.commit()
-    conn.close()
+    hashed_password = await get_password_hash(user.password)
+    try:
+        await db.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                         (user.username, hashed_password))
+    except sqlite3.IntegrityError:
+        # 兩個人同時註冊同一個帳號時，後到的會撞到主鍵
+        raise HTTPException(status_code=400, detail="此帳號已被註冊")
+
+    # [新增] 更新名冊 (/users 的 ETag 會跟著改變)
+    user_directory.add(user.username)
+    backplane.publish("user_added", user.username)
     return {"message": "User created successfully"}
 
 # [新增] 登入 API
 @app.post("/token", response_model=Token)
 async def login_for_access_token(user_data: UserAuth):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
     # 找使用者
-    c.execute("SELECT username, password_hash FROM users WHERE username = ?", (user_data.username,))
-    row = c.fetchone()
-    conn.close()
+    row = await db.fetchone("SELECT username, password_hash FROM users WHERE username = ?", (user_data.username,))
     
     # 驗證帳號存在 且 密碼正確
-    if not row or not verify_password(user_data.password, row[1]):
+    if not row or not await verify_password(user_data.password, row[1]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="帳號或密碼錯誤",
@@ -377,18 +1438,8 @@ async def login_for_access_token(user_data: UserAuth):
 @app.post("/change-password")
 async def change_password(
     req: ChangePasswordRequest, 
-    authorization: str = Header(None) # 從 Header 取得 Token
+    username: str = Depends(get_current_user) # 1. [修改] 由共用元件驗證 Token
 ):
-    # 1. 驗證 Token 是否存在
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="未登入或 Token 無效")
-    
-    token = authorization.split(" ")[1]
-    username = get_current_user_from_token(token)
-    
-    if not username:
-        raise HTTPException(status_code=401, detail="Token 無效或過期")
-
     # 2. 驗證新密碼格式 (與註冊時相同的邏輯)
     if req.new_password != req.confirm_new_password:
         raise HTTPException(status_code=400, detail="兩次新密碼輸入不一致")
@@ -399,77 +1450,326 @@ async def change_password(
     if not re.search(r"[A-Za-z]", req.new_password) or not re.search(r"\d", req.new_password):
         raise HTTPException(status_code=400, detail="新密碼必須包含至少一個英文字母與一個數字")
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
     # 3. 取得目前使用者資料
-    c.execute("SELECT password_hash FROM users WHERE username = ?", (username,))
-    row = c.fetchone()
+    row = await db.fetchone("SELECT password_hash FROM users WHERE username = ?", (username,))
     
     if not row:
-        conn.close()
         raise HTTPException(status_code=404, detail="使用者不存在")
     
     current_password_hash = row[0]
 
     # 4. 驗證舊密碼是否正確
-    if not verify_password(req.old_password, current_password_hash):
-        conn.close()
+    if not await verify_password(req.old_password, current_password_hash):
         raise HTTPException(status_code=400, detail="舊密碼錯誤")
 
     # 5. 更新密碼
-    new_hashed_password = get_password_hash(req.new_password)
-    c.execute("UPDATE users SET password_hash = ? WHERE username = ?", (new_hashed_password, username))
-    conn.commit()
-    conn.close()
+    new_hashed_password = await get_password_hash(req.new_password)
+    await db.execute("UPDATE users SET password_hash = ? WHERE username = ?", (new_hashed_password, username))
 
     return {"message": "密碼修改成功"}
 
+# [新增] 依內容雜湊值找出已經存過的檔案 (檔案還在才算數)
+async def find_upload(content_hash: str) -> Optional[str]:
+    row = await db.fetchone("SELECT extension FROM uploads WHERE hash = ?", (content_hash,))
+    if not row:
+        return None
+    stored_filename = f"{content_hash}.{row[0]}"
+    if not os.path.exists(os.path.join(UPLOAD_DIR, stored_filename)):
+        return None
+    return stored_filename
+
+# [新增] 還在背景產生 .gz 的任務
+precompress_tasks: set = set()
+
+def precompress_done(task: asyncio.Task, path: str):
+    precompress_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"預先壓縮失敗 ({os.path.basename(path)}): {task.exception()}")
+
+async def store_upload(tmp_path, content_hash, size, extension):
+    """
+    [新增] 收完的暫存檔：已經存過一樣的內容就丟掉，否則搬進 UPLOAD_DIR 並登記
+    回傳 (網址, 結果)，結果是 "duplicate" 或 "stored"
+    """
+    # 已經存過一樣的內容：丟掉暫存檔，直接回傳原本的網址
+    stored_filename = await find_upload(content_hash)
+    if stored_filename:
+        await run_in_threadpool(os.remove, tmp_path)
+        # 以前的縮圖沒產生成功的話，趁這次補做
+        media_previews.schedule(content_hash, stored_filename.split(".")[-1])
+        return f"/static/uploads/{stored_filename}", "duplicate"
+
+    # 用內容雜湊值當檔名
+    stored_filename = f"{content_hash}.{extension}"
+    file_path = os.path.join(UPLOAD_DIR, stored_filename)
+
+    # 儲存檔案 (暫存檔直接改名，不必再複製一次)
+    await run_in_threadpool(os.replace, tmp_path, file_path)
+    await db.execute("INSERT OR REPLACE INTO uploads (hash, size, extension, created) VALUES (?, ?, ?, ?)",
+                     (content_hash, size, extension, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+    # [新增] 在背景產生縮圖 (圖片) 或封面 (影片)
+    media_previews.schedule(content_hash, extension)
+    # [新增] 壓縮效果好的類型，在背景產生 .gz 版本
+    if extension in PRECOMPRESS_EXTENSIONS:
+        # [修改] 保留任務的參考 (事件迴圈只存弱參考，不保留可能還沒跑完就被回收)，結束時再移除
+        task = asyncio.create_task(run_in_threadpool(precompress, file_path))
+        precompress_tasks.add(task)
+        task.add_done_callback(lambda t: precompress_done(t, file_path))
+    return f"/static/uploads/{stored_filename}", "stored"
+
 # [新增] 專門處理圖片上傳的 API
 # 前端會用 Form Data (multipart/form-data) 傳送檔案到這裡
+# [修改] 不再用 UploadFile 一次讀進記憶體，而是邊收邊寫到暫存檔，收完再原子性地搬進 UPLOAD_DIR
+# [修改] 檔名改用內容的 SHA-256，同樣的檔案只存一份，網址也可以永久快取
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(request: Request, sha256: Optional[str] = None):
+    # [新增] 監控用：耗時與結果
+    started = time.perf_counter()
+    result = "failed"
     try:
-        # 允許的副檔名類型
-        allowed_extensions = ["jpg", "jpeg", "png", "gif", "pdf", "doc", "docx", "zip", "rar","mp4", "webm", "heic"]
-
-        # 取得副檔名
-        filename_ext = file.filename.split(".")[-1].lower()
-        if filename_ext not in allowed_extensions:
-            raise HTTPException(status_code=400, detail="不支援的檔案類型")
-
-        # [新增] 檢查檔案大小
-        # UploadFile 是 SpooledTemporaryFile，我們可以移到檔案尾端看大小
-        file.file.seek(0, 2) # 移到檔案最後面
-        file_size = file.file.tell() # 取得目前位置 (即檔案大小)
-        file.file.seek(0) # 記得移回檔案最前面，不然等下 read() 會讀不到東西！
-
-        if file_size > MAX_FILE_SIZE:
-            # 轉換成 MB 顯示錯誤訊息比較好讀
-            size_in_mb = MAX_FILE_SIZE / (1024 * 1024)
-            raise HTTPException(status_code=400, detail=f"檔案過大，限制為 {int(size_in_mb)}MB")
-
-        # 產生亂碼檔名
-        unique_filename = f"{uuid.uuid4()}.{filename_ext}"
-        file_path = os.path.join(UPLOAD_DIR, unique_filename)
-
-        # 儲存檔案
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        # [新增] 前端先算好雜湊值的話，已經有的檔案連內容都不必收
+        if sha256 and re.fullmatch(r"[0-9a-f]{64}", sha256):
+            stored_filename = await find_upload(sha256)
+            if stored_filename:
+                result = "known_hash"
+                return {"url": f"/static/uploads/{stored_filename}"}
+
+        # [新增] 有 Content-Length 的話，明顯太大的請求連讀都不用讀
+        # (multipart 的邊界與標頭會多出一點點，所以留 64KB 的餘裕)
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_FILE_SIZE + 64 * 1024:
+            raise HTTPException(status_code=400, detail=size_limit_message(MAX_FILE_SIZE))
+
+        # 邊收邊檢查副檔名與大小
+        try:
+            received = await receive_upload(request, UPLOAD_TMP_DIR, "file", MAX_FILE_SIZE, ALLOWED_EXTENSIONS)
+        except UploadError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        upload_bytes.inc(received.size)
 
-        return {"url": f"/static/uploads/{unique_filename}"}
+        # [修改] 存檔 (與分段上傳共用)
+        url, result = await store_upload(received.path, received.sha256, received.size, received.extension)
+        received.path = None
+        return {"url": url}
 
     except HTTPException as he:
+        if he.status_code == 400:
+            result = "rejected"
         raise he # 如果是我們自己拋出的 HTTP 錯誤，直接往外丟
     except Exception as e:
         print(f"Upload failed: {e}")
         raise HTTPException(status_code=500, detail="檔案上傳失敗")
+    finally:
+        uploads_total.labels(result).inc()
+        upload_seconds.observe(time.perf_counter() - started)
+
+# --- [新增] 可續傳的分段上傳 ---
+# 1. POST /uploads 建立上傳 (檔名、大小)，拿到 upload_id 與每段大小
+# 2. PUT /uploads/{upload_id}?offset=N 上傳一段 (body 就是檔案內容)，可以同時傳好幾段，失敗的段重傳即可
+# 3. GET /uploads/{upload_id} 查詢還缺哪幾段 (斷線或重新整理頁面後用來續傳)
+# 4. POST /uploads/{upload_id}/complete 收齊後驗證並存檔，回傳網址 (跟 /upload 一樣)
+# 放棄的上傳可以 DELETE，沒有 DELETE 的會在 UPLOAD_SESSION_TTL 之後被清掉
+# 全部都要登入 (跟 /ws 一樣的 Token)，每個上傳只有建立它的人能看到與操作
+
+def upload_session_path(upload_id):
+    return os.path.join(UPLOAD_TMP_DIR, f"session-{upload_id}.data")
+
+def chunk_count(size, chunk_size):
+    return (size + chunk_size - 1) // chunk_size
+
+def now_string(seconds_ago=0):
+    return (datetime.now() - timedelta(seconds=seconds_ago)).strftime("%Y-%m-%d %H:%M:%S")
+
+async def get_upload_session(upload_id, username):
+    """回傳 (filename, extension, size, chunk_size, sha256, state)，找不到 (或不是自己的) 就回 404"""
+    row = await db.read(get_session, upload_id)
+    if not row or row[6] != username:
+        raise HTTPException(status_code=404, detail="找不到這個上傳 (可能已經過期)")
+    return row[:6]
+
+async def discard_upload_session(upload_id):
+    await db.write(delete_session, upload_id)
+    path = upload_session_path(upload_id)
+    if os.path.exists(path):
+        await run_in_threadpool(os.remove, path)
+
+@app.post("/uploads")
+async def create_upload_session(body: UploadSessionCreate, username: str = Depends(get_current_user)):
+    extension = body.filename.split(".")[-1].lower()
+    if extension not in ALLOWED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="不支援的檔案類型")
+    max_size = MAX_LARGE_FILE_SIZE if extension in LARGE_FILE_EXTENSIONS else MAX_FILE_SIZE
+    if body.size <= 0:
+        raise HTTPException(status_code=400, detail="檔案是空的")
+    if body.size > max_size:
+        raise HTTPException(status_code=400, detail=size_limit_message(max_size))
+
+    sha256 = body.sha256.lower() if body.sha256 else None
+    if sha256 and not re.fullmatch(r"[0-9a-f]{64}", sha256):
+        raise HTTPException(status_code=400, detail="sha256 格式錯誤")
+    # 已經有一樣的檔案就不必上傳
+    if sha256:
+        stored_filename = await find_upload(sha256)
+        if stored_filename:
+            uploads_total.labels("known_hash").inc()
+            return {"url": f"/static/uploads/{stored_filename}"}
+
+    # [修改] 上限在建立的同一個交易裡檢查，多個請求 (或 worker) 同時建立也不會超過
+    upload_id = secrets.token_hex(16)
+    refused = await db.write(create_session, upload_id, username, body.filename, extension, body.size,
+                             UPLOAD_CHUNK_SIZE, sha256, now_string(),
+                             MAX_UPLOAD_SESSIONS, MAX_UPLOAD_SESSIONS_PER_USER)
+    if refused == "owner_limit":
+        raise HTTPException(status_code=429, detail="同時進行中的上傳太多，請先等其他檔案傳完")
+    if refused == "busy":
+        raise HTTPException(status_code=503, detail="目前上傳人數過多，請稍後再試")
+    try:
+        await run_in_threadpool(create_session_file, upload_session_path(upload_id), body.size)
+    except Exception:
+        await discard_upload_session(upload_id)
+        raise
+    upload_sessions_total.labels("created").inc()
+    return {"upload_id": upload_id, "chunk_size": UPLOAD_CHUNK_SIZE,
+            "chunk_count": chunk_count(body.size, UPLOAD_CHUNK_SIZE)}
+
+@app.get("/uploads/{upload_id}")
+async def get_upload_progress(upload_id: str, username: str = Depends(get_current_user)):
+    _, _, size, chunk_size, _, state = await get_upload_session(upload_id, username)
+    total = chunk_count(size, chunk_size)
+    missing = await db.read(missing_chunks, upload_id, total)
+    return {"upload_id": upload_id, "size": size, "chunk_size": chunk_size, "chunk_count": total,
+            "missing": missing, "state": state}
+
+@app.put("/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request, offset: int = 0, username: str = Depends(get_current_user)):
+    _, _, size, chunk_size, _, _ = await get_upload_session(upload_id, username)
+    # 每一段都要從 chunk_size 的整數倍開始，長度是 chunk_size (最後一段可以比較短)
+    if offset < 0 or offset >= size or offset % chunk_size:
+        raise HTTPException(status_code=400, detail="offset 錯誤")
+    chunk = offset // chunk_size
+    length = min(chunk_size, size - offset)
+
+    # [修改] 先登記「正在寫」(上傳已經在完成中就拒絕)，完成上傳的請求會等登記的分段都寫完才算雜湊值
+    writer = secrets.token_hex(8)
+    if not await db.write(begin_chunk, upload_id, writer, now_string()):
+        raise HTTPException(status_code=409, detail="這個上傳已經在完成中")
+    received = None
+    try:
+        await write_chunk(request, upload_session_path(upload_id), offset, length)
+        received = chunk
+    except UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="找不到這個上傳 (可能已經過期)")
+    finally:
+        # 客戶端中途斷線 (請求被取消) 也一定要取消登記，不然完成上傳的請求會一直等
+        await asyncio.shield(db.write(end_chunk, upload_id, writer, received, now_string()))
+    upload_bytes.inc(length)
+    return {"chunk": chunk}
+
+async def wait_for_chunk_writers(upload_id) -> bool:
+    """等還在寫的分段都結束，等太久回傳 False"""
+    deadline = time.monotonic() + UPLOAD_COMPLETE_WAIT
+    while await db.read(active_writers, upload_id, now_string(UPLOAD_WRITER_STALE)):
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.1)
+    return True
+
+@app.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, username: str = Depends(get_current_user)):
+    started = time.perf_counter()
+    result = "failed"
+    try:
+        _, extension, size, chunk_size, expected_hash, _ = await get_upload_session(upload_id, username)
+        # [修改] 先把狀態改成 completing (之後的分段都會被拒絕)，再等已經在寫的分段寫完
+        if not await db.write(claim_session, upload_id):
+            raise HTTPException(status_code=409, detail="這個上傳已經在完成中")
+        try:
+            if not await wait_for_chunk_writers(upload_id):
+                raise HTTPException(status_code=409, detail="還有分段正在上傳，請稍後再試")
+            missing = await db.read(missing_chunks, upload_id, chunk_count(size, chunk_size))
+            if missing:
+                raise HTTPException(status_code=409, detail=f"還有 {len(missing)} 段還沒上傳")
+        except BaseException:
+            await db.write(release_session, upload_id)
+            raise
+
+        path = upload_session_path(upload_id)
+        try:
+            # 各段已經寫在正確的位置，整個檔案讀一遍算雜湊值就好
+            content_hash = await run_in_threadpool(file_sha256, path)
+            if expected_hash and content_hash != expected_hash:
+                await discard_upload_session(upload_id)
+                raise HTTPException(status_code=400, detail="檔案內容與 sha256 不符，請重新上傳")
+            url, result = await store_upload(path, content_hash, size, extension)
+            await db.write(delete_session, upload_id)
+        except HTTPException:
+            raise
+        except Exception:
+            # 讓客戶端可以再試一次完成
+            await db.write(release_session, upload_id)
+            raise
+        upload_sessions_total.labels("completed").inc()
+        return {"url": url}
+    except HTTPException as he:
+        if he.status_code < 500:
+            result = "rejected"
+        raise he
+    except Exception as e:
+        print(f"Upload failed: {e}")
+        raise HTTPException(status_code=500, detail="檔案上傳失敗")
+    finally:
+        uploads_total.labels(result).inc()
+        upload_seconds.observe(time.perf_counter() - started)
+
+@app.delete("/uploads/{upload_id}")
+async def abort_upload(upload_id: str, username: str = Depends(get_current_user)):
+    _, _, _, _, _, state = await get_upload_session(upload_id, username)
+    if state != "open":
+        raise HTTPException(status_code=409, detail="這個上傳已經在完成中")
+    await discard_upload_session(upload_id)
+    upload_sessions_total.labels("aborted").inc()
+    return {"message": "已取消上傳"}
+
+async def expire_upload_sessions():
+    """[新增] 清掉太久沒有動靜的分段上傳，以及沒有對應紀錄的暫存檔"""
+    cutoff = datetime.now() - timedelta(seconds=UPLOAD_SESSION_TTL)
+    for upload_id in await db.read(expired_sessions, cutoff.strftime("%Y-%m-%d %H:%M:%S")):
+        await discard_upload_session(upload_id)
+        upload_sessions_total.labels("expired").inc()
+
+    # 建立到一半就當掉之類的情況：檔案還在，紀錄已經不在
+    # [新增] /upload 收到一半就當掉留下的 .part 也一起清掉 (正常的上傳幾分鐘內就會收完)
+    known = {row[0] for row in await db.fetchall("SELECT id FROM upload_sessions")}
+    part_cutoff = time.time() - UPLOAD_PART_TTL
+    for name in await run_in_threadpool(os.listdir, UPLOAD_TMP_DIR):
+        path = os.path.join(UPLOAD_TMP_DIR, name)
+        if name.startswith("session-"):
+            stale = (name[len("session-"):-len(".data")] not in known
+                     and os.path.getmtime(path) < cutoff.timestamp())
+        else:
+            stale = name.endswith(".part") and os.path.getmtime(path) < part_cutoff
+        if stale:
+            await run_in_threadpool(os.remove, path)
+
+async def upload_gc_worker():
+    while True:
+        try:
+            await expire_upload_sessions()
+        except Exception as e:
+            print(f"清理分段上傳失敗: {e}")
+        await asyncio.sleep(UPLOAD_GC_INTERVAL)
 
 # --- WebSocket 路由 (聊天室核心) ---
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, token: str = Query(None)):
+async def websocket_endpoint(websocket: WebSocket, token: str = Query(None), last_id: Optional[int] = Query(None),
+                             room: str = Query(DEFAULT_ROOM), heartbeat: bool = Query(False)):
     # 注意：這裡將 nickname 改為接收 token
+    # [新增] last_id：斷線重連的客戶端帶上最後看到的訊息 id，只補傳差異
+    # [新增] room：要進入的聊天室 (每條連線一次只在一個聊天室)
+    # [新增] heartbeat：客戶端會回應 {"type":"ping"} (沒帶的舊版客戶端不會收到 ping，也不會因為沒回 pong 被回收)
 
     if token is None:
         await websocket.close(code=4003, reason="Token missing")
@@ -483,41 +1783,80 @@ async def websocket_endpoint(websocket: WebSocket, token: str = Query(None)):
         await websocket.close(code=4003, reason="Invalid token")
         return
 
+    if not ROOM_ID_PATTERN.match(room):
+        await websocket.close(code=ROOM_CLOSE_CODE, reason="Invalid room")
+        return
+    # [新增] 第一次有人進這個聊天室時才載入它的歷史訊息
+    history = await room_histories.load(room, load_room_history)
+
     # 2. 嘗試連線
     # [核心修改] 接收回傳值：is_replaced (是否為取代舊連線)
-    is_replaced = await manager.connect(websocket, username)
+    # [新增] previous_room：被取代的舊連線原本在哪個聊天室
+    is_replaced, previous_room = await manager.connect(websocket, username, room, heartbeat)
 
     # 連線成功後，傳送歷史訊息
-    history = get_recent_messages()
+    # [修改] 直接送出記憶體裡已序列化好的 history 訊框，不用查資料庫
     # 我們定義一個新的類型 'history'
-    await websocket.send_text(json.dumps({"type": "history", "messages": history}))
+    # [新增] 有帶 last_id 且缺口不大時，只送 'history_delta' (新訊息 + 被刪除的 id)
+    # [修改] 一併記下這份歷史訊息涵蓋到哪個 id，已經包含的訊息稍後的廣播就不再重送
+    delta = history.delta_since(last_id) if last_id is not None else None
+    if delta is not None:
+        manager.send_history(websocket, delta, history.last_id)
+    else:
+        manager.send_history(websocket, history.history_frame(), history.last_id)
 
     # [核心修改] 只有在「不是」取代舊連線的情況下，才廣播加入訊息
-    if not is_replaced:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
+    # [新增] 換了聊天室的重新連線：在舊聊天室廣播離開、新聊天室廣播加入 (成員名單不變)
+    if previous_room is not None and previous_room != room:
+        enqueue_system_message(f"{username} 離開了聊天室", previous_room)
+        await manager.broadcast({"type": "system", "message": f"{username} 離開了聊天室"}, previous_room)
+    if not is_replaced or (previous_room is not None and previous_room != room):
         # 存入資料庫
-        message_queue.put_nowait(("系統", f"{username} 加入了聊天室", timestamp, "system", None))
+        enqueue_system_message(f"{username} 加入了聊天室", room)
         
         # 廣播
-        await manager.broadcast({"type": "system", "message": f"{username} 加入了聊天室"})
-    # 無論是新連線還是取代舊連線，都廣播最新的成員名單
-    await manager.broadcast({"type": "member_list_update", "members": manager.get_member_list()})
+        await manager.broadcast({"type": "system", "message": f"{username} 加入了聊天室"}, room)
+    if not is_replaced:
+        # [修改] 其他人只會收到合併後的差異 (joined/left)，不再廣播完整名單
+        manager.presence_joined(username)
+    # [修改] 完整的成員名單只送給剛連線的這個人
+    # 名單是已經廣播出去的狀態，時間窗裡還沒送出的差異之後一樣會收到
+    manager.send_personal(websocket, {"type": "member_list_update", "members": manager.member_snapshot(username)})
 
     try:
         while True:
-            data = await websocket.receive_text()
+            try:
+                data = await websocket.receive_text()
+            except RuntimeError:
+                # [新增] 伺服器這邊已經主動關閉連線 (重複登入、太慢、洗版)，一樣走斷線處理
+                raise WebSocketDisconnect()
+
+            # [新增] 任何訊框都代表對方還活著；pong 只是心跳回覆，不必往下處理
+            manager.touch(websocket)
+            if data == PONG_MESSAGE:
+                continue
 
             # --- [新增] 訊息長度檢查 ---
             if len(data) > MAX_MSG_LENGTH:
                 # 選擇性：可以回傳一個系統訊息警告使用者
-                warning_msg = json.dumps({
+                warning_msg = {
                     "type": "system", 
                     "message": f"訊息過長 (超過 {MAX_MSG_LENGTH} 字)，傳送失敗。"
-                })
-                await websocket.send_text(warning_msg)
+                }
+                manager.send_personal(websocket, warning_msg)
                 continue # 跳過這次迴圈，不處理這則訊息
             # --------------------------
+
+            # [新增] 洗版檢查：超過速率的訊息不寫入也不廣播
+            verdict = flood_control.check(username)
+            if verdict != "ok":
+                if verdict == "warn":
+                    manager.send_personal(websocket, {"type": "system", "message": "訊息傳送太快，請稍後再試。"})
+                elif verdict == "busy":
+                    manager.send_personal(websocket, {"type": "system", "message": "聊天室目前訊息太多，這則訊息沒有送出，請稍後再試。"})
+                elif verdict == "kick":
+                    manager.close(websocket, FLOOD_CLOSE_CODE, "Flooding")
+                continue
             try:
                 parsed = json.loads(data)
 
@@ -535,8 +1874,11 @@ async def websocket_endpoint(websocket: WebSocket, token: str = Query(None)):
                     image_url = parsed.get("imageData")
 
                     if image_url:
+                        # [新增] 等一下剛上傳的圖片縮圖 (寫入前先等，記憶體緩衝區裡的訊息才會帶縮圖)
+                        preview = await media_previews.wait_for(image_url, PREVIEW_WAIT_SECONDS)
+
                         # 丟進佇列 (Tuple 格式要跟 worker 對應)
-                        message_id = save_message(username, image_url, timestamp, "image", None)
+                        message_id = await save_message(username, image_url, timestamp, "image", None, room)
                         
                         # 2. 廣播給所有人 (包含傳送者)
                         await manager.broadcast({
@@ -544,14 +1886,15 @@ async def websocket_endpoint(websocket: WebSocket, token: str = Query(None)):
                             "nickname": username,
                             "imageData": image_url, # 這裡廣播網址
                             "time": timestamp,
-                            "id": message_id
-                        })
+                            "id": message_id,
+                            **(preview or {})
+                        }, room)
                 elif msg_type == "file":
                     file_url = parsed.get("imageData")  # 雖然是檔案，但欄位仍用 imageData
                     filename = parsed.get("filename", "附件")
 
                     if file_url:
-                        message_id = save_message(username, file_url, timestamp, "file", filename)
+                        message_id = await save_message(username, file_url, timestamp, "file", filename, room)
                         await manager.broadcast({
                             "type": "file",
                             "nickname": username,
@@ -559,97 +1902,84 @@ async def websocket_endpoint(websocket: WebSocket, token: str = Query(None)):
                             "filename": filename,
                             "time": timestamp,
                             "id": message_id
-                        })
+                        }, room)
                 elif msg_type == "video":
                     video_url = parsed.get("imageData")
                     filename = parsed.get("filename", "影片")
 
                     if video_url:
-                        message_id = save_message(username, video_url, timestamp, "video", filename)
+                        preview = await media_previews.wait_for(video_url, PREVIEW_WAIT_SECONDS)
+                        message_id = await save_message(username, video_url, timestamp, "video", filename, room)
                         await manager.broadcast({
                             "type": "video",
                             "nickname": username,
                             "imageData": video_url,
                             "filename": filename,
                             "time": timestamp,
-                            "id": message_id
-                        })
+                            "id": message_id,
+                            **(preview or {})
+                        }, room)
 
                 else:
                     # 一般文字訊息
-                    message_id = save_message(username, data, timestamp, "text", None)
+                    message_id = await save_message(username, data, timestamp, "text", None, room)
                     await manager.broadcast({
                         "type": "chat",
                         "nickname": username,
                         "message": data,
                         "time": timestamp,
                         "id": message_id  # 加入 id
-                    })
+                    }, room)
 
             # [修改] 除了 JSONDecodeError，也要捕捉 ValueError (我們剛剛手動引發的) 或 AttributeError
             except (json.JSONDecodeError, ValueError, AttributeError) as e:
                 # 錯誤處理
                 timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 # 這裡將 data (原始字串) 當作純文字訊息儲存
-                message_id = save_message(username, data, timestamp, "text", None)
+                message_id = await save_message(username, data, timestamp, "text", None, room)
                 await manager.broadcast({
                     "type": "chat",
                     "nickname": username,
                     "message": data,
                     "time": timestamp,
                     "id": message_id  # 加入 id
-                })
+                }, room)
             
     except WebSocketDisconnect:
         nickname_left = manager.disconnect(websocket) # 斷線處理
+        flood_control.release(username)
 
         # 只有當 disconnect 回傳有值時，才代表是「使用者自己斷線/關閉網頁」
         # 如果回傳 None，代表它是「被踢掉的舊連線」，我們就不廣播離開訊息
         if nickname_left:
-            # 處理離開訊息
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            # 存入資料庫
-            message_queue.put_nowait(("系統", f"{nickname_left} 離開了聊天室", timestamp, "system", None))
-
-            # 廣播離開訊息
-            await manager.broadcast({"type": "system", "message": f"{nickname_left} 離開了聊天室"})
-            await manager.broadcast({"type": "member_list_update", "members": manager.get_member_list()})
+            # 處理離開訊息 (存入資料庫 + 廣播)
+            await announce_leave(nickname_left, room)
 
 @app.post("/delete-message")
-async def delete_message(id: int, authorization: str = Header(None)):
-    # 1. 取出使用者
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="未登入或 Token 無效")
-
-    token = authorization.split(" ")[1]
-    username = get_current_user_from_token(token)
-    if not username:
-        raise HTTPException(status_code=401, detail="Token 無效或過期")
-
-    # 2. 查詢此訊息是否存在 + 是否屬於該使用者
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT nickname FROM messages WHERE id = ?", (id,))
-    row = c.fetchone()
+async def delete_message(id: int, username: str = Depends(get_current_user)):
+    # 1. 取出使用者 ([修改] 由共用元件驗證 Token)
+    # 2. 查詢此訊息是否存在 + 是否屬於該使用者，是的話刪除
+    # [修改] 已經封存的訊息也找得到 (翻頁時還看得到，所以也要能刪)
+    row = await db.write(delete_message_row, id, username)
 
     if not row:
-        conn.close()
         raise HTTPException(status_code=404, detail="找不到該訊息")
 
     if row[0] != username:
-        conn.close()
         raise HTTPException(status_code=403, detail="只能刪除自己的訊息")
 
-    # 3. 更新 is_deleted 為 1
-    c.execute("UPDATE messages SET is_deleted = 1 WHERE id = ?", (id,))
-    conn.commit()
-    conn.close()
+    # [修改] 只需要通知該聊天室
+    room = row[1]
+    room_histories.remove(room, id)
+    backplane.publish("history_remove", {"room": room, "id": id})
     await manager.broadcast({
         "type": "delete",
         "id": id
-    })
+    }, room)
     return {"message": "刪除成功"}
 
 # 允許在 Python 腳本中直接執行
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
+    # [新增] 協定層的心跳 (所有客戶端都會自動回應)
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True,
+                ws_ping_interval=HEARTBEAT_INTERVAL, ws_ping_timeout=HEARTBEAT_TIMEOUT)
\ No newline at end of file
@@ -0,0 +1,157 @@
+# media.py
+# 上傳後在背景產生縮圖 (圖片) 與封面 (影片)，聊天室與歷史訊息只載入小圖，放大時才載入原檔
+import os
+import shutil
+import asyncio
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Dict, Optional
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 沒裝 Pillow 就不產生縮圖，前端會直接顯示原檔
+    Image = None
+
+IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "heic"}
+VIDEO_EXTENSIONS = {"mp4", "webm"}
+
+
+# --- 在子行程裡執行的函式 (必須是模組層級才能被 pickle) ---
+def _save_thumbnail(image, dest: str, max_side: int) -> dict:
+    width, height = image.size
+    image.thumbnail((max_side, max_side))
+    # JPEG 沒有透明度，透明背景改成白色
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    image.save(dest, "JPEG", quality=80, optimize=True, progressive=True)
+    return {"width": width, "height": height, "thumb_width": image.width, "thumb_height": image.height}
+
+def make_image_thumbnail(src: str, dest: str, max_side: int) -> Optional[dict]:
+    with Image.open(src) as image:
+        # 動畫 GIF 縮成一張靜態圖會失去動畫，這種就直接顯示原檔
+        if getattr(image, "is_animated", False):
+            return None
+        # 依照手機拍照的 EXIF 方向轉正
+        image = ImageOps.exif_transpose(image)
+        return _save_thumbnail(image, dest, max_side)
+
+def make_video_poster(src: str, dest: str, max_side: int) -> Optional[dict]:
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        return None
+    fd, frame_path = tempfile.mkstemp(suffix=".png")
+    os.close(fd)
+    try:
+        # 取第 1 秒的畫面 (太短的影片就取第一格)
+        for seek in ("1", "0"):
+            subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-ss", seek, "-i", src,
+                            "-frames:v", "1", frame_path],
+                           check=False, timeout=30, capture_output=True)
+            if os.path.getsize(frame_path) > 0:
+                break
+        else:
+            return None
+        with Image.open(frame_path) as image:
+            return _save_thumbnail(image, dest, max_side)
+    finally:
+        os.remove(frame_path)
+
+
+class MediaPreviews:
+    """
+    管理縮圖的產生 (行程池) 與查詢 (記憶體索引，以內容雜湊值為 key)
+    """
+    def __init__(self, upload_dir: str, thumb_dir: str, url_prefix: str,
+                 workers: int = 1, max_side: int = 480):
+        self.upload_dir = upload_dir
+        self.thumb_dir = thumb_dir
+        # 對外的網址前綴，例如 /static/uploads
+        self.url_prefix = url_prefix
+        self.workers = workers
+        self.max_side = max_side
+        self.enabled = Image is not None
+        # 內容雜湊值: {"thumbnail": 網址, "width", "height", "thumb_width", "thumb_height"}
+        self.previews: Dict[str, dict] = {}
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # 產生完成後的回呼 (用來寫進資料庫)
+        self.on_ready: Optional[Callable[[str, dict], Awaitable[None]]] = None
+
+    def start(self):
+        if not os.path.exists(self.thumb_dir):
+            os.makedirs(self.thumb_dir)
+        if self.enabled:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        for task in self._pending.values():
+            task.cancel()
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    def load(self, content_hash: str, preview: dict):
+        self.previews[content_hash] = preview
+
+    @staticmethod
+    def hash_from_url(url: str) -> Optional[str]:
+        # 上傳檔案的網址是 /static/uploads/<雜湊值>.<副檔名>
+        if not isinstance(url, str):
+            return None
+        return url.rsplit("/", 1)[-1].split(".")[0] or None
+
+    def lookup(self, url: str) -> Optional[dict]:
+        """依原檔網址找縮圖資訊 (還沒產生或不支援就回傳 None)"""
+        content_hash = self.hash_from_url(url)
+        return self.previews.get(content_hash) if content_hash else None
+
+    def schedule(self, content_hash: str, extension: str):
+        """上傳完成後呼叫：在背景產生縮圖"""
+        if not self._executor or content_hash in self.previews or content_hash in self._pending:
+            return
+        if extension in IMAGE_EXTENSIONS:
+            fn = make_image_thumbnail
+        elif extension in VIDEO_EXTENSIONS:
+            fn = make_video_poster
+        else:
+            return
+        task = asyncio.create_task(self._generate(fn, content_hash, extension))
+        self._pending[content_hash] = task
+
+    async def _generate(self, fn, content_hash: str, extension: str):
+        src = os.path.join(self.upload_dir, f"{content_hash}.{extension}")
+        thumb_name = f"{content_hash}.jpg"
+        try:
+            info = await asyncio.get_running_loop().run_in_executor(
+                self._executor, fn, src, os.path.join(self.thumb_dir, thumb_name), self.max_side)
+            if not info:
+                return
+            preview = {"thumbnail": f"{self.url_prefix}/thumbs/{thumb_name}", **info}
+            self.previews[content_hash] = preview
+            if self.on_ready:
+                await self.on_ready(content_hash, preview)
+        except Exception as e:
+            print(f"縮圖產生失敗 ({content_hash}.{extension}): {e}")
+        finally:
+            self._pending.pop(content_hash, None)
+
+    async def wait_for(self, url: str, timeout: float) -> Optional[dict]:
+        """廣播前稍微等一下剛上傳的檔案縮圖，等不到就先送原檔"""
+        content_hash = self.hash_from_url(url)
+        if not content_hash:
+            return None
+        task = self._pending.get(content_hash)
+        if task:
+            try:
+                await asyncio.wait_for(asyncio.shield(task), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.previews.get(content_hash)
@@ -0,0 +1,79 @@
+# password_pool.py
+# bcrypt 很慢 (每次數十到數百毫秒)，放在獨立的行程池裡算，才不會卡住 event loop 上的 WebSocket
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from passlib.context import CryptContext
+
+# 密碼雜湊器 (用來把密碼加密，不要存明碼！)
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+# --- 在子行程裡執行的函式 (必須是模組層級才能被 pickle) ---
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+class PasswordPoolBusy(Exception):
+    """排隊的雜湊工作已經太多，呼叫端應該直接回 503"""
+
+
+class PasswordPool:
+    """
+    有上限的 bcrypt 行程池：同時最多 workers 個在算，最多再排 queue_limit 個
+    超過的請求立刻丟 PasswordPoolBusy，不讓整台伺服器一起變慢
+    """
+    def __init__(self, workers: int = 2, queue_limit: int = 32):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # 目前「在算 + 在排隊」的數量
+        self.pending = 0
+        # 統計數據
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+
+    def start(self):
+        # 用 spawn 建立子行程，不會複製父行程裡的資料庫連線與執行緒
+        self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        self._semaphore = asyncio.Semaphore(self.workers)
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        self._executor = None
+
+    async def _submit(self, fn, *args):
+        if self.pending >= self.workers + self.queue_limit:
+            self.rejected += 1
+            raise PasswordPoolBusy()
+        self.pending += 1
+        queued_at = time.perf_counter()
+        try:
+            async with self._semaphore:
+                started_at = time.perf_counter()
+                result = await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+                elapsed = time.perf_counter() - started_at
+            self.completed += 1
+            self.total_wait += started_at - queued_at
+            self.total_run += elapsed
+            self.max_run = max(self.max_run, elapsed)
+            return result
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._submit(_verify, plain_password, hashed_password)
@@ -0,0 +1,61 @@
+# presence.py
+# 上線/離線差異的合併：一個時間窗內的變動只廣播一次 presence_update
+# 所有客戶端的成員名單 = 最後一次廣播出去的狀態 (announced) + 之後收到的差異
+# 所以剛連線的人拿到的完整名單也必須是 announced，而不是「現在」的狀態，
+# 否則時間窗內發生、最後互相抵銷的變動會讓他的名單跟別人不一樣
+from typing import Dict, Iterable, List, Optional
+
+
+class PresenceDiff:
+    def __init__(self):
+        # 已經廣播出去 (所有客戶端都知道) 的本機線上成員
+        self.announced: set = set()
+        # 這個時間窗內每位成員最後的狀態 (True = 上線)
+        self._pending: Dict[str, bool] = {}
+
+    def joined(self, nickname: str):
+        self._pending[nickname] = True
+
+    def left(self, nickname: str):
+        self._pending[nickname] = False
+
+    def adopt(self, nickname: str):
+        """從其他 worker 接手的連線：客戶端早就知道他在線上，不必再廣播上線"""
+        self._pending.pop(nickname, None)
+        self.announced.add(nickname)
+
+    def forget(self, nickname: str):
+        """被其他 worker 接手的連線：之後由那個 worker 負責廣播他離線"""
+        self._pending.pop(nickname, None)
+        self.announced.discard(nickname)
+
+    def snapshot(self, extra: Iterable[str] = ()) -> List[str]:
+        """給剛連線的客戶端的完整名單 (之後的差異都以這份為基準)"""
+        return list(self.announced.union(extra))
+
+    def take(self) -> Optional[dict]:
+        """
+        時間窗結束時呼叫：跟 announced 比較後真的有變的才放進差異，並更新 announced
+        上線後又離線 (或離線後又上線) 的成員跟 announced 一樣，對任何客戶端都不算變動
+        沒有變動時回傳 None
+        """
+        joined = [name for name, online in self._pending.items() if online and name not in self.announced]
+        left = [name for name, online in self._pending.items() if not online and name in self.announced]
+        self._pending.clear()
+        if not joined and not left:
+            return None
+        self.announced.update(joined)
+        self.announced.difference_update(left)
+        return {"type": "presence_update", "joined": joined, "left": left}
+
+
+def merge_presence_updates(first: dict, second: dict) -> dict:
+    """
+    連續兩個 presence_update 合併成一個 (客戶端依序套用兩個的結果跟套用合併後的一樣)
+    先上線又離線 (或先離線又上線) 的成員互相抵銷
+    """
+    joined = [name for name in first["joined"] if name not in second["left"]]
+    joined += [name for name in second["joined"] if name not in first["left"]]
+    left = [name for name in first["left"] if name not in second["joined"]]
+    left += [name for name in second["left"] if name not in first["joined"]]
+    return {"type": "presence_update", "joined": joined, "left": left}
@@ -0,0 +1,102 @@
+# rate_limit.py
+# 洗版防護：每位使用者一個 token bucket，外加整個聊天室 (本 worker) 共用一個
+# 每收到一個訊框只做幾次浮點運算，不必開執行緒或查資料庫
+import time
+from typing import Dict, Set
+
+
+class TokenBucket:
+    """每秒補充 rate 個 token，最多存 burst 個；每則訊息花掉 cost 個"""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now: float, cost: float = 1) -> bool:
+        if not self.peek(now, cost):
+            return False
+        self.tokens -= cost
+        return True
+
+    def peek(self, now: float, cost: float = 1) -> bool:
+        """有沒有足夠的 token (不扣)"""
+        self._refill(now)
+        return self.tokens >= cost
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class FloodControl:
+    """
+    check() 的回傳值：
+    - "ok": 放行
+    - "warn": 這一則不處理，第一次超過時提醒使用者 (之後安靜丟掉，避免警告本身也洗版)
+    - "drop": 這一則不處理，不必再提醒
+    - "kick": 連續超過 max_strikes 次，應該斷線
+    - "busy": 使用者自己沒有超過，是整個聊天室的額度用完了：這一則不處理，提醒一次 (之後回傳 "drop")
+      不算使用者的違規次數，也不扣他自己的額度
+    """
+    def __init__(self, user_rate: float, user_burst: float,
+                 global_rate: float, global_burst: float, max_strikes: int):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_strikes = max_strikes
+        self.global_bucket = TokenBucket(global_rate, global_burst, time.monotonic())
+        self.buckets: Dict[str, TokenBucket] = {}
+        # 使用者連續被擋下的次數，放行一次就歸零
+        self.strikes: Dict[str, int] = {}
+        # 已經提醒過「聊天室太忙」的使用者，放行一次就移除
+        self.busy_notified: Set[str] = set()
+        # 統計數據
+        self.rejected = 0
+        self.kicked = 0
+        self.global_rejected = 0
+
+    def check(self, username: str, cost: float = 1) -> str:
+        now = time.monotonic()
+        bucket = self.buckets.get(username)
+        if bucket is None:
+            bucket = self.buckets[username] = TokenBucket(self.user_rate, self.user_burst, now)
+
+        if bucket.peek(now, cost):
+            # 使用者自己沒超過：整個聊天室滿了只丟掉這一則，不算他的違規
+            if not self.global_bucket.consume(now, cost):
+                self.global_rejected += 1
+                if username in self.busy_notified:
+                    return "drop"
+                self.busy_notified.add(username)
+                return "busy"
+            bucket.consume(now, cost)
+            self.strikes.pop(username, None)
+            self.busy_notified.discard(username)
+            return "ok"
+
+        self.rejected += 1
+        strikes = self.strikes.get(username, 0) + 1
+        self.strikes[username] = strikes
+        if strikes > self.max_strikes:
+            # 斷線前可能還會陸續收到幾則，只算一次
+            if strikes == self.max_strikes + 1:
+                self.kicked += 1
+            return "kick"
+        return "warn" if strikes == 1 else "drop"
+
+    def release(self, username: str):
+        """
+        連線結束時呼叫：桶子已經補滿的話，留著跟重新建立一樣，直接刪掉省記憶體
+        還沒補滿就留著，避免靠斷線重連來重置額度
+        """
+        bucket = self.buckets.get(username)
+        if bucket is not None and bucket.is_full(time.monotonic()):
+            del self.buckets[username]
+            self.strikes.pop(username, None)
+            self.busy_notified.discard(username)
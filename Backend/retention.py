@@ -0,0 +1,145 @@
+# retention.py
+# 訊息保留政策：清掉沒人會看的資料列、把舊訊息壓縮成封存區段，並逐步歸還磁碟空間
+# 每個函式只處理一小批，在 Database 的寫入執行緒上各自是一個短交易，聊天訊息的寫入只會被插隊一下
+import json
+import zlib
+from typing import List, Optional, Tuple
+
+# 封存區段裡每則訊息的欄位 (與 format_message_row 的順序相同)
+ARCHIVE_COLUMNS = "nickname, message, msg_type, timestamp, id, is_deleted, filename"
+
+
+def create_retention_schema(c):
+    """建立封存表與清理用的部分索引 (在 init_db 裡呼叫)"""
+    # 一個區段 = 同一個聊天室裡 id 連續的一段訊息，整段 JSON 壓縮後存成一個 BLOB
+    c.execute('''CREATE TABLE IF NOT EXISTS message_archive
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  room_id TEXT NOT NULL,
+                  first_id INTEGER NOT NULL,
+                  last_id INTEGER NOT NULL,
+                  message_count INTEGER NOT NULL,
+                  first_time TEXT,
+                  last_time TEXT,
+                  data BLOB NOT NULL)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_message_archive_room_last
+                 ON message_archive (room_id, last_id)''')
+    # 只收錄要被清掉的資料列，索引本身很小，清理時不必掃整張表
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_messages_deleted
+                 ON messages (id) WHERE is_deleted = 1''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_messages_system_time
+                 ON messages (timestamp) WHERE msg_type = 'system' ''')
+
+def enable_incremental_vacuum(conn, allow_vacuum: bool = False) -> str:
+    """
+    讓刪掉的頁面可以用 PRAGMA incremental_vacuum 分批歸還給檔案系統
+    新資料庫直接生效；既有的資料庫要整個 VACUUM 一次才能切換，
+    VACUUM 期間整個資料庫都被鎖住，所以只在 allow_vacuum 時才做 (當作一次性的維護步驟)
+    回傳 "enabled" (已經是或剛設定好)、"vacuumed" (這次做了 VACUUM) 或 "needs_vacuum" (還沒切換)
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return "enabled"
+    has_tables = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table'").fetchone()
+    if has_tables and not allow_vacuum:
+        # 沒切換也能用：清掉的頁面留在資料庫裡給之後的資料重複使用，只是檔案不會變小
+        return "needs_vacuum"
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    if not has_tables:
+        return "enabled"
+    conn.commit()
+    conn.execute("VACUUM")
+    return "vacuumed"
+
+def purge_deleted(conn, limit: int) -> int:
+    """真正刪除一批已經軟刪除的訊息，回傳刪除筆數"""
+    return conn.execute('''DELETE FROM messages WHERE id IN
+                           (SELECT id FROM messages WHERE is_deleted = 1 ORDER BY id LIMIT ?)''',
+                        (limit,)).rowcount
+
+def purge_system_messages(conn, before: str, limit: int) -> int:
+    """刪除一批 before (時間字串) 之前的加入/離開系統訊息，回傳刪除筆數"""
+    return conn.execute('''DELETE FROM messages WHERE id IN
+                           (SELECT id FROM messages WHERE msg_type = 'system' AND timestamp < ? LIMIT ?)''',
+                        (before, limit)).rowcount
+
+def pack_segment(rows: List[list]) -> bytes:
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+def archive_segment(conn, before: str, segment_size: int) -> int:
+    """
+    把最舊的聊天室裡 before 之前的訊息 (最多 segment_size 則) 搬進一個封存區段，回傳搬移筆數
+    訊息 id 與時間是一起遞增的，所以依 id 順序取，遇到第一則比 before 新的就停
+    (被封存的訊息不再出現在全文搜尋裡)
+    """
+    # 先拿到寫入鎖，多個 worker 同時跑也不會封存到同一批
+    conn.execute("BEGIN IMMEDIATE")
+    # 只看最舊的一則 (不用時間條件過濾，沒有可封存的訊息時才不會掃過整張表)
+    oldest = conn.execute("SELECT room_id, timestamp FROM messages WHERE is_deleted = 0 ORDER BY id LIMIT 1").fetchone()
+    if oldest is None or oldest[1] >= before:
+        return 0
+    room = oldest[0]
+    rows = []
+    for row in conn.execute(f'''SELECT {ARCHIVE_COLUMNS} FROM messages
+                                WHERE room_id = ? AND is_deleted = 0
+                                ORDER BY id LIMIT ?''', (room, segment_size)):
+        if row[3] >= before:
+            break
+        rows.append(list(row))
+    if not rows:
+        return 0
+
+    data = pack_segment(rows)
+    conn.execute('''INSERT INTO message_archive
+                    (room_id, first_id, last_id, message_count, first_time, last_time, data)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                 (room, rows[0][4], rows[-1][4], len(rows), rows[0][3], rows[-1][3], data))
+    conn.execute('''DELETE FROM messages WHERE room_id = ? AND is_deleted = 0 AND id BETWEEN ? AND ?''',
+                 (room, rows[0][4], rows[-1][4]))
+    return len(rows)
+
+def read_archive(conn, room: str, before_id: int, limit: int) -> List[list]:
+    """從封存區段取出某個聊天室 before_id 之前最新的 limit 則訊息 (由舊到新)"""
+    rows: List[list] = []
+    for (data,) in conn.execute('''SELECT data FROM message_archive
+                                   WHERE room_id = ? AND first_id < ?
+                                   ORDER BY last_id DESC''', (room, before_id)):
+        segment = [row for row in json.loads(zlib.decompress(data)) if row[4] < before_id]
+        rows = segment + rows
+        if len(rows) >= limit:
+            break
+    return rows[-limit:] if limit else []
+
+def remove_archived(conn, message_id: int, nickname: str) -> Optional[Tuple[str, str]]:
+    """
+    刪除封存區段裡的一則訊息 (只有發送者是 nickname 才真的刪)，回傳 (發送者, 聊天室)，找不到回傳 None
+    區段重新壓縮後寫回，刪到沒有訊息就整段移除
+    """
+    # 不同聊天室的區段 id 範圍會重疊，要解開才知道在哪一段
+    for segment_id, room, data in conn.execute('''SELECT id, room_id, data FROM message_archive
+                                                 WHERE first_id <= ? AND last_id >= ?''',
+                                              (message_id, message_id)).fetchall():
+        rows = json.loads(zlib.decompress(data))
+        found = [row for row in rows if row[4] == message_id]
+        if not found:
+            continue
+        owner = found[0][0]
+        if owner != nickname:
+            return owner, room
+        rows = [row for row in rows if row[4] != message_id]
+        if rows:
+            conn.execute('''UPDATE message_archive
+                            SET first_id = ?, last_id = ?, message_count = ?, first_time = ?, last_time = ?, data = ?
+                            WHERE id = ?''',
+                         (rows[0][4], rows[-1][4], len(rows), rows[0][3], rows[-1][3], pack_segment(rows), segment_id))
+        else:
+            conn.execute("DELETE FROM message_archive WHERE id = ?", (segment_id,))
+        return owner, room
+    return None
+
+def incremental_vacuum(conn, pages: int) -> int:
+    """歸還最多 pages 個空頁面給檔案系統，回傳實際歸還的頁面數"""
+    free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if not free_before:
+        return 0
+    # execute() 只會執行一步 (= 一個頁面)，要用 executescript 讓它一次做完
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    return free_before - conn.execute("PRAGMA freelist_count").fetchone()[0]
@@ -0,0 +1,103 @@
+# search.py
+# 訊息全文搜尋 (SQLite FTS5)
+# FTS5 內建的斷詞器不會切中文，所以在 Python 端先把文字轉成索引用的詞：
+# 英數字保留整個單字，連續的中日韓文字切成重疊的兩字一組 (bigram)
+import re
+from typing import List, Optional
+
+# 中日韓文字 (平假名/片假名、CJK 統一漢字與擴充 A、相容漢字、韓文)
+_CJK = "぀-ヿ㐀-䶿一-鿿豈-﫿가-힯"
+_TOKEN_RE = re.compile(f"[{_CJK}]+|[^\\W{_CJK}]+")
+_CJK_RE = re.compile(f"[{_CJK}]")
+
+# 會被索引的訊息：文字訊息的內容，檔案與影片的檔名
+SEARCH_TEXT_SQL = "CASE WHEN {row}.msg_type = 'text' THEN {row}.message ELSE {row}.filename END"
+SEARCHABLE_TYPES_SQL = "{row}.msg_type IN ('text', 'file', 'video')"
+
+
+def _runs(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower()) if text else []
+
+def _bigrams(run: str) -> List[str]:
+    if len(run) == 1:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+def search_tokens(text: Optional[str]) -> str:
+    """索引用的詞 (以空白分隔)，註冊成 SQL 函式給觸發器使用，必須是 deterministic"""
+    tokens = []
+    for run in _runs(text):
+        if _CJK_RE.match(run):
+            tokens.extend(_bigrams(run))
+        else:
+            tokens.append(run)
+    return " ".join(tokens)
+
+def build_match_query(query: str) -> Optional[str]:
+    """
+    把使用者輸入轉成 FTS5 的 MATCH 語法 (每一段都要符合，AND)
+    - 中文：bigram 組成的片語，相鄰位置才算符合，等同子字串比對；單一個字用前綴比對
+    - 英數字：前綴比對，打到一半也找得到
+    """
+    parts = []
+    for run in _runs(query):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                parts.append(f'"{run}"*')
+            else:
+                parts.append('"' + " ".join(_bigrams(run)) + '"')
+        else:
+            parts.append(f'"{run}"*')
+    return " ".join(parts) or None
+
+def register_sql_functions(conn):
+    """每條會寫入 messages 的連線都要註冊，觸發器才能呼叫 search_tokens()"""
+    conn.create_function("search_tokens", 1, search_tokens, deterministic=True)
+
+def create_search_index(c) -> bool:
+    """
+    建立 FTS5 索引與同步用的觸發器 (在 init_db 裡呼叫)
+    回傳 True 代表索引是這次新建的，呼叫端要回填既有的訊息
+    """
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'").fetchone()
+
+    # contentless：索引裡只存詞，不重複存一份訊息內容，rowid 就是 messages.id
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(tokens, content='')")
+
+    new_text = SEARCH_TEXT_SQL.format(row="new")
+    old_text = SEARCH_TEXT_SQL.format(row="old")
+    new_searchable = SEARCHABLE_TYPES_SQL.format(row="new")
+    old_searchable = SEARCHABLE_TYPES_SQL.format(row="old")
+
+    # 新增訊息
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+                  WHEN new.is_deleted = 0 AND {new_searchable}
+                  BEGIN
+                      INSERT INTO messages_fts (rowid, tokens) VALUES (new.id, search_tokens({new_text}));
+                  END''')
+    # 軟刪除 (is_deleted 0 -> 1)：從索引移除 (contentless 表要帶原本的詞才能刪)
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS messages_fts_soft_delete AFTER UPDATE OF is_deleted ON messages
+                  WHEN old.is_deleted = 0 AND new.is_deleted = 1 AND {old_searchable}
+                  BEGIN
+                      INSERT INTO messages_fts (messages_fts, rowid, tokens) VALUES ('delete', old.id, search_tokens({old_text}));
+                  END''')
+    # 取消刪除 (is_deleted 1 -> 0)：加回索引
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS messages_fts_restore AFTER UPDATE OF is_deleted ON messages
+                  WHEN old.is_deleted = 1 AND new.is_deleted = 0 AND {new_searchable}
+                  BEGIN
+                      INSERT INTO messages_fts (rowid, tokens) VALUES (new.id, search_tokens({new_text}));
+                  END''')
+    # 真的刪除資料列
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+                  WHEN old.is_deleted = 0 AND {old_searchable}
+                  BEGIN
+                      INSERT INTO messages_fts (messages_fts, rowid, tokens) VALUES ('delete', old.id, search_tokens({old_text}));
+                  END''')
+    return not exists
+
+def backfill_search_index(c):
+    """把建立索引之前就存在的訊息補進索引"""
+    c.execute(f'''INSERT INTO messages_fts (rowid, tokens)
+                  SELECT id, search_tokens({SEARCH_TEXT_SQL.format(row="messages")})
+                  FROM messages
+                  WHERE is_deleted = 0 AND {SEARCHABLE_TYPES_SQL.format(row="messages")}''')
@@ -0,0 +1,86 @@
+# static_media.py
+# /static 的檔案服務：上傳檔永遠不會變，可以讓瀏覽器長期快取；另外支援預先壓縮好的版本
+import os
+import re
+import mimetypes
+from os import PathLike
+from typing import Iterable
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import Scope
+
+# 上傳檔的檔名就是內容的 SHA-256 (舊資料是 uuid)，檔案內容永遠不會改變
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# 其他靜態檔每次都要向伺服器確認 (靠 ETag 拿 304)
+DEFAULT_CACHE_CONTROL = "no-cache"
+
+# 可以事先壓縮的版本 (副檔名, Content-Encoding)，依偏好順序排列
+PRECOMPRESSED_VARIANTS = ((".br", "br"), (".gz", "gzip"))
+
+CONTENT_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class MediaStaticFiles(StaticFiles):
+    """
+    在 StaticFiles 之上加入：
+    - immutable_dirs 底下的檔案回傳一年的 immutable 快取標頭
+    - 檔名是內容雜湊值時，直接拿它當強 ETag (多台 / 多 worker 都一致)
+    - 瀏覽器接受的話，改送事先壓縮好的 .br / .gz 版本
+    Range (影片拖曳) 與 If-None-Match / 304 則沿用 FileResponse / StaticFiles 的處理
+    """
+    def __init__(self, *args, immutable_dirs: Iterable[str] = (), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.immutable_dirs = tuple(os.path.normpath(d) + os.sep for d in immutable_dirs)
+
+    def _is_immutable(self, full_path: str) -> bool:
+        relative = os.path.relpath(full_path, self.directory) if self.directory else full_path
+        return any((relative + os.sep).startswith(d) for d in self.immutable_dirs)
+
+    def _pick_variant(self, full_path: str, request_headers: Headers):
+        """找出瀏覽器能接受、而且確實存在的壓縮版本"""
+        # 分段下載 (Range) 的位移是以原檔計算，這時一律送原檔
+        if "range" in request_headers:
+            return None
+        accept_encoding = request_headers.get("accept-encoding", "")
+        accepted = {token.split(";")[0].strip() for token in accept_encoding.split(",")}
+        for suffix, encoding in PRECOMPRESSED_VARIANTS:
+            if encoding not in accepted:
+                continue
+            variant_path = full_path + suffix
+            try:
+                variant_stat = os.stat(variant_path)
+            except OSError:
+                continue
+            return variant_path, variant_stat, encoding
+        return None
+
+    def file_response(self, full_path: PathLike, stat_result: os.stat_result,
+                      scope: Scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        immutable = self._is_immutable(full_path)
+        media_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+
+        headers = {
+            "cache-control": IMMUTABLE_CACHE_CONTROL if immutable else DEFAULT_CACHE_CONTROL,
+            "vary": "Accept-Encoding",
+        }
+
+        serve_path, serve_stat, encoding = full_path, stat_result, None
+        variant = self._pick_variant(full_path, request_headers)
+        if variant:
+            serve_path, serve_stat, encoding = variant
+            headers["content-encoding"] = encoding
+
+        # 內容雜湊值當 ETag；壓縮版本的內容不同，ETag 也要不同
+        stem = os.path.basename(full_path).split(".")[0]
+        if CONTENT_HASH_RE.match(stem):
+            headers["etag"] = f'"{stem}-{encoding}"' if encoding else f'"{stem}"'
+
+        response = FileResponse(serve_path, status_code=status_code, stat_result=serve_stat,
+                                media_type=media_type, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -0,0 +1,41 @@
+# conftest.py
+# 後端模組都放在 Backend/ 底下 (沒有打包)，測試時把它加進 import 路徑
+import importlib
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeWebSocket:
+    """只記錄送出內容的 WebSocket (給 ConnectionManager 用)"""
+    def __init__(self):
+        self.headers = {}
+        self.sent = []
+        self.closed_with = None
+        self.broken = False
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data):
+        if self.broken:
+            raise ConnectionResetError()
+        self.sent.append(data)
+
+    async def send_bytes(self, data):
+        await self.send_text(data)
+
+    async def close(self, code=1000, reason=""):
+        self.closed_with = code
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    # main 在 import 時會在目前目錄建立上傳資料夾
+    monkeypatch.chdir(tmp_path)
+    sys.modules.pop("main", None)
+    module = importlib.import_module("main")
+    yield module
+    sys.modules.pop("main", None)
@@ -0,0 +1,53 @@
+# test_broadcast.py
+# 廣播：連線時的歷史訊息已經包含的訊息不再重送
+import asyncio
+import json
+from conftest import FakeWebSocket
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_broadcast_skips_messages_already_in_history(main):
+    async def scenario():
+        manager = main.manager
+        ws = FakeWebSocket()
+        await manager.connect(ws, "alice")
+        # 訊息 7 已經進了記憶體緩衝區 (歷史訊息裡有)，但它的廣播還沒送出
+        manager.send_history(ws, {"type": "history", "messages": [{"id": 7}]}, 7)
+        await manager.broadcast({"type": "chat", "message": "old", "id": 7})
+        await manager.broadcast({"type": "chat", "message": "new", "id": 8})
+        await manager.broadcast({"type": "delete", "id": 7})
+        await settle()
+        frames = [json.loads(frame) for frame in ws.sent]
+        assert [(f["type"], f.get("id")) for f in frames] == [("history", None), ("chat", 8), ("delete", 7)]
+        manager.senders[ws].stop()
+    asyncio.run(scenario())
+
+def test_full_queue_drops_messages_but_never_state(main):
+    async def scenario():
+        sender = main.ClientSender(FakeWebSocket(), 2, "coalesce")
+        chat = main.Frame({"type": "chat", "id": 1})
+        # 最舊的是一般訊息：丟掉它
+        assert sender.push(chat) and sender.push(main.Frame({"type": "delete", "id": 1}))
+        assert sender.push(main.Frame({"type": "chat", "id": 2}))
+        assert [f.payload["type"] for _, f in sender._frames] == ["delete", "chat"]
+        # 最舊的是狀態訊框：寧可斷線也不丟
+        assert not sender.push(main.Frame({"type": "chat", "id": 3}))
+        sender.stop()
+    asyncio.run(scenario())
+
+def test_pending_presence_updates_are_merged(main):
+    async def scenario():
+        sender = main.ClientSender(FakeWebSocket(), 2, "coalesce")
+        first = main.Frame({"type": "presence_update", "joined": ["a"], "left": []})
+        sender.push(first, "presence_update")
+        sender.push(main.Frame({"type": "chat", "id": 1}))
+        sender.push(main.Frame({"type": "presence_update", "joined": ["b"], "left": ["a"]}), "presence_update")
+        assert [f.payload for _, f in sender._frames][0] == {"type": "presence_update", "joined": ["b"], "left": []}
+        # 共用的 Frame 沒有被改到
+        assert first.payload["joined"] == ["a"]
+        sender.stop()
+    asyncio.run(scenario())
@@ -0,0 +1,64 @@
+# test_heartbeat.py
+# 心跳回收：只有連線時帶 heartbeat=1 的客戶端才會收到 ping、才會因為沒回應被回收
+import asyncio
+import json
+from conftest import FakeWebSocket
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_only_opted_in_clients_are_pinged_and_reaped(main):
+    async def scenario():
+        manager = main.manager
+        legacy, modern = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(legacy, "legacy")
+        await manager.connect(modern, "modern", heartbeat=True)
+        start = manager.senders[modern].last_seen
+
+        # 閒置超過 HEARTBEAT_INTERVAL：只有 modern 收到 ping
+        await main.check_heartbeats(start + main.HEARTBEAT_INTERVAL)
+        await settle()
+        assert legacy.sent == []
+        assert [json.loads(frame) for frame in modern.sent] == [{"type": "ping"}]
+
+        # 超過 HEARTBEAT_TIMEOUT 都沒回應：只有 modern 被回收
+        await main.check_heartbeats(start + main.HEARTBEAT_TIMEOUT + 1)
+        await settle()
+        assert modern.closed_with == main.HEARTBEAT_CLOSE_CODE
+        assert modern not in manager.senders and "modern" not in manager.user_sockets
+        assert legacy.closed_with is None and legacy in manager.senders
+        for sender in manager.senders.values():
+            sender.stop()
+    run(scenario())
+
+def test_pong_keeps_an_opted_in_client_alive(main):
+    async def scenario():
+        manager = main.manager
+        ws = FakeWebSocket()
+        await manager.connect(ws, "a", heartbeat=True)
+        start = manager.senders[ws].last_seen
+        manager.senders[ws].last_seen = start + main.HEARTBEAT_TIMEOUT
+        await main.check_heartbeats(start + main.HEARTBEAT_TIMEOUT + 1)
+        assert ws in manager.senders
+        manager.senders[ws].stop()
+    run(scenario())
+
+def test_send_failures_are_reaped_for_every_client(main):
+    async def scenario():
+        manager = main.manager
+        ws = FakeWebSocket()
+        await manager.connect(ws, "legacy")
+        ws.broken = True
+        manager.send_personal(ws, {"type": "system", "message": "hi"})
+        await settle()
+        assert manager.reaper_wakeup.is_set()
+        await main.check_heartbeats(manager.senders[ws].last_seen)
+        assert ws not in manager.senders and "legacy" not in manager.user_sockets
+        assert main.message_queue.get_nowait()[1] == "legacy 離開了聊天室"
+    run(scenario())
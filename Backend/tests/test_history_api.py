@@ -0,0 +1,54 @@
+# test_history_api.py
+# /history/more：翻過記憶體緩衝區與資料表之後，要接著從封存區段拿
+# /delete-message：封存區段裡的訊息也要能刪
+import pytest
+from fastapi.testclient import TestClient
+from retention import archive_segment
+
+
+@pytest.fixture
+def client(main):
+    with TestClient(main.app) as client:
+        yield client
+
+def insert_messages(conn, count, room):
+    return [conn.execute("INSERT INTO messages (nickname, message, msg_type, timestamp, room_id) "
+                         "VALUES ('alice', ?, 'text', ?, ?)",
+                         (f"m{day}", f"2024-01-{day:02d} 00:00:00", room)).lastrowid
+            for day in range(1, count + 1)]
+
+def add_messages(main, client, count, room="lobby"):
+    return client.portal.call(main.db.write, insert_messages, count, room)
+
+def archive(main, client, segment_size):
+    client.portal.call(main.db.write, archive_segment, "2025-01-01 00:00:00", segment_size)
+
+def page(client, before_id, limit, room="r1"):
+    data = client.get("/history/more", params={"before_id": before_id, "limit": limit, "room": room}).json()
+    return [m["id"] for m in data["messages"]], data["next_cursor"]
+
+
+def test_paging_continues_into_the_archive(main, client):
+    # (大廳在啟動時就載入了，用一個還沒載入的聊天室)
+    ids = add_messages(main, client, 8, "r1")
+    archive(main, client, segment_size=5)
+    # 聊天室載入後緩衝區只有資料表裡剩下的 3 則 (比容量少，但更舊的在封存區段)
+    cache = client.portal.call(main.room_histories.load, "r1", main.load_room_history)
+    assert len(cache) == 3
+
+    assert page(client, ids[7], 2) == (ids[5:7], ids[5])
+    assert page(client, ids[5], 3) == (ids[2:5], ids[2])
+    assert page(client, ids[2], 3) == (ids[:2], None)
+    assert page(client, ids[0], 3) == ([], None)
+
+def test_delete_removes_an_archived_message(main, client, monkeypatch):
+    monkeypatch.setattr(main, "SECRET_KEY", "test-secret")
+    headers = {"Authorization": f"Bearer {main.create_access_token({'sub': 'alice'})}"}
+    ids = add_messages(main, client, 4, "r1")
+    archive(main, client, segment_size=10)
+
+    bob = {"Authorization": f"Bearer {main.create_access_token({'sub': 'bob'})}"}
+    assert client.post("/delete-message", params={"id": ids[1]}, headers=bob).status_code == 403
+    assert client.post("/delete-message", params={"id": ids[1]}, headers=headers).status_code == 200
+    assert page(client, ids[3] + 1, 10) == ([ids[0], ids[2], ids[3]], None)
+    assert client.post("/delete-message", params={"id": ids[1]}, headers=headers).status_code == 404
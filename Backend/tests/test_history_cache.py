@@ -0,0 +1,96 @@
+# test_history_cache.py
+from history_cache import HistoryCache
+
+
+def msg(message_id):
+    return {"id": message_id, "nickname": "a", "type": "chat", "message": str(message_id)}
+
+def make_cache(ids, **options):
+    cache = HistoryCache(**options)
+    cache.load([msg(i) for i in ids])
+    return cache
+
+
+def test_delta_returns_new_messages_after_last_id():
+    cache = make_cache(range(1, 6))
+    for i in range(6, 10):
+        cache.add(msg(i))
+    delta = cache.delta_since(6)
+    assert delta["type"] == "history_delta"
+    assert [m["id"] for m in delta["messages"]] == [7, 8, 9]
+    assert delta["deleted"] == []
+
+def test_delta_is_empty_when_client_is_up_to_date():
+    cache = make_cache(range(1, 6))
+    cache.add(msg(6))
+    delta = cache.delta_since(6)
+    assert delta["messages"] == [] and delta["deleted"] == []
+
+def test_delta_includes_deletes_made_while_disconnected():
+    cache = make_cache(range(1, 6))
+    cache.add(msg(6))
+    # 客戶端看到 6 之後斷線，期間刪掉 3 (客戶端手上有) 與 7 (客戶端沒看過)
+    cache.add(msg(7))
+    cache.remove(3)
+    cache.remove(7)
+    delta = cache.delta_since(6)
+    assert [m["id"] for m in delta["messages"]] == []
+    assert sorted(delta["deleted"]) == [3, 7]
+
+def test_delta_skips_deletes_the_client_already_saw():
+    cache = make_cache(range(1, 6))
+    cache.add(msg(6))
+    # 刪除當下最新是 6，客戶端斷線前已經看到 7，delete 廣播也收到了
+    cache.remove(2)
+    cache.add(msg(7))
+    cache.add(msg(8))
+    delta = cache.delta_since(7)
+    assert [m["id"] for m in delta["messages"]] == [8]
+    assert delta["deleted"] == []
+
+def test_delta_refuses_ids_from_before_a_restart():
+    # 載入前的刪除不知道，比載入時更早的 last_id 要拿完整快照
+    cache = make_cache(range(1, 6))
+    cache.add(msg(6))
+    assert cache.delta_since(4) is None
+    assert cache.delta_since(5) is None
+
+def test_delta_refuses_unknown_future_ids():
+    cache = make_cache(range(1, 6))
+    cache.add(msg(6))
+    assert cache.delta_since(100) is None
+
+def test_delta_refuses_gaps_larger_than_the_snapshot():
+    cache = make_cache(range(1, 6), capacity=50, snapshot_size=3)
+    cache.add(msg(6))
+    for i in range(7, 11):
+        cache.add(msg(i))
+    assert cache.delta_since(6) is None
+    assert [m["id"] for m in cache.delta_since(7)["messages"]] == [8, 9, 10]
+
+def test_delta_refuses_ids_evicted_from_the_buffer():
+    cache = make_cache(range(1, 4), capacity=4, snapshot_size=4)
+    for i in range(4, 10):
+        cache.add(msg(i))
+    # 緩衝區只剩 6~9，last_id = 4 之後的 5 已經被擠掉
+    assert cache.floor_id == 6
+    assert cache.delta_since(4) is None
+    assert [m["id"] for m in cache.delta_since(5)["messages"]] == [6, 7, 8, 9]
+
+def test_delta_refuses_when_the_delete_log_overflowed():
+    cache = make_cache(range(1, 6), delete_log_size=2)
+    cache.add(msg(6))
+    cache.add(msg(7))
+    for i in (1, 2, 3):
+        cache.remove(i)
+    # 第一筆刪除紀錄 (當時最新是 7) 被擠掉了，7 以前的客戶端可能漏掉它
+    assert cache.delta_since(6) is None
+    assert cache.delta_since(7) is None
+
+def test_pages_past_the_oldest_cached_message_go_to_the_database():
+    # 撈不滿容量也可能還有更舊的 (封存區段裡)，緩衝區不能回答「沒有更多了」
+    cache = make_cache(range(5, 9), capacity=50)
+    assert cache.floor_id == 5
+    assert [m["id"] for m in cache.page_before(8, 2)] == [6, 7]
+    assert cache.page_before(6, 2) is None
+    assert cache.recent(10) is None
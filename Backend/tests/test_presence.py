@@ -0,0 +1,113 @@
+# test_presence.py
+from presence import PresenceDiff, merge_presence_updates
+
+
+class Client:
+    """模擬前端：連線時拿到完整名單，之後套用 presence_update"""
+    def __init__(self, members):
+        self.members = set(members)
+
+    def apply(self, diff):
+        if diff is None:
+            return
+        self.members.difference_update(diff["left"])
+        self.members.update(diff["joined"])
+
+
+def flush(presence, clients):
+    diff = presence.take()
+    for client in clients:
+        client.apply(diff)
+    return diff
+
+
+def test_join_then_leave_in_one_window_is_not_broadcast():
+    presence = PresenceDiff()
+    presence.joined("A")
+    presence.left("A")
+    assert presence.take() is None
+    assert presence.announced == set()
+
+def test_join_connect_leave_in_one_window():
+    presence = PresenceDiff()
+    old = Client(presence.snapshot())
+    presence.joined("A")
+    # C 在時間窗內連線，名單不能包含還沒廣播的 A
+    presence.joined("C")
+    new = Client(presence.snapshot({"C"}))
+    presence.left("A")
+    flush(presence, [old, new])
+    assert old.members == new.members == {"C"}
+
+def test_leave_connect_rejoin_in_one_window():
+    presence = PresenceDiff()
+    presence.joined("A")
+    old = Client([])
+    flush(presence, [old])
+    assert old.members == {"A"}
+
+    presence.left("A")
+    presence.joined("C")
+    new = Client(presence.snapshot({"C"}))
+    presence.joined("A")
+    flush(presence, [old, new])
+    assert old.members == new.members == {"A", "C"}
+
+def test_reconnect_storm_converges_for_every_client():
+    presence = PresenceDiff()
+    for name in ("A", "B", "D"):
+        presence.joined(name)
+    clients = [Client([])]
+    flush(presence, clients)
+
+    # 同一個時間窗裡：大家斷線又重連，中間不斷有新客戶端連上
+    online = {"A", "B", "D"}
+    for name in ["A", "B", "A", "D", "B", "A"]:
+        if name in online:
+            presence.left(name)
+            online.discard(name)
+        else:
+            presence.joined(name)
+            online.add(name)
+        clients.append(Client(presence.snapshot()))
+    flush(presence, clients)
+    for client in clients:
+        assert client.members == online
+    assert presence.announced == online
+
+def test_adopt_and_forget_hand_a_member_between_workers():
+    presence = PresenceDiff()
+    # 從其他 worker 接手：不廣播上線，但之後離線要廣播
+    presence.adopt("A")
+    assert presence.take() is None
+    presence.left("A")
+    assert presence.take() == {"type": "presence_update", "joined": [], "left": ["A"]}
+
+    # 被其他 worker 接手：本機不再負責他的離線
+    presence.joined("B")
+    presence.take()
+    presence.forget("B")
+    assert presence.take() is None
+    assert "B" not in presence.snapshot()
+
+def test_merged_updates_match_applying_both():
+    presence = PresenceDiff()
+    for name in ("a", "b"):
+        presence.joined(name)
+    presence.take()
+    base = Client(presence.snapshot())
+    one_by_one = Client(base.members)
+    merged = Client(base.members)
+
+    presence.joined("c")
+    presence.left("a")
+    first = presence.take()
+    presence.left("c")
+    presence.joined("a")
+    presence.joined("d")
+    second = presence.take()
+
+    one_by_one.apply(first)
+    one_by_one.apply(second)
+    merged.apply(merge_presence_updates(first, second))
+    assert merged.members == one_by_one.members == {"a", "b", "d"}
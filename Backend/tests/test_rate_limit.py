@@ -0,0 +1,82 @@
+# test_rate_limit.py
+import pytest
+import rate_limit
+from rate_limit import FloodControl, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """固定的時間，測試自己決定要往前走多少"""
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_bucket_refills_at_rate_up_to_burst():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    assert all(bucket.consume(0) for _ in range(3))
+    assert not bucket.consume(0)
+    assert bucket.consume(0.5)
+    assert not bucket.consume(0.5)
+    assert bucket.is_full(100) and bucket.tokens == 3
+
+def test_peek_does_not_spend_tokens():
+    bucket = TokenBucket(rate=1, burst=1, now=0)
+    assert bucket.peek(0) and bucket.peek(0)
+    assert bucket.consume(0)
+    assert not bucket.peek(0)
+
+
+def test_user_over_own_limit_is_warned_then_kicked(clock):
+    flood = FloodControl(user_rate=1, user_burst=2, global_rate=100, global_burst=100, max_strikes=3)
+    assert [flood.check("a") for _ in range(2)] == ["ok", "ok"]
+    assert [flood.check("a") for _ in range(4)] == ["warn", "drop", "drop", "kick"]
+    assert flood.kicked == 1 and flood.rejected == 4
+    # 斷線前陸續收到的訊框不重複計算
+    assert flood.check("a") == "kick" and flood.kicked == 1
+
+def test_strikes_reset_after_an_accepted_frame(clock):
+    flood = FloodControl(user_rate=1, user_burst=1, global_rate=100, global_burst=100, max_strikes=2)
+    assert flood.check("a") == "ok"
+    assert flood.check("a") == "warn"
+    clock[0] += 1
+    assert flood.check("a") == "ok"
+    assert flood.check("a") == "warn"
+
+def test_global_limit_does_not_strike_or_kick_a_polite_user(clock):
+    flood = FloodControl(user_rate=1, user_burst=5, global_rate=1, global_burst=3, max_strikes=2)
+    # 其他人把整個聊天室的額度用完
+    for name in ("x", "y", "z"):
+        assert flood.check(name) == "ok"
+    assert flood.check("a") == "busy"
+    for _ in range(10):
+        assert flood.check("a") == "drop"
+    assert "a" not in flood.strikes
+    assert flood.kicked == 0 and flood.rejected == 0 and flood.global_rejected == 11
+    # 被丟掉的訊框沒有扣到他自己的額度
+    assert flood.buckets["a"].tokens == 5
+
+def test_global_busy_notice_is_sent_again_after_recovering(clock):
+    flood = FloodControl(user_rate=10, user_burst=10, global_rate=1, global_burst=1, max_strikes=5)
+    assert flood.check("a") == "ok"
+    assert flood.check("a") == "busy"
+    clock[0] += 1
+    assert flood.check("a") == "ok"
+    assert flood.check("a") == "busy"
+
+def test_user_limit_still_applies_while_global_is_empty(clock):
+    flood = FloodControl(user_rate=1, user_burst=1, global_rate=1, global_burst=1, max_strikes=1)
+    assert flood.check("a") == "ok"
+    # 自己的額度也用完了：算違規
+    assert flood.check("a") == "warn"
+    assert flood.check("a") == "kick"
+
+def test_release_forgets_idle_users_but_keeps_draining_ones(clock):
+    flood = FloodControl(user_rate=1, user_burst=2, global_rate=100, global_burst=100, max_strikes=5)
+    flood.check("a")
+    flood.release("a")
+    # 還沒補滿：留著，避免斷線重連重置額度
+    assert "a" in flood.buckets
+    clock[0] += 5
+    flood.release("a")
+    assert "a" not in flood.buckets
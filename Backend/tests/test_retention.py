@@ -0,0 +1,137 @@
+# test_retention.py
+import sqlite3
+import pytest
+from retention import (create_retention_schema, enable_incremental_vacuum, purge_deleted, purge_system_messages,
+                       archive_segment, read_archive, remove_archived, incremental_vacuum)
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    conn.execute('''CREATE TABLE messages
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT, nickname TEXT, message TEXT, msg_type TEXT,
+                     timestamp TEXT, filename TEXT, is_deleted INTEGER DEFAULT 0,
+                     room_id TEXT NOT NULL DEFAULT 'lobby')''')
+    create_retention_schema(conn)
+    yield conn
+    conn.close()
+
+def add(conn, day, room="lobby", msg_type="text", deleted=0):
+    return conn.execute("INSERT INTO messages (nickname, message, msg_type, timestamp, room_id, is_deleted) "
+                        "VALUES ('a', ?, ?, ?, ?, ?)",
+                        (f"m{day}", msg_type, f"2024-01-{day:02d} 00:00:00", room, deleted)).lastrowid
+
+def archive_all(conn, before, segment_size):
+    total = 0
+    while True:
+        count = archive_segment(conn, before, segment_size)
+        conn.commit()
+        if not count:
+            return total
+        total += count
+
+
+def test_archive_moves_old_messages_into_segments(conn):
+    ids = [add(conn, day) for day in range(1, 11)]
+    assert archive_all(conn, "2024-01-06 00:00:00", segment_size=2) == 5
+    remaining = [row[0] for row in conn.execute("SELECT id FROM messages ORDER BY id")]
+    assert remaining == ids[5:]
+    segments = conn.execute("SELECT room_id, first_id, last_id, message_count FROM message_archive ORDER BY id").fetchall()
+    assert segments == [("lobby", 1, 2, 2), ("lobby", 3, 4, 2), ("lobby", 5, 5, 1)]
+
+def test_archive_keeps_rooms_in_separate_segments(conn):
+    add(conn, 1, "a")
+    add(conn, 2, "b")
+    add(conn, 3, "a")
+    add(conn, 20, "a")
+    assert archive_all(conn, "2024-01-10 00:00:00", segment_size=10) == 3
+    rooms = {row[0]: row[1] for row in conn.execute("SELECT room_id, message_count FROM message_archive")}
+    assert rooms == {"a": 2, "b": 1}
+
+def test_archive_skips_deleted_rows_and_stops_at_new_ones(conn):
+    add(conn, 1)
+    add(conn, 2, deleted=1)
+    add(conn, 20)
+    add(conn, 3)
+    # id 與時間一起遞增，遇到第一則新的就停 (後面那則舊時間的不會被跳著封存)
+    assert archive_all(conn, "2024-01-10 00:00:00", segment_size=10) == 1
+    assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 3
+
+def test_archive_does_nothing_when_nothing_is_old(conn):
+    add(conn, 20)
+    assert archive_segment(conn, "2024-01-10 00:00:00", 10) == 0
+    conn.commit()
+    assert archive_segment(conn, "2024-01-10 00:00:00", 10) == 0
+
+def test_read_archive_pages_backwards_across_segments(conn):
+    ids = [add(conn, day) for day in range(1, 8)]
+    archive_all(conn, "2024-02-01 00:00:00", segment_size=3)
+    rows = read_archive(conn, "lobby", before_id=ids[6], limit=4)
+    assert [row[4] for row in rows] == ids[2:6]
+    # 欄位順序與 format_message_row 相同
+    nickname, message, msg_type, timestamp, message_id, is_deleted, filename = rows[0]
+    assert (nickname, message, msg_type, is_deleted, filename) == ("a", "m3", "text", 0, None)
+    assert [row[4] for row in read_archive(conn, "lobby", before_id=ids[2], limit=10)] == ids[:2]
+    assert read_archive(conn, "lobby", before_id=ids[0], limit=10) == []
+    assert read_archive(conn, "other", before_id=100, limit=10) == []
+
+def test_read_archive_continues_where_the_table_ends(conn):
+    ids = [add(conn, day) for day in range(1, 7)]
+    archive_all(conn, "2024-01-04 00:00:00", segment_size=10)
+    # /history/more：資料表裡最舊的是 ids[3]，不夠的從封存區段接著拿
+    live = [row[0] for row in conn.execute("SELECT id FROM messages ORDER BY id")]
+    assert live == ids[3:]
+    assert [row[4] for row in read_archive(conn, "lobby", live[0], 2)] == ids[1:3]
+
+def test_remove_archived_rewrites_or_drops_the_segment(conn):
+    ids = [add(conn, day) for day in range(1, 4)]
+    other = add(conn, 4, "other")
+    archive_all(conn, "2024-02-01 00:00:00", segment_size=10)
+    # 不是自己的訊息：回傳發送者，不刪
+    assert remove_archived(conn, ids[0], "b") == ("a", "lobby")
+    assert remove_archived(conn, ids[0], "a") == ("a", "lobby")
+    assert [row[4] for row in read_archive(conn, "lobby", 100, 10)] == ids[1:]
+    assert conn.execute("SELECT first_id, message_count FROM message_archive WHERE room_id = 'lobby'").fetchone() == (ids[1], 2)
+    # 別的聊天室的區段 id 範圍重疊也不會刪錯
+    assert remove_archived(conn, other, "a") == ("a", "other")
+    assert conn.execute("SELECT COUNT(*) FROM message_archive WHERE room_id = 'other'").fetchone()[0] == 0
+    assert remove_archived(conn, 999, "a") is None
+
+def test_purge_deleted_and_old_system_messages(conn):
+    add(conn, 1, deleted=1)
+    add(conn, 2, deleted=1)
+    add(conn, 3, msg_type="system")
+    add(conn, 20, msg_type="system")
+    add(conn, 4)
+    assert purge_deleted(conn, 1) == 1
+    assert purge_deleted(conn, 10) == 1
+    assert purge_deleted(conn, 10) == 0
+    assert purge_system_messages(conn, "2024-01-10 00:00:00", 10) == 1
+    remaining = conn.execute("SELECT msg_type, timestamp FROM messages ORDER BY id").fetchall()
+    assert remaining == [("system", "2024-01-20 00:00:00"), ("text", "2024-01-04 00:00:00")]
+
+
+def test_incremental_vacuum_on_a_new_database(tmp_path):
+    conn = sqlite3.connect(tmp_path / "new.db")
+    assert enable_incremental_vacuum(conn) == "enabled"
+    conn.execute("CREATE TABLE t (x BLOB)")
+    conn.executemany("INSERT INTO t VALUES (zeroblob(4000))", [()] * 50)
+    conn.commit()
+    conn.execute("DELETE FROM t")
+    conn.commit()
+    assert incremental_vacuum(conn, 10) == 10
+    assert incremental_vacuum(conn, 1000) > 0
+    assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    conn.close()
+
+def test_existing_database_is_only_vacuumed_when_allowed(tmp_path):
+    path = tmp_path / "old.db"
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (x)")
+    conn.commit()
+    assert enable_incremental_vacuum(conn) == "needs_vacuum"
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+    assert enable_incremental_vacuum(conn, allow_vacuum=True) == "vacuumed"
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert enable_incremental_vacuum(conn) == "enabled"
+    conn.close()
@@ -0,0 +1,101 @@
+# test_upload_sessions.py
+import sqlite3
+import pytest
+from upload_sessions import (create_upload_schema, create_session, get_session, begin_chunk, end_chunk,
+                             claim_session, release_session, active_writers, missing_chunks, delete_session,
+                             expired_sessions)
+
+NOW = "2026-01-01 12:00:00"
+LATER = "2026-01-01 12:05:00"
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    create_upload_schema(conn)
+    yield conn
+    conn.close()
+
+def new_session(conn, upload_id="u1", owner="alice", size=10, chunk_size=4, max_sessions=10, max_per_owner=5):
+    refused = create_session(conn, upload_id, owner, "a.zip", "zip", size, chunk_size, None, NOW,
+                             max_sessions, max_per_owner)
+    conn.commit()
+    return refused
+
+
+def test_session_records_owner_and_starts_open(conn):
+    assert new_session(conn) is None
+    assert get_session(conn, "u1") == ("a.zip", "zip", 10, 4, None, "open", "alice")
+    assert get_session(conn, "nope") is None
+    assert missing_chunks(conn, "u1", 3) == [0, 1, 2]
+
+def test_session_limits_per_owner_and_in_total(conn):
+    assert new_session(conn, "u1", max_per_owner=2) is None
+    assert new_session(conn, "u2", max_per_owner=2) is None
+    assert new_session(conn, "u3", max_per_owner=2) == "owner_limit"
+    assert new_session(conn, "u4", owner="bob", max_sessions=2) == "busy"
+    assert new_session(conn, "u5", owner="bob", max_sessions=3) is None
+    assert conn.execute("SELECT COUNT(*) FROM upload_sessions").fetchone()[0] == 3
+
+def test_chunks_are_recorded_only_when_written(conn):
+    new_session(conn)
+    assert begin_chunk(conn, "u1", "w1", NOW)
+    assert begin_chunk(conn, "u1", "w2", NOW)
+    assert active_writers(conn, "u1", NOW) == 2
+    end_chunk(conn, "u1", "w1", 0, LATER)
+    # 寫失敗的分段不算收到
+    end_chunk(conn, "u1", "w2", None, LATER)
+    assert active_writers(conn, "u1", NOW) == 0
+    assert missing_chunks(conn, "u1", 3) == [1, 2]
+
+def test_claim_rejects_new_chunks_but_waits_for_in_flight_ones(conn):
+    new_session(conn)
+    assert begin_chunk(conn, "u1", "w1", NOW)
+    assert claim_session(conn, "u1")
+    # 完成中：不接受新的分段，也不能重複完成
+    assert not begin_chunk(conn, "u1", "w2", NOW)
+    assert not claim_session(conn, "u1")
+    # 已經在寫的那一段還要等它結束，結束後照樣記錄
+    assert active_writers(conn, "u1", NOW) == 1
+    end_chunk(conn, "u1", "w1", 2, LATER)
+    assert active_writers(conn, "u1", NOW) == 0
+    assert missing_chunks(conn, "u1", 3) == [0, 1]
+
+def test_release_reopens_a_claimed_session(conn):
+    new_session(conn)
+    assert claim_session(conn, "u1")
+    release_session(conn, "u1")
+    assert get_session(conn, "u1")[5] == "open"
+    assert begin_chunk(conn, "u1", "w1", NOW)
+
+def test_stale_writers_are_not_waited_for(conn):
+    new_session(conn)
+    begin_chunk(conn, "u1", "w1", NOW)
+    # 登記時間比 stale_before 早：當作那個 worker 已經當掉
+    assert active_writers(conn, "u1", LATER) == 0
+
+def test_deleted_session_ignores_late_writers(conn):
+    new_session(conn)
+    begin_chunk(conn, "u1", "w1", NOW)
+    delete_session(conn, "u1")
+    end_chunk(conn, "u1", "w1", 0, LATER)
+    assert get_session(conn, "u1") is None
+    assert conn.execute("SELECT COUNT(*) FROM upload_chunks").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM upload_writers").fetchone()[0] == 0
+    assert not begin_chunk(conn, "u1", "w2", LATER)
+
+def test_expired_sessions_use_last_activity(conn):
+    new_session(conn, "u1")
+    new_session(conn, "u2")
+    begin_chunk(conn, "u2", "w1", LATER)
+    assert expired_sessions(conn, "2026-01-01 12:01:00") == ["u1"]
+
+def test_schema_adds_owner_to_old_tables():
+    conn = sqlite3.connect(":memory:")
+    conn.execute('''CREATE TABLE upload_sessions
+                    (id TEXT PRIMARY KEY, filename TEXT, extension TEXT, size INTEGER, chunk_size INTEGER,
+                     sha256 TEXT, state TEXT DEFAULT 'open', updated TEXT)''')
+    conn.execute("INSERT INTO upload_sessions (id, updated) VALUES ('old', ?)", (NOW,))
+    create_upload_schema(conn)
+    assert get_session(conn, "old")[6] is None
+    conn.close()
@@ -0,0 +1,108 @@
+# upload_sessions.py
+# 可續傳分段上傳的狀態 (存在資料庫裡，多個 worker 共用)
+# 每個函式都是在 Database 寫入/讀取執行緒上跑的一個短交易
+#
+# 狀態：
+#   open        可以上傳分段
+#   completing  有一個請求正在驗證與搬移檔案，不再接受新的分段
+# 正在寫檔的分段會先登記在 upload_writers，完成上傳的請求要等它們都寫完才開始算雜湊值
+from typing import List, Optional
+
+
+def create_upload_schema(c):
+    """建立分段上傳用的資料表 (在 init_db 裡呼叫)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS upload_sessions
+                 (id TEXT PRIMARY KEY,
+                  filename TEXT,
+                  extension TEXT,
+                  size INTEGER,
+                  chunk_size INTEGER,
+                  sha256 TEXT,
+                  state TEXT DEFAULT 'open',
+                  updated TEXT,
+                  owner TEXT)''')
+    # 舊的資料表沒有 owner 欄位：補上 (原本那些沒有主人的上傳只會等著過期)
+    columns = [row[1] for row in c.execute("PRAGMA table_info(upload_sessions)")]
+    if "owner" not in columns:
+        c.execute("ALTER TABLE upload_sessions ADD COLUMN owner TEXT")
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_upload_sessions_owner
+                 ON upload_sessions (owner)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS upload_chunks
+                 (upload_id TEXT,
+                  chunk INTEGER,
+                  PRIMARY KEY (upload_id, chunk)) WITHOUT ROWID''')
+    # 正在寫檔的分段 (writer 是每個請求自己產生的代號)
+    c.execute('''CREATE TABLE IF NOT EXISTS upload_writers
+                 (upload_id TEXT,
+                  writer TEXT,
+                  started TEXT,
+                  PRIMARY KEY (upload_id, writer)) WITHOUT ROWID''')
+
+def create_session(conn, upload_id: str, owner: str, filename: str, extension: str, size: int,
+                   chunk_size: int, sha256: Optional[str], now: str,
+                   max_sessions: int, max_per_owner: int) -> Optional[str]:
+    """
+    建立一個上傳，回傳 None 代表成功
+    超過上限時不建立，回傳 "busy" (全部的上傳太多) 或 "owner_limit" (這位使用者的上傳太多)
+    """
+    # 先拿到寫入鎖，多個 worker 同時建立也不會超過上限
+    conn.execute("BEGIN IMMEDIATE")
+    total, mine = conn.execute("SELECT COUNT(*), COALESCE(SUM(owner = ?), 0) FROM upload_sessions",
+                               (owner,)).fetchone()
+    if mine >= max_per_owner:
+        return "owner_limit"
+    if total >= max_sessions:
+        return "busy"
+    conn.execute('''INSERT INTO upload_sessions (id, filename, extension, size, chunk_size, sha256, state, updated, owner)
+                    VALUES (?, ?, ?, ?, ?, ?, 'open', ?, ?)''',
+                 (upload_id, filename, extension, size, chunk_size, sha256, now, owner))
+    return None
+
+def get_session(conn, upload_id: str):
+    """回傳 (filename, extension, size, chunk_size, sha256, state, owner)，找不到回傳 None"""
+    return conn.execute('''SELECT filename, extension, size, chunk_size, sha256, state, owner
+                           FROM upload_sessions WHERE id = ?''', (upload_id,)).fetchone()
+
+def begin_chunk(conn, upload_id: str, writer: str, now: str) -> bool:
+    """登記開始寫一個分段；上傳已經在完成中 (或不存在) 就回傳 False"""
+    # 跟 claim_session 在同一條寫入連線上依序執行，兩者不會交錯
+    if not conn.execute("UPDATE upload_sessions SET updated = ? WHERE id = ? AND state = 'open'",
+                        (now, upload_id)).rowcount:
+        return False
+    conn.execute("INSERT INTO upload_writers (upload_id, writer, started) VALUES (?, ?, ?)",
+                 (upload_id, writer, now))
+    return True
+
+def end_chunk(conn, upload_id: str, writer: str, chunk: Optional[int], now: str):
+    """分段寫完 (chunk 是收好的分段編號，寫失敗時是 None)，取消登記"""
+    conn.execute("DELETE FROM upload_writers WHERE upload_id = ? AND writer = ?", (upload_id, writer))
+    # 上傳途中被取消或過期的話，就不再記錄
+    if chunk is not None and conn.execute("UPDATE upload_sessions SET updated = ? WHERE id = ?",
+                                          (now, upload_id)).rowcount:
+        conn.execute("INSERT OR IGNORE INTO upload_chunks (upload_id, chunk) VALUES (?, ?)", (upload_id, chunk))
+
+def claim_session(conn, upload_id: str) -> bool:
+    """同一個上傳只讓一個請求 (或一個 worker) 去完成；成功之後新的分段都會被 begin_chunk 拒絕"""
+    return conn.execute("UPDATE upload_sessions SET state = 'completing' WHERE id = ? AND state = 'open'",
+                        (upload_id,)).rowcount == 1
+
+def release_session(conn, upload_id: str):
+    """完成失敗 (還缺分段、寫檔的請求一直沒結束...)：讓客戶端可以繼續上傳或再試一次"""
+    conn.execute("UPDATE upload_sessions SET state = 'open' WHERE id = ? AND state = 'completing'", (upload_id,))
+
+def active_writers(conn, upload_id: str, stale_before: str) -> int:
+    """還在寫檔的分段數 (比 stale_before 更早登記的當作 worker 已經當掉，不用等)"""
+    return conn.execute("SELECT COUNT(*) FROM upload_writers WHERE upload_id = ? AND started >= ?",
+                        (upload_id, stale_before)).fetchone()[0]
+
+def missing_chunks(conn, upload_id: str, total_chunks: int) -> List[int]:
+    received = {row[0] for row in conn.execute("SELECT chunk FROM upload_chunks WHERE upload_id = ?", (upload_id,))}
+    return [i for i in range(total_chunks) if i not in received]
+
+def delete_session(conn, upload_id: str):
+    conn.execute("DELETE FROM upload_writers WHERE upload_id = ?", (upload_id,))
+    conn.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+    conn.execute("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+
+def expired_sessions(conn, before: str) -> List[str]:
+    return [row[0] for row in conn.execute("SELECT id FROM upload_sessions WHERE updated < ?", (before,))]
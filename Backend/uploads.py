@@ -0,0 +1,206 @@
+# uploads.py
+# 串流接收上傳檔案：邊收邊寫進暫存檔，記憶體用量固定，不會因為大檔案而暴增
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+from typing import Iterable, Optional
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # 舊版 python-multipart 的套件名稱
+    from multipart.multipart import MultipartParser, parse_options_header
+
+
+class UploadError(Exception):
+    """上傳內容不合法 (格式、副檔名、大小)，訊息會直接回給前端"""
+
+
+def size_limit_message(max_size: int) -> str:
+    # 轉換成 MB 顯示錯誤訊息比較好讀
+    return f"檔案過大，限制為 {int(max_size / (1024 * 1024))}MB"
+
+
+class ReceivedFile:
+    """
+    multipart 解析器的回呼 (在背景執行緒裡被呼叫)
+    只把欄位名稱為 field_name 的檔案寫進暫存檔，其他欄位直接忽略
+    """
+    def __init__(self, tmp_dir: str, field_name: str, max_size: int, allowed_extensions: Iterable[str]):
+        self.tmp_dir = tmp_dir
+        self.field_name = field_name.encode()
+        self.max_size = max_size
+        self.allowed_extensions = set(allowed_extensions)
+        # 收完之後給呼叫端用的結果
+        self.path: Optional[str] = None
+        self.filename: Optional[str] = None
+        self.extension: Optional[str] = None
+        self.size = 0
+        self.complete = False
+        # 邊收邊算 SHA-256，收完就知道內容的雜湊值 (用來去除重複檔案)
+        self._hasher = hashlib.sha256()
+        # 解析中的狀態
+        self._file = None
+        self._in_target = False
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+
+    def callbacks(self) -> dict:
+        return {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        }
+
+    def _on_part_begin(self):
+        self._headers = {}
+        self._in_target = False
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if options.get(b"name") != self.field_name or b"filename" not in options or self.path:
+            return
+        self.filename = options[b"filename"].decode("utf-8", errors="replace")
+
+        # 取得副檔名，在寫入任何資料之前就先擋掉
+        self.extension = self.filename.split(".")[-1].lower()
+        if self.extension not in self.allowed_extensions:
+            raise UploadError("不支援的檔案類型")
+
+        fd, self.path = tempfile.mkstemp(dir=self.tmp_dir, suffix=".part")
+        self._file = os.fdopen(fd, "wb")
+        self._in_target = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if not self._in_target:
+            return
+        # 邊收邊檢查大小，超過就立刻中止
+        self.size += end - start
+        if self.size > self.max_size:
+            raise UploadError(size_limit_message(self.max_size))
+        self._hasher.update(data[start:end])
+        self._file.write(data[start:end])
+
+    def _on_part_end(self):
+        if self._in_target:
+            self._file.close()
+            self._file = None
+            self._in_target = False
+            self.complete = True
+
+    @property
+    def sha256(self) -> str:
+        return self._hasher.hexdigest()
+
+    def discard(self):
+        """上傳失敗時刪掉暫存檔"""
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+
+async def receive_upload(request: Request, tmp_dir: str, field_name: str,
+                         max_size: int, allowed_extensions: Iterable[str]) -> ReceivedFile:
+    """
+    從 request 串流讀取 multipart 內容，檔案寫到 tmp_dir 的暫存檔
+    解析與寫檔都在執行緒池裡做，不會卡住 event loop
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError("請使用 multipart/form-data 上傳檔案")
+
+    received = ReceivedFile(tmp_dir, field_name, max_size, allowed_extensions)
+    parser = MultipartParser(params[b"boundary"], received.callbacks())
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await run_in_threadpool(parser.write, chunk)
+        await run_in_threadpool(parser.finalize)
+        if not received.complete:
+            raise UploadError("沒有收到檔案")
+    except BaseException:
+        await run_in_threadpool(received.discard)
+        raise
+    return received
+
+
+# --- [新增] 可續傳的分段上傳 ---
+# 建立上傳時先開一個跟檔案一樣大的稀疏檔 (sparse file)，每一段直接寫到它在檔案裡的位置
+# 各段可以同時上傳、順序不拘，全部收齊後這個檔案就是完整的檔案，不必再合併或整個讀進記憶體
+
+def create_session_file(path: str, size: int):
+    """(在背景執行緒裡呼叫) 建立 size bytes 的稀疏檔"""
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+async def write_chunk(request: Request, path: str, offset: int, length: int) -> int:
+    """
+    把 request body 串流寫到 path 的 offset 位置，body 必須剛好是 length bytes
+    寫到一半失敗沒關係：這一段不會被標記為已收到，客戶端重傳時會整段覆蓋
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) != length:
+        raise UploadError(f"這一段的大小應該是 {length} bytes")
+
+    f = await run_in_threadpool(open, path, "r+b")
+    try:
+        await run_in_threadpool(f.seek, offset)
+        received = 0
+        async for data in request.stream():
+            if not data:
+                continue
+            received += len(data)
+            if received > length:
+                raise UploadError(f"這一段的大小應該是 {length} bytes")
+            await run_in_threadpool(f.write, data)
+        if received != length:
+            raise UploadError(f"這一段的大小應該是 {length} bytes")
+    finally:
+        await run_in_threadpool(f.close)
+    return received
+
+def file_sha256(path: str, block_size: int = 1024 * 1024) -> str:
+    """(在背景執行緒裡呼叫) 分塊讀取計算 SHA-256，記憶體用量固定"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def precompress(path: str, min_saving: float = 0.1) -> bool:
+    """
+    (在背景執行緒裡呼叫) 產生 path + ".gz"，讓靜態檔服務可以直接送壓縮版本
+    壓不到 min_saving 以上就不留，避免白佔空間
+    """
+    gz_path = path + ".gz"
+    tmp_path = gz_path + ".part"
+    with open(path, "rb") as src, gzip.open(tmp_path, "wb", compresslevel=9) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    if os.path.getsize(tmp_path) > os.path.getsize(path) * (1 - min_saving):
+        os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, gz_path)
+    return True
@@ -0,0 +1,71 @@
+# user_directory.py
+# 所有已註冊帳號的記憶體名冊：啟動時從資料庫載入一次，之後由 /register 更新
+# /users 不必每次查整張 users 表，序列化結果與 ETag 也只在名冊變動後重算一次
+import hashlib
+import json
+from bisect import bisect_right, insort
+from typing import Callable, Iterable, List, Optional, Tuple
+
+
+class UserDirectory:
+    def __init__(self):
+        # 依帳號名稱排序，翻頁用帳號名稱當游標
+        self._names: List[str] = []
+        self._members = set()
+        # 名冊變動後才重新產生
+        self._etag: Optional[str] = None
+        self._body: Optional[bytes] = None
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, username: str):
+        return username in self._members
+
+    def _invalidate(self):
+        self._etag = None
+        self._body = None
+
+    def load(self, usernames: Iterable[str]):
+        self._members = set(usernames)
+        self._names = sorted(self._members)
+        self._invalidate()
+
+    def add(self, username: str):
+        """註冊成功後呼叫 (其他 worker 透過跨行程通道收到時也會呼叫，重複加入不影響)"""
+        if username in self._members:
+            return
+        self._members.add(username)
+        insort(self._names, username)
+        self._invalidate()
+
+    @property
+    def etag(self) -> str:
+        # 由內容算出來，不同 worker 的名冊一樣時 ETag 也一樣
+        if self._etag is None:
+            digest = hashlib.sha1("\n".join(self._names).encode("utf-8")).hexdigest()[:16]
+            self._etag = f'"users-{len(self._names)}-{digest}"'
+        return self._etag
+
+    def body(self) -> bytes:
+        """整份名冊的 JSON (舊版 /users 的回應格式：帳號名稱陣列)"""
+        if self._body is None:
+            self._body = json.dumps(self._names, ensure_ascii=False).encode("utf-8")
+        return self._body
+
+    def page(self, after: Optional[str], limit: int,
+             include: Callable[[str], bool] = lambda name: True,
+             names: Optional[List[str]] = None) -> Tuple[List[str], Optional[str]]:
+        """
+        從 after 之後依序取出最多 limit 個符合 include 的帳號，回傳 (帳號列表, 下一頁游標)
+        names 可以換成其他排序好的清單 (例如線上名單)
+        """
+        names = self._names if names is None else names
+        start = bisect_right(names, after) if after is not None else 0
+        result = []
+        for i in range(start, len(names)):
+            if include(names[i]):
+                result.append(names[i])
+                if len(result) == limit:
+                    return result, names[i] if i + 1 < len(names) else None
+        return result, None
@@ -0,0 +1,64 @@
+# wire.py
+# WebSocket 的傳輸格式
+# 預設 (舊版客戶端)：JSON 文字訊框
+# 客戶端在 Sec-WebSocket-Protocol 提出 MSGPACK_SUBPROTOCOL 時：MessagePack 二進位訊框，
+# history 類訊框改成「欄位名稱只列一次」的欄式編碼，手機弱網路下載歷史訊息快很多
+import json
+from typing import Optional
+
+try:
+    import msgpack
+except ImportError:  # 沒裝 msgpack 就不接受協商，所有客戶端都走 JSON
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = "chat.msgpack.v1"
+
+# 內含訊息陣列的訊框，MessagePack 模式下改用欄式編碼
+_TABULAR_TYPES = {"history", "history_delta"}
+
+
+def negotiate(websocket) -> Optional[str]:
+    """依客戶端提出的子協定決定要用的格式，回傳 None 代表 JSON"""
+    offered = websocket.headers.get("sec-websocket-protocol", "")
+    if msgpack is not None and MSGPACK_SUBPROTOCOL in (p.strip() for p in offered.split(",")):
+        return MSGPACK_SUBPROTOCOL
+    return None
+
+def to_columns(messages: list) -> dict:
+    """
+    [{"id": 1, "nickname": "a", ...}, ...] -> {"fields": ["id", "nickname", ...], "rows": [[1, "a", ...], ...]}
+    不同類型的訊息欄位不一樣，缺少的欄位填 None
+    """
+    fields = []
+    seen = set()
+    for msg in messages:
+        for key in msg:
+            if key not in seen:
+                seen.add(key)
+                fields.append(key)
+    return {"fields": fields, "rows": [[msg.get(key) for key in fields] for msg in messages]}
+
+
+class Frame:
+    """
+    一則要送出的訊息，每種格式只編碼一次 (廣播給一千人也只 json.dumps / packb 各一次)
+    JSON 模式回傳 str (文字訊框)，MessagePack 模式回傳 bytes (二進位訊框)
+    """
+    __slots__ = ("payload", "_json", "_msgpack")
+
+    def __init__(self, payload: dict):
+        self.payload = payload
+        self._json: Optional[str] = None
+        self._msgpack: Optional[bytes] = None
+
+    def encode(self, protocol: Optional[str]):
+        if protocol == MSGPACK_SUBPROTOCOL:
+            if self._msgpack is None:
+                payload = self.payload
+                if payload.get("type") in _TABULAR_TYPES:
+                    payload = {**payload, "messages": to_columns(payload["messages"])}
+                self._msgpack = msgpack.packb(payload)
+            return self._msgpack
+        if self._json is None:
+            self._json = json.dumps(self.payload)
+        return self._json